@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+'''
+compare.py
+Compares two replay.py results files and points out regressions: throughput or CPU per line worse by
+more than the threshold, alert latency up by more than the latency threshold, and alerts that are
+newly missed or unexpected.  Exits with 1 if there are any, so it can gate a change.
+
+Usage: python3 bench/compare.py BASELINE.json NEW.json [--threshold PERCENT] [--latency_threshold SECONDS]
+
+'''
+
+import argparse
+import json
+import sys
+
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def alert_latencies(fixture):
+    latencies = {}
+    for alert in fixture["alerts"]:
+        if "latency_s" in alert:
+            latencies.setdefault(alert["alert"], alert["latency_s"])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two replay benchmark results.')
+    parser.add_argument('baseline', help='Results file to compare against')
+    parser.add_argument('new', help='Results file to check')
+    parser.add_argument('--threshold', type=float, default=10, help='Allowed slowdown in percent (default 10)')
+    parser.add_argument('--latency_threshold', type=float, default=0.5, help='Allowed alert latency increase in seconds (default 0.5)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print("Baseline: " + baseline["label"] + " (" + baseline["created"] + ", python " + baseline["python"] + ")")
+    print("New:      " + new["label"] + " (" + new["created"] + ", python " + new["python"] + ")")
+    if baseline["platform"] != new["platform"]:
+        print("Warning: results are from different platforms, timings may not be comparable")
+    print("")
+    print("%-10s %14s %14s %12s" % ("fixture", "lines/sec", "cpu us/line", "peak queue"))
+
+    regressions = []
+    for name, old in sorted(baseline["fixtures"].items()):
+        fixture = new["fixtures"].get(name)
+        if fixture is None:
+            print("%-10s missing from new results" % name)
+            continue
+
+        throughput = change(old["lines_per_sec"], fixture["lines_per_sec"])
+        cpu = change(old["cpu_us_per_line"], fixture["cpu_us_per_line"])
+        print("%-10s %+13.1f%% %+13.1f%% %5d -> %-5d" % (name, throughput, cpu, old["peak_queue_depth"], fixture["peak_queue_depth"]))
+
+        if throughput < -args.threshold:
+            regressions.append(name + ": throughput down " + format(-throughput, ".1f") + "%")
+        if cpu > args.threshold:
+            regressions.append(name + ": CPU per line up " + format(cpu, ".1f") + "%")
+
+        old_latencies = alert_latencies(old)
+        for alert, latency in alert_latencies(fixture).items():
+            if alert in old_latencies and latency - old_latencies[alert] > args.latency_threshold:
+                regressions.append(name + ": '" + alert + "' latency " + str(old_latencies[alert]) + "s -> " + str(latency) + "s")
+
+        old_missed = [expect["alert"] for expect in old["missed"]]
+        for expect in fixture["missed"]:
+            if expect["alert"] not in old_missed:
+                regressions.append(name + ": '" + expect["alert"] + "' is no longer detected")
+        for alert in fixture["unexpected"]:
+            if alert not in old["unexpected"]:
+                regressions.append(name + ": unexpected alert '" + alert + "'")
+
+    print("")
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print("    " + regression)
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
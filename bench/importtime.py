@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+'''
+importtime.py
+Checks what loading the monitor agent costs before it does anything.  Runs Python with -X importtime
+on sjmstreammonitor-withprobe.py (loaded as a module, so startup() and main() don't run) and reports
+the time spent importing, the slowest imports, and whether any of the heavy dependencies that should
+only be loaded when needed (pymongo, Apprise, PIL, NumPy, urllib.request, http.server) came in,
+and whether anything set up logging (that is startup()'s job, a handler installed on import
+would write every record straight to stderr as well as through streammon_log's queue).
+
+Usage: python3 bench/importtime.py [--budget MS] [--repeat N]
+
+Exits with 1 if the import time (the fastest of --repeat runs, less a bare interpreter's) is over
+the budget, a heavy dependency was loaded or the root logger has handlers, so it can run before a release.  Needs config.py like
+the monitor itself.  Timings are only comparable between runs on the same machine.
+
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MONITOR = os.path.join(BASE_DIR, "sjmstreammonitor-withprobe.py")
+
+# Milliseconds the monitor's imports may take, on top of the interpreter's own
+IMPORT_BUDGET_MS = 150
+
+# Loaded on first use only
+LAZY_MODULES = ("pymongo", "apprise", "PIL", "numpy", "urllib.request", "http.server")
+
+LOAD_MONITOR = '''
+import json, logging, runpy, sys
+sys.path.insert(0, %r)
+runpy.run_path(%r, run_name="streammon_importtime")
+print(json.dumps({"loaded": [name for name in %r if name in sys.modules],
+    "handlers": [repr(handler) for handler in logging.getLogger().handlers]}))
+''' % (BASE_DIR, MONITOR, LAZY_MODULES)
+
+
+# Runs code with -X importtime, returns {module: cumulative microseconds} for the top level imports,
+# and what the code printed
+def import_times(code):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=BASE_DIR)
+    if result.returncode != 0:
+        sys.exit("Loading the monitor failed:\n" + result.stderr[-2000:])
+    times = {}
+    for line in result.stderr.splitlines():
+        # "import time:      self [us] | cumulative | imported package", nested imports are indented
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times, result.stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the monitor agent.')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS, help='Import time budget in ms')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs, the fastest one counts')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports to list')
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.repeat):
+        # The interpreter and what the loader itself imports (runpy imports pkgutil when it's used)
+        baseline, _ = import_times("import json, logging, pkgutil, runpy, sys")
+        times, output = import_times(LOAD_MONITOR)
+        total = sum(us for name, us in times.items() if name not in baseline) / 1000
+        if best is None or total < best[0]:
+            best = (total, times, baseline, output)
+
+    total, times, baseline, output = best
+    result = json.loads(output.strip().splitlines()[-1])
+    loaded = result["loaded"]
+
+    print("Slowest imports:")
+    for name, us in sorted(((name, us) for name, us in times.items() if name not in baseline), key=lambda item: -item[1])[:args.top]:
+        print("  %-30s %8.1f ms" % (name, us / 1000))
+    print("Import time %.1f ms, budget %.1f ms" % (total, args.budget))
+
+    failed = False
+    if total > args.budget:
+        print("Over budget")
+        failed = True
+    if loaded:
+        print("Loaded at import, should be loaded on first use: " + ", ".join(loaded))
+        failed = True
+    if result["handlers"]:
+        print("Logging set up at import, should be left to startup(): " + ", ".join(result["handlers"]))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
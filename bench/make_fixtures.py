@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+'''
+make_fixtures.py
+Writes the replay fixtures in bench/fixtures: the output ffmpeg gives the monitor (progress reports
+and filter metadata from the events pipe, warnings from stderr) for a normal, black, frozen, silent
+and dropped stream, along with the alerts each one should produce.
+
+These are synthetic: they follow what ffmpeg prints with the arguments from
+streammon_detect.build_ffmpeg_args(), with every line stamped with the stream time it arrives at, but
+nothing here was recorded.  record.py records the same format from a real ffmpeg run, for fixtures
+from your own streams.
+
+Usage: python3 bench/make_fixtures.py [output directory]
+
+'''
+
+import json
+import os
+import sys
+
+FPS = 25
+DURATION = 120
+
+# The conditions in each fixture, as (start, end) in stream seconds
+BLACK = (30, 60)
+FREEZE = (40, 90)
+FREEZE_DURATION = 10
+SILENCE = (20, 70)
+SILENCE_DURATION = 10
+DROPPED = (40, 80)
+
+# When the detection settings the replay uses (StreamState defaults) should raise each alert
+BLACKFRAME_SECONDS_ALLOWED = 5
+STALE_FRAME_TIMEOUT = 10
+
+
+def progress_block(t, frame):
+    # What -progress writes every -stats_period
+    out_time_us = int(t * 1000000)
+    return [
+        "frame=" + str(frame),
+        "fps=" + format(FPS, ".2f"),
+        "stream_0_0_q=-0.0",
+        "bitrate=N/A",
+        "total_size=N/A",
+        "out_time_us=" + str(out_time_us),
+        "out_time_ms=" + str(out_time_us),
+        "out_time=" + "%02d:%02d:%09.6f" % (t // 3600, (t % 3600) // 60, t % 60),
+        "dup_frames=0",
+        "drop_frames=0",
+        "speed=1.00x",
+        "progress=continue",
+    ]
+
+
+def metadata_block(frame, t, values):
+    # What metadata=mode=print writes for a frame that has metadata
+    return ["frame:%-4d pts:%-7d pts_time:%s" % (frame, int(t * 90000), format(t, "g"))] + \
+        [key + "=" + value for key, value in values]
+
+
+def make(name):
+    lines = []
+    expected = []
+
+    def add(t, new_lines):
+        for line in new_lines:
+            lines.append((round(t, 3), line))
+
+    # A warning or two on stderr, like most real streams have
+    add(0.5, ["[hls @ 0x55d0c8a3c040] [warning] Skip ('#EXT-X-VERSION:3')"])
+    add(0.6, ["[https @ 0x55d0c8a44f00] [warning] Opening 'https://example.com/live/segment100.ts' for reading"])
+
+    frame = 0
+    for n in range(DURATION * FPS):
+        t = n / FPS
+        stalled = name == "dropped" and DROPPED[0] <= t < DROPPED[1]
+        if not stalled:
+            frame = frame + 1
+
+        if name == "black":
+            values = []
+            if BLACK[0] <= t < BLACK[1]:
+                values.append(("lavfi.blackframe.pblack", "100"))
+                if t == BLACK[0]:
+                    values.append(("lavfi.black_start", format(t, "g")))
+            elif t == BLACK[1]:
+                values.append(("lavfi.black_end", format(t, "g")))
+            if values:
+                add(t, metadata_block(frame, t, values))
+
+        elif name == "frozen":
+            if t == FREEZE[0] + FREEZE_DURATION:
+                add(t, metadata_block(frame, t, [("lavfi.freezedetect.freeze_start", format(FREEZE[0], "g"))]))
+            elif t == FREEZE[1]:
+                add(t, metadata_block(frame, t, [
+                    ("lavfi.freezedetect.freeze_duration", format(FREEZE[1] - FREEZE[0], "g")),
+                    ("lavfi.freezedetect.freeze_end", format(t, "g"))]))
+
+        elif name == "silent":
+            # Audio frames are numbered separately, 1024 samples at 48kHz
+            if t == SILENCE[0] + SILENCE_DURATION:
+                add(t, metadata_block(int(t * 48000 / 1024), t, [("lavfi.silence_start", format(SILENCE[0], "g"))]))
+            elif t == SILENCE[1]:
+                add(t, metadata_block(int(t * 48000 / 1024), t, [
+                    ("lavfi.silence_end", format(t, "g")),
+                    ("lavfi.silence_duration", format(SILENCE[1] - SILENCE[0], "g"))]))
+
+        if n % FPS == FPS - 1:
+            add(t + 1 / FPS, progress_block(t + 1 / FPS, frame))
+
+    if name == "black":
+        expected.append({"alert": "BLACKFRAME DURATION EXCEEDED", "due": BLACK[0] + BLACKFRAME_SECONDS_ALLOWED})
+        expected.append({"alert": "Blackframe issue ended", "due": BLACK[1]})
+    elif name == "frozen":
+        expected.append({"alert": "FREEZEFRAME DURATION EXCEEDED", "due": FREEZE[0] + FREEZE_DURATION})
+        expected.append({"alert": "Freezeframe issue ended", "due": FREEZE[1]})
+    elif name == "silent":
+        expected.append({"alert": "SILENCE DURATION EXCEEDED", "due": SILENCE[0] + SILENCE_DURATION})
+        expected.append({"alert": "Audio restored", "due": SILENCE[1]})
+    elif name == "dropped":
+        expected.append({"alert": "NO_NEW_FRAMES DURATION EXCEEDED", "due": DROPPED[0] + STALE_FRAME_TIMEOUT})
+        expected.append({"alert": "NO_NEW_FRAMES CONDITION ENDED", "due": DROPPED[1]})
+
+    lines.sort(key=lambda item: item[0])
+    return lines, expected
+
+
+def main():
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+    os.makedirs(out_dir, exist_ok=True)
+
+    for name in ("normal", "black", "frozen", "silent", "dropped"):
+        lines, expected = make(name)
+        with open(os.path.join(out_dir, name + ".log"), "w") as f:
+            for t, line in lines:
+                f.write(format(t, ".3f") + "\t" + line + "\n")
+        with open(os.path.join(out_dir, name + ".json"), "w") as f:
+            json.dump({"expected": expected}, f, indent=2)
+            f.write("\n")
+        print(name + ": " + str(len(lines)) + " lines, " + str(len(expected)) + " expected alerts")
+
+
+if __name__ == "__main__":
+    main()
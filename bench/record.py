@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+'''
+record.py
+Records a replay fixture from a real ffmpeg: runs ffmpeg on a stream (or file) with the monitor's
+arguments and writes every line it gives the monitor, on stderr and the events pipe, stamped with
+the seconds since ffmpeg started.  Write the matching .json with the alerts you expect by hand.
+
+Usage: python3 bench/record.py STREAM_URI OUTPUT.log [--seconds N] [--audio_only] [--profile PROFILE]
+
+Use -re in --input_args when recording from a file, so it is read at the stream's own speed.
+
+'''
+
+import argparse
+import os
+import selectors
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streammon_detect import build_ffmpeg_args, build_input_args
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record ffmpeg monitor output as a replay fixture.')
+    parser.add_argument('stream_uri', help='Stream URI or file')
+    parser.add_argument('output', help='Fixture file to write')
+    parser.add_argument('--seconds', type=int, default=120, help='How long to record')
+    parser.add_argument('--audio_only', action='store_true')
+    parser.add_argument('--profile', default="full", help='Analysis profile (full, reduced or keyframe)')
+    parser.add_argument('--input_args', default="", help='Extra ffmpeg input arguments, e.g. "-re"')
+    parser.add_argument('--ffmpeg', default="/usr/bin/ffmpeg")
+    args = parser.parse_args()
+
+    # Same settings the supervisor gives the monitors, but without the frame grab output
+    ffmpeg_args = build_ffmpeg_args(int(args.audio_only), "32", "-50", "10", "-45", "10", 60,
+        frame_grab_from_analyzer=0, profile=args.profile)
+    events_read, events_write = os.pipe()
+    ffmpeg_args = ffmpeg_args.replace("{events_fd}", str(events_write))
+    input_args = build_input_args(int(args.audio_only), args.profile) + " " + args.input_args
+    command = [args.ffmpeg] + input_args.split() + ["-t", str(args.seconds), "-i", args.stream_uri] + ffmpeg_args.split()
+    print("Running " + " ".join(command))
+
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, pass_fds=(events_write,))
+    os.close(events_write)
+    start = time.monotonic()
+
+    selector = selectors.DefaultSelector()
+    events = os.fdopen(events_read, 'rb')
+    selector.register(process.stderr, selectors.EVENT_READ)
+    selector.register(events, selectors.EVENT_READ)
+
+    count = 0
+    with open(args.output, "w") as out:
+        while selector.get_map():
+            for key, _ in selector.select():
+                line = key.fileobj.readline()
+                if not line:
+                    selector.unregister(key.fileobj)
+                    continue
+                out.write(format(time.monotonic() - start, ".3f") + "\t" + line.decode('UTF-8', errors='replace').rstrip() + "\n")
+                count = count + 1
+
+    process.wait()
+    print("Wrote " + str(count) + " lines to " + args.output + ", ffmpeg exited with " + str(process.returncode))
+
+
+if __name__ == "__main__":
+    main()
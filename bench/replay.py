@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+'''
+replay.py
+Replays recorded ffmpeg output (bench/fixtures, see make_fixtures.py and record.py) through the
+monitor's parsing and detection path as fast as it will go, and reports for each fixture:
+
+  lines_per_sec     lines through classify_line() and StreamState.handle_event() per wall clock second
+  cpu_us_per_line   process CPU time per line, in microseconds
+  peak_queue_depth  deepest the bounded analyze queue got (and how many droppable lines were dropped)
+  alerts            each alert with its latency: stream seconds after it was due (latency_s), and wall
+                    clock time from its line being queued to the alert being raised (latency_wall_ms)
+  missed/unexpected expected alerts that never came, and alerts that weren't expected
+
+The pipeline is the monitor's: a reader thread classifies the lines and puts them on a bounded queue
+(dropping only the droppable ones when it's full), and the consumer feeds them to a StreamState
+using the stream time from the fixture as its clock.  Alerts go to a stub instead of Apprise and
+Mongo, and logging goes nowhere.
+
+Results are written as JSON (bench/results/<label>.json by default), compare them with compare.py.
+
+Usage: python3 bench/replay.py [--label LABEL] [--repeat N] [--fixtures DIR] [--output FILE]
+
+'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from queue import Queue
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+from streammon_detect import StreamState, new_queue_stats, queue_line
+
+# Same as the monitor's ANALYZE_QUEUE_SIZE
+ANALYZE_QUEUE_SIZE = 2000
+
+# Fixtures are checked with these settings, see make_fixtures.py
+RAMPUP_TIME = 10
+BLACKFRAME_SECONDS_ALLOWED = 5
+STALE_FRAME_TIMEOUT = 10
+
+
+# Returns the (stream time, line) pairs of a fixture and the alerts it should produce
+def load_fixture(path):
+    lines = []
+    with open(path) as f:
+        for row in f:
+            t, line = row.rstrip("\n").split("\t", 1)
+            lines.append((float(t), line))
+
+    expected = []
+    expected_path = os.path.splitext(path)[0] + ".json"
+    if os.path.exists(expected_path):
+        with open(expected_path) as f:
+            expected = json.load(f)["expected"]
+    return lines, expected
+
+
+# Runs the fixture through the pipeline once, returns the measurements
+def replay(lines, queue_size=ANALYZE_QUEUE_SIZE):
+    analyzeq = Queue(maxsize=queue_size)
+    stats = new_queue_stats()
+    alerts = []
+    current = {}
+
+    # Where the monitor would queue the alert for the dispatcher
+    def send_message(msg):
+        alerts.append({
+            "alert": msg,
+            "time": current["t"],
+            "latency_wall_ms": (time.perf_counter() - current["queued"]) * 1000,
+        })
+
+    log = logging.getLogger("bench.replay")
+    log.propagate = False
+    log.addHandler(logging.NullHandler())
+    state = StreamState("replay", send_message, 0, log=log, blackframe_seconds_allowed=BLACKFRAME_SECONDS_ALLOWED,
+        stale_frame_timeout=STALE_FRAME_TIMEOUT, rampup_time=RAMPUP_TIME)
+
+    # What the monitor's reader threads do with each line (see enqueue_output())
+    def reader():
+        for t, line in lines:
+            queue_line(analyzeq, line, stats, extra=(t, time.perf_counter()))
+        analyzeq.put(None)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    t = threading.Thread(target=reader)
+    t.start()
+    while True:
+        item = analyzeq.get()
+        if item is None:
+            break
+        event, value, line, current["t"], current["queued"] = item
+        state.handle_event(event, value, line, current["t"])
+    t.join()
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {
+        "lines": len(lines),
+        "wall_s": wall,
+        "lines_per_sec": len(lines) / wall,
+        "cpu_us_per_line": cpu / len(lines) * 1000000,
+        "peak_queue_depth": stats["high_water"],
+        "dropped": stats["dropped"],
+        "blocked": stats["blocked"],
+        "alerts": alerts,
+    }
+
+
+# Matches the alerts against the expected ones, adds latency_s to the matched alerts and
+# returns (missed, unexpected)
+def check_alerts(alerts, expected):
+    unmatched = list(alerts)
+    missed = []
+    for expect in expected:
+        for alert in unmatched:
+            if alert["alert"].startswith(expect["alert"]) and alert["time"] >= expect["due"] - 0.001:
+                alert["latency_s"] = round(alert["time"] - expect["due"], 3)
+                unmatched.remove(alert)
+                break
+        else:
+            missed.append(expect)
+    return missed, [alert["alert"] for alert in unmatched]
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=bench_dir,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded ffmpeg output through the detection path.')
+    parser.add_argument('--fixtures', default=os.path.join(bench_dir, "fixtures"), help='Fixture directory')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per fixture, the fastest one counts')
+    parser.add_argument('--queue_size', type=int, default=ANALYZE_QUEUE_SIZE, help='Analyze queue size')
+    parser.add_argument('--label', default=None, help='Name for this run (default: git describe)')
+    parser.add_argument('--output', default=None, help='Results file (default: bench/results/<label>.json)')
+    args = parser.parse_args()
+
+    version = git_version()
+    label = args.label or version
+    results = {
+        "label": label,
+        "version": version,
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "queue_size": args.queue_size,
+        "fixtures": {},
+    }
+
+    paths = sorted(glob.glob(os.path.join(args.fixtures, "*.log")))
+    if not paths:
+        print("No fixtures in " + args.fixtures + ", run make_fixtures.py first")
+        sys.exit(1)
+
+    print("%-10s %8s %12s %10s %6s %8s  %s" % ("fixture", "lines", "lines/sec", "cpu us/ln", "peak", "dropped", "alerts (latency)"))
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        lines, expected = load_fixture(path)
+        best = None
+        for _ in range(args.repeat):
+            run = replay(lines, args.queue_size)
+            if best is None or run["wall_s"] < best["wall_s"]:
+                best = run
+        best["missed"], best["unexpected"] = check_alerts(best["alerts"], expected)
+        results["fixtures"][name] = best
+
+        latencies = ", ".join(a["alert"].split(" ")[0] + " " + (format(a["latency_s"], ".2f") + "s" if "latency_s" in a else "?")
+            for a in best["alerts"])
+        print("%-10s %8d %12.0f %10.2f %6d %8d  %s" % (name, best["lines"], best["lines_per_sec"], best["cpu_us_per_line"],
+            best["peak_queue_depth"], best["dropped"], latencies or "-"))
+        for expect in best["missed"]:
+            print("    MISSED " + expect["alert"] + " due at " + str(expect["due"]) + "s")
+        for alert in best["unexpected"]:
+            print("    UNEXPECTED " + alert)
+
+    output = args.output or os.path.join(bench_dir, "results", label + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print("Results written to " + output)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,16 @@ for pid in $(ps aux | grep '[s]jmstreammonitor-withprobe.py' | awk '{print $2}')
         kill -9 $pid
     fi
 done
+# Monitors forked by the supervisor's zygote show up in ps as the supervisor, they list themselves in run/monitors
+for file in run/monitors/*; do
+    [ -f "$file" ] || continue
+    pid=$(basename "$file")
+    if ps -p $pid -o args= | grep -q streammon_supervisor; then
+        echo "Killing forked monitor with PID: $pid"
+        kill -9 -$pid
+    fi
+    rm -f "$file"
+done
 # kill -9 $(ps aux | grep '[s]jmstreammonitor-withprobe.py' | awk '{print $2}')
 
 # sleep 5
@@ -1,5 +1,7 @@
 import pymongo
 import argparse
+import base64
+import hashlib
 from bson import ObjectId
 
 # Define the MongoDB connection
@@ -9,6 +11,9 @@ db = client['streammon']
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description="Update MongoDB schema with dry-run option")
 parser.add_argument('--dry-run', action='store_true', help="Run the script without making any changes")
+parser.add_argument('--binary-images', action='store_true',
+    help="Also update to version 2 (binary thumbnails, alert images in stream_alert_images). "
+         "Only once the UI and API read the version 2 format, see README.md")
 args = parser.parse_args()
 
 # Check schema version
@@ -20,103 +25,156 @@ except AttributeError:
     schema_version = 0
 
 # Define the required schema version threshold
-REQUIRED_SCHEMA_VERSION = 1
+REQUIRED_SCHEMA_VERSION = 2
+
+# Version 2 changes how images are stored under the UI and API, so it's only done when asked for
+if not args.binary_images:
+    if schema_version < 2:
+        print("Not updating to schema version 2 (binary images) without --binary-images, see README.md")
+    REQUIRED_SCHEMA_VERSION = 1
 
 if schema_version < REQUIRED_SCHEMA_VERSION:
     print(f"Updating schema to version {REQUIRED_SCHEMA_VERSION}")
 
-    # Update stream_configs collection
-    print("stream_configs collection: ")
-    stream_configs = db.stream_configs.find()
-    for config in stream_configs:
-        if '_id' in config:
-            stream_id_str = str(config['_id'])
-            if args.dry_run:
-                print(f"Dry-run: Would set streamId for _id {config['_id']} to {stream_id_str}")
-            else:
-                print(f"Setting streamId for _id {config['_id']} to {stream_id_str}")
-                db.stream_configs.update_one(
-                    {'_id': config['_id']},
-                    {'$set': {'streamId': stream_id_str}}
-                )
+    # Version 1: streamId/userId fields
+    if schema_version < 1:
 
-    # Update the stream_alerts collection
-    # here we will match the value of "stream" with the "title" field in stream_configs,
-    # and then copy the streamId from stream_configs to stream_alerts
-    print ("stream_alerts collection: ")
-    stream_alerts = db.stream_alerts.find()
-    for alert in stream_alerts:
-        if 'stream' in alert:
-            stream_config = db.stream_configs.find_one({'title': alert['stream']})
-            if stream_config:
-                stream_id_str = str(stream_config['_id'])
+        # Update stream_configs collection
+        print("stream_configs collection: ")
+        stream_configs = db.stream_configs.find()
+        for config in stream_configs:
+            if '_id' in config:
+                stream_id_str = str(config['_id'])
                 if args.dry_run:
-                    print(f"Dry-run: Would set streamId for stream {alert['stream']} to {stream_id_str}")
+                    print(f"Dry-run: Would set streamId for _id {config['_id']} to {stream_id_str}")
                 else:
-                    print(f"Setting streamId for stream {alert['stream']} to {stream_id_str}")
-                    db.stream_alerts.update_one(
-                        {'_id': alert['_id']},
+                    print(f"Setting streamId for _id {config['_id']} to {stream_id_str}")
+                    db.stream_configs.update_one(
+                        {'_id': config['_id']},
                         {'$set': {'streamId': stream_id_str}}
                     )
-            else:
-                print(f"Stream {alert['stream']} not found in stream_configs")
-
-
-    # Update the stream_images collection
-    # here we will match the value of "stream" with the "title" field in stream_configs,
-    # and then copy the streamId from stream_configs to stream_images
-    stream_images = db.stream_images.find()
-    print ("stream_images collection: ")
-    for image in stream_images:
-        if 'stream' in image:
-            stream_config = db.stream_configs.find_one({'title': image['stream']})
-            if stream_config:
-                stream_id_str = str(stream_config['_id'])
-                if args.dry_run:
-                    print(f"Dry-run: Would set streamId for stream {image['stream']} to {stream_id_str}")
+
+        # Update the stream_alerts collection
+        # here we will match the value of "stream" with the "title" field in stream_configs,
+        # and then copy the streamId from stream_configs to stream_alerts
+        print ("stream_alerts collection: ")
+        stream_alerts = db.stream_alerts.find()
+        for alert in stream_alerts:
+            if 'stream' in alert:
+                stream_config = db.stream_configs.find_one({'title': alert['stream']})
+                if stream_config:
+                    stream_id_str = str(stream_config['_id'])
+                    if args.dry_run:
+                        print(f"Dry-run: Would set streamId for stream {alert['stream']} to {stream_id_str}")
+                    else:
+                        print(f"Setting streamId for stream {alert['stream']} to {stream_id_str}")
+                        db.stream_alerts.update_one(
+                            {'_id': alert['_id']},
+                            {'$set': {'streamId': stream_id_str}}
+                        )
                 else:
-                    print(f"Setting streamId for stream {image['stream']} to {stream_id_str}")
-                    db.stream_images.update_one(
-                        {'_id': image['_id']},
-                        {'$set': {'streamId': stream_id_str}}
-                    )
-            else:
-                print(f"Stream {image['stream']} not found in stream_configs")
-
-    # Update the stream_reports collection
-    # here we will match the value of "title" with the "title" field in stream_configs,
-    # and then copy the streamId from stream_configs to stream_reports
-    stream_reports = db.stream_reports.find()
-    print ("stream_reports collection: ")
-    for report in stream_reports:
-        if 'title' in report:
-            stream_config = db.stream_configs.find_one({'title': report['title']})
-            if stream_config:
-                stream_id_str = str(stream_config['_id'])
+                    print(f"Stream {alert['stream']} not found in stream_configs")
+
+
+        # Update the stream_images collection
+        # here we will match the value of "stream" with the "title" field in stream_configs,
+        # and then copy the streamId from stream_configs to stream_images
+        stream_images = db.stream_images.find()
+        print ("stream_images collection: ")
+        for image in stream_images:
+            if 'stream' in image:
+                stream_config = db.stream_configs.find_one({'title': image['stream']})
+                if stream_config:
+                    stream_id_str = str(stream_config['_id'])
+                    if args.dry_run:
+                        print(f"Dry-run: Would set streamId for stream {image['stream']} to {stream_id_str}")
+                    else:
+                        print(f"Setting streamId for stream {image['stream']} to {stream_id_str}")
+                        db.stream_images.update_one(
+                            {'_id': image['_id']},
+                            {'$set': {'streamId': stream_id_str}}
+                        )
+                else:
+                    print(f"Stream {image['stream']} not found in stream_configs")
+
+        # Update the stream_reports collection
+        # here we will match the value of "title" with the "title" field in stream_configs,
+        # and then copy the streamId from stream_configs to stream_reports
+        stream_reports = db.stream_reports.find()
+        print ("stream_reports collection: ")
+        for report in stream_reports:
+            if 'title' in report:
+                stream_config = db.stream_configs.find_one({'title': report['title']})
+                if stream_config:
+                    stream_id_str = str(stream_config['_id'])
+                    if args.dry_run:
+                        print(f"Dry-run: Would set streamId for report {report['title']} to {stream_id_str}")
+                    else:
+                        print(f"Setting streamId for report {report['title']} to {stream_id_str}")
+                        db.stream_reports.update_one(
+                            {'_id': report['_id']},
+                            {'$set': {'streamId': stream_id_str}}
+                        )
+                else:
+                    print(f"Stream {report['title']} not found in stream_configs")
+
+        # Update users collection
+        print("users collection: ")
+        users = db.users.find()
+        for user in users:
+            if '_id' in user:
+                user_id_str = str(user['_id'])
                 if args.dry_run:
-                    print(f"Dry-run: Would set streamId for report {report['title']} to {stream_id_str}")
+                    print(f"Dry-run: Would set userId for _id {user['_id']} to {user_id_str}")
                 else:
-                    print(f"Setting streamId for report {report['title']} to {stream_id_str}")
-                    db.stream_reports.update_one(
-                        {'_id': report['_id']},
-                        {'$set': {'streamId': stream_id_str}}
+                    print(f"Setting userId for _id {user['_id']} to {user_id_str}")
+                    db.users.update_one(
+                        {'_id': user['_id']},
+                        {'$set': {'userId': user_id_str}}
                     )
+
+
+    # Version 2: thumbnails are stored as binary jpeg data instead of base64, and alerts
+    # refer to their image in stream_alert_images by id instead of carrying their own copy
+    if schema_version < 2 and REQUIRED_SCHEMA_VERSION >= 2:
+        print("stream_images collection: ")
+        for image in db.stream_images.find({'data': {'$exists': True}}):
+            data = image['data']
+            if isinstance(data, str):
+                data = data.encode()
+            data = bytes(data)
+            # Raw jpeg data starts with the SOI marker, anything else is the old base64
+            if data[:2] == b'\xff\xd8':
+                continue
+            jpeg = base64.b64decode(data)
+            if args.dry_run:
+                print(f"Dry-run: Would store thumbnail for {image.get('stream')} as binary")
             else:
-                print(f"Stream {report['title']} not found in stream_configs")
-
-    # Update users collection
-    print("users collection: ")
-    users = db.users.find()
-    for user in users:
-        if '_id' in user:
-            user_id_str = str(user['_id'])
+                print(f"Storing thumbnail for {image.get('stream')} as binary")
+                db.stream_images.update_one(
+                    {'_id': image['_id']},
+                    {'$set': {'data': jpeg, 'hash': hashlib.sha1(jpeg).hexdigest()}}
+                )
+
+        print("stream_alerts collection: ")
+        for alert in db.stream_alerts.find({'image': {'$exists': True}}):
+            data = alert['image']
+            if isinstance(data, str):
+                data = data.encode()
+            jpeg = base64.b64decode(bytes(data))
+            image_hash = hashlib.sha1(jpeg).hexdigest()
             if args.dry_run:
-                print(f"Dry-run: Would set userId for _id {user['_id']} to {user_id_str}")
+                print(f"Dry-run: Would move image of alert {alert['_id']} to stream_alert_images as {image_hash}")
             else:
-                print(f"Setting userId for _id {user['_id']} to {user_id_str}")
-                db.users.update_one(
-                    {'_id': user['_id']},
-                    {'$set': {'userId': user_id_str}}
+                print(f"Moving image of alert {alert['_id']} to stream_alert_images as {image_hash}")
+                db.stream_alert_images.update_one(
+                    {'_id': image_hash},
+                    {'$setOnInsert': {'data': jpeg, 'stream': alert.get('stream')}},
+                    upsert=True
+                )
+                db.stream_alerts.update_one(
+                    {'_id': alert['_id']},
+                    {'$set': {'image_id': image_hash}, '$unset': {'image': ''}}
                 )
 
     if not args.dry_run:
@@ -16,33 +16,31 @@ from subprocess import PIPE, Popen, call
 import threading
 import concurrent.futures
 import time
-import base64
+import hashlib
 import logging
-import re
 import argparse
-import urllib.request
 from datetime import datetime
-from PIL import Image
-import io
 
-from pymongo import MongoClient
-import pymongo
-from config import MONGO_CONNECTION_STRING, OPERATING_DIRECTORY, MONGO_DATABASE_NAME, ALERTS_DISABLED, STREAMDOWN_ALERTS_DISABLED, STREAM_FAILURE_GRACE_PERIOD, STREAM_FAILURE_RETRY_INTERVAL, ENABLE_GRACEFUL_STREAM_FAILURE
+import streammon_db
+import streammon_status
+import streammon_log
+import streammon_metrics
+import streammon_raw
+import streammon_timers
+import streammon_connect
+import streammon_routing
+from streammon_detect import StreamState, build_ffmpeg_args, build_input_args, get_profile, resolve_stream_uri, split_jpeg_frames, new_queue_stats, queue_line, put_line, DROPPABLE_EVENTS, EVENT_PROTOCOL, EVENT_BLACKFRAME
+from config import OPERATING_DIRECTORY, MONGO_DATABASE_NAME, ALERTS_DISABLED, STREAMDOWN_ALERTS_DISABLED, STREAM_FAILURE_GRACE_PERIOD, STREAM_FAILURE_RETRY_INTERVAL, ENABLE_GRACEFUL_STREAM_FAILURE
 
 PROGRAM_VERSION = "1.0.3"
 
-# Apprise is a notification framework that supports, among many other things, Pushover 
-import apprise
 
 # Import Queue in way that works for both versions of Python (2.x and 3.x)
 # Note this is probably not necessary as we no longer support Python 2.x, but I'm chicken to remove it.
 try:
-    from Queue import Queue, Empty
+    from Queue import Queue, Empty, Full
 except ImportError:
-    from queue import Queue, Empty  # python 3.x
-
-
-print ("Starting up")
+    from queue import Queue, Empty, Full  # python 3.x
 
 
 # Get the database name from the config file
@@ -60,6 +58,7 @@ global_configs_collection_name = "global_configs"
 stream_configs_collection_name = "stream_configs"
 stream_alerts_collection_name = "stream_alerts"
 stream_images_collection_name = "stream_images"
+alert_images_collection_name = "stream_alert_images"
 report_collection_name = "stream_reports"
 alert_collection_name = "stream_alerts"
 users_collection_name = "users"
@@ -77,6 +76,12 @@ parser.add_argument('--pushover',
     action = "append",
     help = 'user_key')
 
+parser.add_argument('--stream_id',
+    metavar = 'stream_id',
+    type = str,
+    default = None,
+    help = 'streamId, to look up the recipients in the supervisor\'s routing table when alerting (instead of --pushover)')
+
 parser.add_argument('--audio_only',    
     action = 'store_true')    
 
@@ -128,6 +133,36 @@ parser.add_argument('--frame_grab_interval',
     default="60",
     help='Frame grab thumbnail update interval in seconds')
 
+parser.add_argument('--profile',
+    metavar = 'profile',
+    type=str,
+    default="full",
+    help='Analysis profile: full, reduced (downscaled, 5 fps) or keyframe (keyframes only, downscaled)')
+
+parser.add_argument('--detector',
+    metavar = 'detector',
+    type=str,
+    default=None,
+    help='Detector: filters (ffmpeg filters) or raw (NumPy over raw frames and PCM)')
+
+parser.add_argument('--threads',
+    metavar = 'threads',
+    type=str,
+    default="0",
+    help='ffmpeg decoder threads (0 lets ffmpeg decide)')
+
+parser.add_argument('--filter_threads',
+    metavar = 'filter_threads',
+    type=str,
+    default="0",
+    help='ffmpeg filter graph threads (0 lets ffmpeg decide)')
+
+parser.add_argument('--cpus',
+    metavar = 'cpus',
+    type=str,
+    default=None,
+    help='Comma separated list of CPUs to run on (ex: "2,3")')
+
 parser.add_argument('--stream_failure_grace_period',
     metavar = 'stream_failure_grace_period',
     type=str,
@@ -145,8 +180,8 @@ parser.add_argument('--version',
     version='%(prog)s v'+PROGRAM_VERSION,
     help='Display version info')
 
-# Allows unknown arguments:
-args, unknown = parser.parse_known_args()
+# The arguments, parsed by startup()
+args = None
 
 
 ###################################################################
@@ -170,6 +205,43 @@ SUPPRESS_BLACKFRAME_LOGGING = 0
 # Suppress most of the stuff from ffmpeg from going to the log
 SUPPRESS_FFMPEG_LOGGING = 1
 
+# Have ffmpeg report frame counters, speed and filter events on a separate pipe (-progress plus
+# metadata=print) so stderr can run at warning level instead of debug.
+# Set to 0 to go back to scraping debug level stderr (needs ffmpeg 4.4 or later for -stats_period)
+USE_PROGRESS_CHANNEL = 1
+# Seconds between progress reports from ffmpeg
+PROGRESS_PERIOD = 1
+# Log a warning when ffmpeg processes the stream slower than this (1.0 is real time)
+SLOW_SPEED_THRESHOLD = 0.9
+
+# Most lines analyze() can fall behind by.  When the queue is full, lines that the next one supersedes
+# (frame counters, speed reports, individual black frames) are dropped, condition events wait for room.
+ANALYZE_QUEUE_SIZE = 2000
+# How often to log the queue counters while they are changing
+QUEUE_STATS_LOG_INTERVAL = 60
+
+# Alerts are handed to a background dispatcher so analyze() never waits on Apprise or the database
+# Most alerts that can be waiting for delivery
+ALERT_QUEUE_SIZE = 100
+# Attempts to deliver a notification before giving up on it
+ALERT_RETRY_ATTEMPTS = 3
+# Seconds to wait before retrying a failed notification, doubles with each attempt
+ALERT_RETRY_DELAY = 5
+# Minimum seconds between notifications, so we don't send too many alerts too quickly
+ALERT_MIN_INTERVAL = 1
+
+# How black, freeze and silence are detected: "filters" has ffmpeg's filters report them, "raw" has
+# ffmpeg send small raw frames and PCM that are checked with NumPy (see streammon_raw).
+# Can be set per monitor with --detector.  Without NumPy the filters are used.
+DETECTOR = "filters"
+
+# Take the frame grab thumbnails from a second (low rate, scaled) output of the analyzer ffmpeg,
+# instead of starting a separate ffmpeg that opens its own connection to the stream every time.
+# Set to 0 to go back to the separate framegrab ffmpeg.
+FRAME_GRAB_FROM_ANALYZER = 1
+# Width of the thumbnails the analyzer produces (height follows the aspect ratio)
+FRAME_GRAB_WIDTH = 640
+
 # blackframe threshold, typically around 32
 BLACKFRAME_THRESHOLD = 32
 # Number of blackframes allowed before we start watching
@@ -199,6 +271,18 @@ STALE_FRAME_TIMEOUT = 10
 # Time to wait between upness checks.  This is not yet a command line option.
 CHECK_UPNESS_TIME = 3600
 
+# Retries within the grace period back off exponentially from the retry interval, with jitter, up to
+# this many seconds (see streammon_connect)
+RETRY_BACKOFF_MAX = 120
+
+# Check that the stream is reachable (TCP connect or HTTP HEAD) before starting ffmpeg on it
+PREFLIGHT_PROBE = 1
+
+# Seconds to wait for one of the supervisor's connect slots before connecting anyway, and seconds
+# into the analyzer's run that the slot is handed back (by then ffmpeg has opened the stream or failed)
+CONNECT_SLOT_WAIT = 60
+CONNECT_SLOT_HOLD = 5
+
 # Send alerts when an issue is resolved
 SEND_RESTORED_ALERTS = 1
 
@@ -212,185 +296,197 @@ ON_POSIX = 'posix' in sys.builtin_module_names
 #############################################
 # Initialize a bunch of globals
 #############################################
-program_start_time = time.time()
-last_framegrab_time = 0
-blackframe_timer_running = 0
-blackframe_last_seen_time = 0
-blackframe_timer = float(0)
-freeze_frame_in_progress = 0
-audio_silent_in_progress = 0
+# Monotonic, like the detection deadlines (see StreamState)
+program_start_time = time.monotonic()
 last_probe_time = 0
 probe_running = 0
 stream_status = 1
-last_frame = 0
-watching_stale_frames = 0
-stale_frame_start_time = 0
-stale_frames_in_progress = 0
-
-
-# Get ready to bring the logger online
-# Since logging depends on the stream description, we will start with that
-if args.stream_desc:
-    print("Stream description: "+ args.stream_desc)
-    stream_desc=args.stream_desc
-else:
-    print("FATAL: Stream Description is required. Monitor thread exiting.")
-    sys.exit()
-
-# Ensure the log file exists because apparently logger can't handle that
-filename_temp=str(log_dir + "/"+args.stream_desc+".log")
-print ("Opening log file: " + filename_temp + "\n")
-if not os.path.isfile(filename_temp):
-    # Create an empty file
-    with open(filename_temp, 'w') as f:
-        pass
-
-# set up logging to file    
-logging.basicConfig(
-    #  filename=log_dir + "/"+args.stream_desc+".log",
-    filename=filename_temp,
-     level=logging.DEBUG, 
-     #format= '[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
-     filemode='w',
-     format='%(asctime)s %(message)s',
-     datefmt='%H:%M:%S'
- )
-
-# set up logging to console
-console = logging.StreamHandler()
-console.setLevel(logging.DEBUG)
-# set a format which is simple for console use
-formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-console.setFormatter(formatter)
-# add the handler to the root logger
-logging.getLogger('').addHandler(console)
-logger = logging.getLogger(__name__)
-
-# Create a new Apprise instance for notifications
-apobj = apprise.Apprise()
-
-# Override defaults with anything we get from command line
-if args.pushover:    
-    for x in args.pushover:
-        logging.info("Adding CL pushover info: " + x)
-        apobj.add('pover://' + x)
-else:
-    logging.info("WARNING: No Pushover key, will run without delivering alerts")
-
-
-#################################################
-# Go through all the arguments we have been given and log the requested settings
-#################################################
-    
-# If we are monitoring an audio stream, make a note so we don't do blackframe or freeze detection
-if args.audio_only:
-    logging.info("Stream is audio_only=" + str(args.audio_only))
-    AUDIO_ONLY=1
-    FRAME_GRAB_INTERVAL = 3600
-
-else:
-    AUDIO_ONLY=0
-
-    if int(args.frame_grab_interval) > 0:
-        logging.info("Using frame grab interval " + args.frame_grab_interval)
-        FRAME_GRAB_INTERVAL = args.frame_grab_interval
-
-    if args.black_threshold:
-        logging.info("Using black threshold " + args.black_threshold)
-        BLACKFRAME_THRESHOLD=args.black_threshold
-
-    if args.black_duration:
-        logging.info("Using black duration " + args.black_duration)
-        BLACKFRAME_SECONDS_ALLOWED = args.black_duration
-
-    if args.freeze_threshold:
-        logging.info("Using freeze threshold " + args.freeze_threshold)
-        FREEZE_NOISE_THRESHOLD=args.freeze_threshold
-
-    if args.freeze_duration:
-        logging.info("Using freeze duration " + args.freeze_duration)
-        FREEZETIME_SECONDS_ALLOWED = args.freeze_duration
-
-if args.silence_threshold:
-    logging.info("Using silence threshold " + args.silence_threshold)
-    SILENCE_THRESHOLD=args.silence_threshold
-
-if args.silence_duration:
-    logging.info("Using silence duration " + args.silence_duration)    
-    SILENCE_DURATION = args.silence_duration
-
-if args.stream_uri:
-    logging.info("Using stream uri " + args.stream_uri)
-    stream = args.stream_uri
-else:
-    logging.error("FATAL: Stream URI is required. Monitor thread exiting.")
-    sys.exit()
-
-
-def resolve_stream_uri(uri):
-    """
-    If the URI points to a .m3u playlist, fetch it and return the first
-    real stream URL found inside it.  Returns the original URI on any
-    failure or if the URI is not a .m3u file.
-    """
-    if not uri.lower().endswith('.m3u'):
-        return uri
-    logging.info("URI ends with .m3u - fetching playlist to resolve real stream URL")
-    try:
-        req = urllib.request.Request(uri, headers={'User-Agent': 'StreamMonitor/1.0'})
-        with urllib.request.urlopen(req, timeout=10) as response:
-            content = response.read().decode('utf-8', errors='ignore')
-        for line in content.splitlines():
-            line = line.strip()
-            if line and not line.startswith('#'):
-                logging.info(f"Resolved .m3u URI '{uri}' -> '{line}'")
-                return line
-        logging.warning("No usable stream URL found in .m3u playlist; using original URI")
-    except Exception as e:
-        logging.warning(f"Failed to fetch/parse .m3u playlist ({uri}): {e}; using original URI")
-    return uri
+# Analyze queue counters: deepest the queue has been, lines dropped and puts that had to wait because it was full
+queue_stats = new_queue_stats()
+# ffmpeg lines analyze() has handled, and how long alerts took from detection to delivery
+lines_analyzed = 0
+alert_latency = streammon_metrics.Histogram(streammon_metrics.ALERT_LATENCY_BUCKETS)
+lines_rate = streammon_metrics.RateMeter()
+# Host-wide cap on connection attempts (see streammon_connect)
+connect_slots = streammon_connect.ConnectSlots()
+# Alerts waiting for the dispatcher, as (message, time detected, frame grab) tuples
+alert_queue = Queue(maxsize=ALERT_QUEUE_SIZE)
+last_alert_sent_time = 0
+# Hash of the last thumbnail written to the database, and the audio icon once we have read it
+last_frame_grab_hash = None
+audio_icon_data = None
+# Latest jpeg thumbnail from the analyzer and when we got it (see FRAME_GRAB_FROM_ANALYZER)
+latest_frame_grab = None
+latest_frame_grab_time = 0
+# The raw detector of the running analyzer, if DETECTOR is "raw"
+raw_detector = None
+# Whether the stream has sound, for the raw detector (None until ffprobe has told us, see raw_ffmpeg_args())
+stream_has_audio = None
+# Status records for the supervisor (see streammon_status)
+status_publisher = streammon_status.StatusPublisher()
+# Apprise, once the first alert needs it, and the keys it was made for (see get_apprise())
+apobj = None
+apobj_keys = None
+# Who gets the alerts, if we were started with --stream_id
+routing_table = streammon_routing.RoutingTable()
+# Thumbnail updates run here, off the analyze thread.  One worker, so they happen one at a time and in
+# order (the thread is only started with the first one).
+frame_grab_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame_grab")
+
+
+# Everything the monitor does before main(): reads the arguments, starts logging, works out the
+# settings and resolves the stream.  Nothing happens on import, so the module can be loaded (e.g.
+# by bench/importtime.py) without side effects.
+def startup():
+    global args
+    global logger
+    global stream
+    global FFMPEG
+    global FFMPEG_INPUT_ARGS
+    global FRAME_GRAB_INTERVAL
+    global BLACKFRAME_SECONDS_ALLOWED
+    global stream_desc
+    global AUDIO_ONLY
+    global PROFILE
+    global STALE_FRAME_TIMEOUT
+    global BLACKFRAME_RESET_TIME
+    global SILENCE_THRESHOLD
+    global SILENCE_DURATION
+    global DETECTOR
+    global FFMPEG_ARGS
+    global BLACKFRAME_THRESHOLD
+    global FREEZE_NOISE_THRESHOLD
+    global FREEZETIME_SECONDS_ALLOWED
+
+    print ("Starting up")
+
+    # Allows unknown arguments:
+    args, unknown = parser.parse_known_args()
+
+    # Get ready to bring the logger online
+    # Since logging depends on the stream description, we will start with that
+    if args.stream_desc:
+        print("Stream description: "+ args.stream_desc)
+        stream_desc=args.stream_desc
+    else:
+        print("FATAL: Stream Description is required. Monitor thread exiting.")
+        sys.exit()
+
+    filename_temp=str(log_dir + "/"+args.stream_desc+".log")
+    print ("Opening log file: " + filename_temp + "\n")
 
+    # set up logging to file (emptied first, rotated when it gets big) and console.
+    # The writes happen on a separate thread, see streammon_log
+    streammon_log.start_logging(filename_temp)
+    logger = logging.getLogger(__name__)
+    logging.info("(re)starting...")
 
-stream = resolve_stream_uri(stream)
+    # The Apprise instance for notifications is made when the first alert goes out, see get_apprise()
+    if args.stream_id:
+        logging.info("Recipients for stream " + args.stream_id + " come from " + routing_table.path)
+    elif not args.pushover:
+        logging.info("WARNING: No Pushover key, will run without delivering alerts")
 
 
-# Define the FFMPEG stream monitor command
-FFMPEG = "/usr/bin/ffmpeg"
+    #################################################
+    # Go through all the arguments we have been given and log the requested settings
+    #################################################
+    
+    # If we are monitoring an audio stream, make a note so we don't do blackframe or freeze detection
+    if args.audio_only:
+        logging.info("Stream is audio_only=" + str(args.audio_only))
+        AUDIO_ONLY=1
+        FRAME_GRAB_INTERVAL = 3600
+
+    else:
+        AUDIO_ONLY=0
 
+        if int(args.frame_grab_interval) > 0:
+            logging.info("Using frame grab interval " + args.frame_grab_interval)
+            FRAME_GRAB_INTERVAL = args.frame_grab_interval
 
+        if args.black_threshold:
+            logging.info("Using black threshold " + args.black_threshold)
+            BLACKFRAME_THRESHOLD=args.black_threshold
 
+        if args.black_duration:
+            logging.info("Using black duration " + args.black_duration)
+            BLACKFRAME_SECONDS_ALLOWED = args.black_duration
 
+        if args.freeze_threshold:
+            logging.info("Using freeze threshold " + args.freeze_threshold)
+            FREEZE_NOISE_THRESHOLD=args.freeze_threshold
 
-# Define the FFMPEG_ARGS which will hold all of the arguments necessary to support the requested monitoring features
-FFMPEG_ARGS = ""
+        if args.freeze_duration:
+            logging.info("Using freeze duration " + args.freeze_duration)
+            FREEZETIME_SECONDS_ALLOWED = args.freeze_duration
 
-if AUDIO_ONLY != 1:
-    # This section deals with adding Freezeframe and blackframe detection for video (aka non-audio_only)
-    # logging.info("Adding blackdetect and freezedetect to FFMPEG_ARGS")
-    # The below line may not be necessary but makes the logs much more noisy. With some experimentation, it may be possible to remove it.
-    # But I can't remember if there is a message we need that only appears with it on.
-    FFMPEG_ARGS = " -loglevel repeat+level+debug"  
+        # A cheaper analysis profile needs more patience with the frame counter and black frames
+        PROFILE = get_profile(args.profile)
+        logging.info("Using analysis profile " + PROFILE.name)
+        STALE_FRAME_TIMEOUT = max(STALE_FRAME_TIMEOUT, PROFILE.min_stale_frame_timeout)
+        BLACKFRAME_RESET_TIME = max(BLACKFRAME_RESET_TIME, PROFILE.min_blackframe_reset_time)
 
-    # Add video filter argument
-    FFMPEG_ARGS = FFMPEG_ARGS + " -vf "
+    if args.silence_threshold:
+        logging.info("Using silence threshold " + args.silence_threshold)
+        SILENCE_THRESHOLD=args.silence_threshold
 
-    # Add blackdetect video filter
-    FFMPEG_ARGS = FFMPEG_ARGS + "blackdetect=d=0:pix_th=0.10,blackframe=amount=98:threshold="+str(BLACKFRAME_THRESHOLD)
+    if args.silence_duration:
+        logging.info("Using silence duration " + args.silence_duration)    
+        SILENCE_DURATION = args.silence_duration
 
-    # Add freezedetect video filter
-    if int(FREEZETIME_SECONDS_ALLOWED) > 0:
-        logging.info("Freezeframe alerting enabled")
-        FFMPEG_ARGS = FFMPEG_ARGS +",freezedetect=noise="+str(FREEZE_NOISE_THRESHOLD)+"dB:duration=" + str(FREEZETIME_SECONDS_ALLOWED)
+    if args.stream_uri:
+        logging.info("Using stream uri " + args.stream_uri)
+        stream = args.stream_uri
     else:
-        logging.info("Freezeframe alerting disabled (duration was 0)")
+        logging.error("FATAL: Stream URI is required. Monitor thread exiting.")
+        sys.exit()
+
+
+    stream = resolve_stream_uri(stream)
+
+
+    # Define the FFMPEG stream monitor command
+    FFMPEG = "/usr/bin/ffmpeg"
+
+
+
+
 
-# Add audio silence monitoring (for both video and audio)
-FFMPEG_ARGS = FFMPEG_ARGS + " -af silencedetect=noise="+str(SILENCE_THRESHOLD)+"dB:d="+str(SILENCE_DURATION)
+    if args.detector:
+        DETECTOR = args.detector
+    if DETECTOR == "raw" and not streammon_raw.available():
+        logging.warning("NumPy is not available, using the filters detector")
+        DETECTOR = "filters"
+    logging.info("Using detector " + DETECTOR)
+
+    # Define the FFMPEG_ARGS which will hold all of the arguments necessary to support the requested monitoring features
+    # {events_fd}, {grab_fd}, {video_fd} and {audio_fd} are filled in by analyze() when the pipes are created.
+    if DETECTOR == "raw":
+        FFMPEG_ARGS = streammon_raw.build_raw_ffmpeg_args(AUDIO_ONLY, FRAME_GRAB_INTERVAL, progress_period=PROGRESS_PERIOD,
+            frame_grab_from_analyzer=FRAME_GRAB_FROM_ANALYZER, frame_grab_width=FRAME_GRAB_WIDTH)
+    else:
+        FFMPEG_ARGS = build_ffmpeg_args(AUDIO_ONLY, BLACKFRAME_THRESHOLD, FREEZE_NOISE_THRESHOLD, FREEZETIME_SECONDS_ALLOWED,
+            SILENCE_THRESHOLD, SILENCE_DURATION, FRAME_GRAB_INTERVAL,
+            use_progress_channel=USE_PROGRESS_CHANNEL, progress_period=PROGRESS_PERIOD,
+            frame_grab_from_analyzer=FRAME_GRAB_FROM_ANALYZER, frame_grab_width=FRAME_GRAB_WIDTH, profile=args.profile)
+    # Decoder options for the profile, these go before the -i
+    FFMPEG_INPUT_ARGS = build_input_args(AUDIO_ONLY, args.profile, int(args.threads), int(args.filter_threads))
+    if int(args.threads) or int(args.filter_threads):
+        logging.info("Using ffmpeg threads " + args.threads + ", filter threads " + args.filter_threads)
+
+    # Keep the monitor and its ffmpegs (which inherit it) on the CPUs the supervisor gave us
+    if args.cpus:
+        try:
+            os.sched_setaffinity(0, [int(cpu) for cpu in args.cpus.split(",")])
+            logging.info("Using cpus " + args.cpus)
+        except (OSError, ValueError) as e:
+            logging.warning("Could not set CPU affinity to " + args.cpus + ": " + str(e))
 
-# Add max muxing queue size, output receive to null, and output messages to stdout
-FFMPEG_ARGS = FFMPEG_ARGS + "  -max_muxing_queue_size 9999 -f null -"
 
-#FFMPEG_ARGS = " -af silencedetect=noise="+str(SILENCE_THRESHOLD)+"dB:d="+str(SILENCE_DURATION)+"  -max_muxing_queue_size 9999 -f null -"
+    # Pre-parse the numeric thresholds once, so analyze() doesn't re-convert strings for every line
+    FRAME_GRAB_INTERVAL = int(FRAME_GRAB_INTERVAL)
+    BLACKFRAME_SECONDS_ALLOWED = float(BLACKFRAME_SECONDS_ALLOWED)
 
 
 def main():
@@ -399,6 +495,8 @@ def main():
     global alerts_hard_disabled
     global streamdown_alerts_hard_disabled
     global stream_down_in_progress
+    global stream_state
+    global frame_grab_timer
     
     alerts_hard_disabled = ALERTS_DISABLED
     streamdown_alerts_hard_disabled = STREAMDOWN_ALERTS_DISABLED
@@ -413,6 +511,19 @@ def main():
         alerts_disabled=0
         alerts_hard_disabled=0
 
+    start_alert_dispatcher()
+
+    # The black/freeze/silence/stale frame detection state for the stream (see streammon_detect)
+    stream_state = StreamState(stream, send_message, program_start_time,
+        audio_only=AUDIO_ONLY, blackframe_seconds_allowed=BLACKFRAME_SECONDS_ALLOWED,
+        freeze_seconds_allowed=FREEZETIME_SECONDS_ALLOWED, stale_frame_timeout=STALE_FRAME_TIMEOUT,
+        rampup_time=RAMPUP_TIME, blackframe_reset_time=BLACKFRAME_RESET_TIME, freeze_priority=FREEZE_PRIORITY,
+        send_restored_alerts=SEND_RESTORED_ALERTS, slow_speed_threshold=SLOW_SPEED_THRESHOLD)
+
+    # The frame grab thumbnail is updated from the same timer wheel, first thing once it's ready
+    frame_grab_timer = streammon_timers.Timer(frame_grab_due)
+    stream_state.wheel.schedule(frame_grab_timer, time.monotonic())
+
     # Command line overrides config file, otherwise use config values
     grace_period = int(args.stream_failure_grace_period) if args.stream_failure_grace_period is not None else int(STREAM_FAILURE_GRACE_PERIOD) if ENABLE_GRACEFUL_STREAM_FAILURE else 0
     retry_interval = int(args.stream_failure_retry_interval) if args.stream_failure_retry_interval is not None else int(STREAM_FAILURE_RETRY_INTERVAL)
@@ -426,7 +537,6 @@ def main():
     # Track whether we're in a grace period retry cycle
     grace_period_start = None
     retry_count = 0
-    connection_established = False  # Track if we ever had a good connection
 
     # Main connection loop with grace period support
     while True:
@@ -434,78 +544,81 @@ def main():
             logging.info("Attempting to analyze stream")
         else:
             logging.info(f"Attempting to analyze stream (retry attempt #{retry_count})")
-        
-        analyze_result = analyze(stream)
-        
-        if analyze_result:
-            # Stream connected successfully and ran until it died
-            logging.info("Stream analyzer completed normally")
-            
-            # If we were in a grace period and successfully reconnected, no alert needed
+
+        publish_status(streammon_status.STATE_STARTING)
+        started = time.monotonic()
+        connect(stream)
+
+        # analyze() only returns once the analyzer has died (or never got going).  A stream that ran
+        # for a while and then died starts a new grace period.
+        logging.info("Stream analyzer could not launch or died for " + stream)
+        if time.monotonic() - started > RAMPUP_TIME:
             if grace_period_start is not None:
-                elapsed = time.time() - grace_period_start
-                logging.info(f"Stream reconnected successfully after {elapsed:.1f} seconds ({retry_count} retries) - no alert sent")
-            
-            # Reset grace period tracking
+                logging.info(f"Stream reconnected after {retry_count} retries and ran for {time.monotonic() - started:.1f} seconds")
             grace_period_start = None
             retry_count = 0
-            connection_established = True
-            
-            # Stream was running and then died - this is expected, loop will retry
-            
+
+        # Start grace period timer on first failure (if grace period is configured)
+        if grace_period_start is None and grace_period > 0:
+            grace_period_start = time.monotonic()
+            retry_count = 0
+            logging.info(f"Starting grace period: will retry for {grace_period} seconds before alerting")
+
+        # Check if we're still within grace period
+        if grace_period > 0:
+            elapsed = time.monotonic() - grace_period_start
+
+            if elapsed < grace_period:
+                # Still within grace period - retry without alerting, backing off so that streams
+                # that went down together don't all come back at once
+                remaining = grace_period - elapsed
+                sleep_time = min(streammon_connect.backoff_delay(retry_count, retry_interval, RETRY_BACKOFF_MAX), remaining)
+                retry_count += 1
+
+                logging.info(f"Grace period: {remaining:.1f} seconds remaining, retrying in {sleep_time:.1f} seconds")
+                publish_status(streammon_status.STATE_RETRYING)
+                time.sleep(sleep_time)
+                continue  # Try again without alerting
+
+            # Grace period expired - send alert
+            logging.info(f"Grace period expired after {retry_count} retry attempts, sending alert")
+            if not stream_down_in_progress:
+                stream_down_in_progress = 1
+                if streamdown_alerts_hard_disabled:
+                    logging.info("Skipping alert, stream down alerts are hard-disabled by configuration.")
+                else:
+                    send_message(f"Stream failure for: {args.stream_uri} (after {retry_count} retry attempts)")
         else:
-            # Stream failed to connect or died immediately
-            logging.info("Stream analyzer could not launch or died for " + stream)
-            
-            # Start grace period timer on first failure (if grace period is configured)
-            if grace_period_start is None and grace_period > 0:
-                grace_period_start = time.time()
-                retry_count = 0
-                logging.info(f"Starting grace period: will retry for {grace_period} seconds before alerting")
-            
-            # Check if we're still within grace period
-            if grace_period > 0 and grace_period_start is not None:
-                elapsed = time.time() - grace_period_start
-                
-                if elapsed < grace_period:
-                    # Still within grace period - retry without alerting
-                    retry_count += 1
-                    remaining = grace_period - elapsed
-                    
-                    # Don't sleep longer than the remaining grace period
-                    sleep_time = min(retry_interval, remaining)
-                    
-                    logging.info(f"Grace period: {remaining:.1f} seconds remaining, retrying in {sleep_time} seconds")
-                    time.sleep(sleep_time)
-                    continue  # Try again without alerting
+            # No grace period configured
+            if not stream_down_in_progress:
+                stream_down_in_progress = 1
+                if streamdown_alerts_hard_disabled:
+                    logging.info("Skipping alert, stream down alerts are hard-disabled by configuration.")
                 else:
-                    # Grace period expired - send alert and reset
-                    logging.info(f"Grace period expired after {retry_count} retry attempts, sending alert")
-                    if not stream_down_in_progress:
-                        stream_down_in_progress = 1
-                        if streamdown_alerts_hard_disabled:
-                            logging.info("Skipping alert, stream down alerts are hard-disabled by configuration.")
-                        else:
-                            send_message(f"Stream failure for: {args.stream_uri} (after {retry_count} retry attempts)")
-                
-                # Reset grace period for next cycle
-                grace_period_start = None
-                retry_count = 0
-                # Now do the long sleep and exit
-                logging.info("Stream death. Retry connect in " + str(CHECK_UPNESS_TIME) + " seconds")
-                time.sleep(CHECK_UPNESS_TIME)
-                break
-            else:
-                # No grace period configured
-                if not stream_down_in_progress:
-                    stream_down_in_progress = 1
-                    if streamdown_alerts_hard_disabled:
-                        logging.info("Skipping alert, stream down alerts are hard-disabled by configuration.")
-                    else:
-                        send_message(f"Stream failure for: {args.stream_uri}")
-                logging.info("Stream death. Retry connect in " + str(CHECK_UPNESS_TIME) + " seconds")
-                time.sleep(CHECK_UPNESS_TIME)
-                break
+                    send_message(f"Stream failure for: {args.stream_uri}")
+
+        # Now do the long sleep and exit
+        logging.info("Stream death. Retry connect in " + str(CHECK_UPNESS_TIME) + " seconds")
+        publish_status(streammon_status.STATE_DOWN)
+        time.sleep(CHECK_UPNESS_TIME)
+        break
+
+
+# One attempt at the stream: waits for a connect slot, checks that the stream is reachable and runs the
+# analyzer until it dies.  The slot is held from the probe on, so the probes are capped along with the
+# ffmpegs.  An unreachable stream fails straight away without starting ffmpeg.
+def connect(stream):
+    if not connect_slots.acquire(CONNECT_SLOT_WAIT):
+        logging.warning("No connect slot free after " + str(CONNECT_SLOT_WAIT) + " seconds, connecting anyway")
+    try:
+        if PREFLIGHT_PROBE:
+            reachable, reason = streammon_connect.probe(stream)
+            if not reachable:
+                logging.info("Stream not reachable, not starting the analyzer: " + reason)
+                return
+        analyze(stream)
+    finally:
+        connect_slots.release()
 
 
 ################################################################################
@@ -516,33 +629,16 @@ def main():
 # This function deals with connecting to the Mongo database.
 # It returns the handle to the connected database if it is available
 # It exits the program if the database is not available (as we couldn't do anything without it)
+# The connection is made once and shared by everything in this process (see streammon_db)
 def get_database():
-    from pymongo import MongoClient
-    import pymongo
-
-    print ("get_database()\n")
-    
-    # Create a connection using MongoClient. You can import MongoClient or use pymongo.MongoClient
-    from pymongo import MongoClient
     from pymongo.errors import ConnectionFailure
 
-    client = MongoClient(str(MONGO_CONNECTION_STRING))
     try:
-        # The ping command is cheap and does not require auth.
-        client.admin.command('ping')
+        return streammon_db.get_database()
     except ConnectionFailure:
         print("MongoDB Server not available. Exiting")
         exit()
 
-    print ("MongoDB Server available\n")
-
-    # Print all the databases found    
-    # for db in client.list_databases():
-    #     print(db)
-
-    # Return the database handle
-    return client[database_name]
-
 
 # This function takes output of the ffmpeg process, assembles it, and puts it into the specified queue
 def process_line(std, q):    
@@ -628,16 +724,19 @@ def run_ffmpeg_command(ffcmd_grab):
 # Should be run every minute or so.
 # Note, if something goes wrong and the stream framegrab fails, the program exits (assumption is that the stream is down)
 def update_frame_grab():
-
-    dbname = get_database()
-    stream_images_collection = dbname[stream_images_collection_name]
+    global last_frame_grab_hash
 
     # If this is an audio stream, we will use a static image of an audio icon
     if (AUDIO_ONLY == 1):
 
         logging.info("Writing audio icon as stream image: ")
-        im = Image.open("audio_icon.jpg")
+        image_data = read_image_file("audio_icon.jpg")
     
+    # Use the latest thumbnail from the analyzer if we have one
+    elif latest_frame_grab is not None:
+        logging.info("Using frame grab from analyzer, " + str(round(time.time() - latest_frame_grab_time)) + "s old")
+        image_data = latest_frame_grab
+
     # Otherwise, we start a special instance of ffmpeg to grab a frame from the stream and write it as a temp jpg file
     else: 
         ffcmd_grab = "ffmpeg -ss 2 -i "+ stream +" -frames:v 1 -y -f image2 -t 5 \""+ stream_desc + ".jpg\""
@@ -654,100 +753,202 @@ def update_frame_grab():
         executor = concurrent.futures.ThreadPoolExecutor()
         future = executor.submit(run_ffmpeg_command, ffcmd_grab)
         
-        im = Image.open(stream_desc+".jpg")        
-    
-
-    # Now we read in the file, convert it to base64, and write it to the database
-    image_bytes = io.BytesIO()
-    im.save(image_bytes, format='JPEG')   
+        image_data = read_image_file(stream_desc+".jpg")
     
+    # Black or frozen streams keep producing the same frame, no need to write it again
+    image_hash = hashlib.sha1(image_data).hexdigest()
+    if image_hash == last_frame_grab_hash:
+        logging.info("Frame grab unchanged, not updating database")
+        return
+    last_frame_grab_hash = image_hash
+
+    # The jpeg goes into the database as it is (binary, no re-encoding)
     dateTimeObj = datetime.now()
     mytime = dateTimeObj.now().strftime("%Y-%m-%d %H:%M:%S")
 
     logging.info("Updating frame grab in database")
 
-    mydict = {'timestamp': mytime, 'stream': stream_desc, 'data': base64.b64encode(image_bytes.getvalue())}
+    mydict = {'timestamp': mytime, 'stream': stream_desc, 'data': image_data, 'hash': image_hash}
 
-    image_id = stream_images_collection.update_one(
+    # Thumbnails aren't urgent, they go out with the next write-behind flush
+    streammon_db.write_behind.update_one(
+        stream_images_collection_name,
         {'stream': stream_desc}, 
-        {'$set': mydict},
-        upsert=True
+        {'$set': mydict}
     )
 
     return    
 
 
+# Returns the contents of an image file, the audio icon is only read once
+def read_image_file(filename):
+    global audio_icon_data
 
-# Returns base64 encoded image data of the latest thumbnail without writing it to the database
-# Can be used to write an image to the stream_alerts collection in the database for logging/review purposes
-def return_frame_grab():
+    if filename == "audio_icon.jpg" and audio_icon_data is not None:
+        return audio_icon_data
+    with open(filename, 'rb') as f:
+        image_data = f.read()
+    if filename == "audio_icon.jpg":
+        audio_icon_data = image_data
+    return image_data
 
-    # ffcmd_grab = "ffmpeg -ss 2 -i "+ stream +" -frames:v 1 -y -f image2 -t 5 \""+ stream_desc + ".jpg\""
 
-    # logging.info("Running framegrab: " + ffcmd_grab)
-    # subprocess.call(ffcmd_grab, shell=True)
+# Returns the jpeg data of the latest thumbnail without writing it to the database, None if there isn't one
+# If frame (jpeg bytes from the analyzer) is given, that is used instead of the latest thumbnail
+def return_frame_grab(frame=None):
 
     if (AUDIO_ONLY == 1):
         logging.info("Monitoring an audio stream ")
-        im = Image.open("audio_icon.jpg")
+        return read_image_file("audio_icon.jpg")
+
+    elif frame is not None:
+        return frame
+
+    elif latest_frame_grab is not None:
+        return latest_frame_grab
     
     else: 
-        im = Image.open(stream_desc+".jpg")
-
-    image_bytes = io.BytesIO()
-    im.save(image_bytes, format='JPEG')
+        try:
+            return read_image_file(stream_desc+".jpg")
+        except OSError:
+            return None
 
-    # image = {
-    #     'data': image_bytes.getvalue()
-    # }
 
-    dateTimeObj = datetime.now()
-    mytime = dateTimeObj.now().strftime("%Y-%m-%d %H:%M:%S")
+# Stores the image for an alert and returns its id, for the stream_alerts document to refer to.
+# Alert images are stored by content hash, so an image that is already there (the audio icon,
+# the same black frame for the problem and the restored alert, ...) is only stored once.
+def store_alert_image(image_data):
+    image_hash = hashlib.sha1(image_data).hexdigest()
 
-    return base64.b64encode(image_bytes.getvalue())
+    dbname = get_database()
+    dbname[alert_images_collection_name].update_one(
+        {'_id': image_hash},
+        {'$setOnInsert': {'data': image_data, 'stream': stream_desc}},
+        upsert=True
+    )
+    return image_hash
     
 
 
+# Returns True when update_frame_grab() has something to work with.  When the thumbnails come from
+# the analyzer, that is not until it has produced its first frame.
+def frame_grab_ready():
+    if AUDIO_ONLY == 1 or not FRAME_GRAB_FROM_ANALYZER:
+        return True
+    return latest_frame_grab is not None
+
+
+# Frame grab timer (see main()), updates the thumbnail and sets itself for the next one
+def frame_grab_due(now):
+    if not frame_grab_ready():
+        # Try again in a second
+        stream_state.wheel.schedule(frame_grab_timer, now + 1)
+        return
+
+    logging.info("Updating frame grab")
+    stream_state.wheel.schedule(frame_grab_timer, now + FRAME_GRAB_INTERVAL)
+
+    # Call update_frame_grab asynchronously, the analyze thread doesn't wait for it
+    future = frame_grab_executor.submit(update_frame_grab)
+    future.add_done_callback(frame_grab_done)
+
+
+# Logs a thumbnail update that failed, nobody else looks at the future
+def frame_grab_done(future):
+    if future.exception() is not None:
+        logging.error("Frame grab update failed: " + str(future.exception()))
+
+
+# Reads the jpeg stream from the analyzer's frame grab output and keeps the most recent frame.
+def read_frame_grabs(output):
+    global latest_frame_grab
+    global latest_frame_grab_time
+
+    buffer = b""
+    while True:
+        data = output.read(65536)
+        if not data:
+            break
+        frame, buffer = split_jpeg_frames(buffer + data)
+        if frame is not None:
+            latest_frame_grab = frame
+            latest_frame_grab_time = time.time()
+    output.close()
+
+
+# The raw detector's ffmpeg arguments for a video stream.  An audio output for a stream without sound
+# stops ffmpeg, so ffprobe is asked whether there is any, once it has been able to tell us.  Until then
+# the audio output stays in.
+def raw_ffmpeg_args():
+    global stream_has_audio
+    if stream_has_audio is None:
+        stream_has_audio = streammon_raw.has_audio(os.path.join(os.path.dirname(FFMPEG), "ffprobe"), stream)
+        if stream_has_audio is not None:
+            logging.info("Stream has audio: " + str(stream_has_audio))
+    return streammon_raw.build_raw_ffmpeg_args(AUDIO_ONLY, FRAME_GRAB_INTERVAL, progress_period=PROGRESS_PERIOD,
+        frame_grab_from_analyzer=FRAME_GRAB_FROM_ANALYZER, frame_grab_width=FRAME_GRAB_WIDTH,
+        audio=stream_has_audio is not False)
+
+
 #####################################################################################
 # The big function that does the analysis of ffmpeg output (should probably be broken down a little)
 # This function runs FFMPEG continuously monitor the stream and monitor the output
 ####################################################################################
 def analyze(stream):
-    global blackframe_timer_running
-    global blackframe_last_seen_time
-    global blackframe_timer
-    global program_start_time
-    global freeze_frame_in_progress
-    global audio_silent_in_progress
     global last_probe_time
     global probe_running
-    global last_frame
-    global watching_stale_frames
-    global stale_frames_in_progress
-    global stale_frame_start_time
     global stream_down_in_progress
-    global last_framegrab_time
     global FRAME_GRAB_INTERVAL
+    global lines_analyzed
+    global raw_detector
 
-    global FREEZETIME_SECONDS_ALLOWED    
-    global SILENCE_DURATION
-
-    blackframe_alerted_latch = 0
+    stream_state.new_analyzer()
 
-    analyzeq = Queue()
+    analyzeq = Queue(maxsize=ANALYZE_QUEUE_SIZE)
+    # Set when we stop reading analyzeq, see put_line()
+    readers_stop = threading.Event()
     probeq = Queue()
 
     logging.info("Analyzing " + stream)    
+
+    # The events pipe carries ffmpeg's progress reports and the filter metadata (see USE_PROGRESS_CHANNEL)
+    events_pipe = None
+    ffmpeg_args = FFMPEG_ARGS
+    if DETECTOR == "raw" and not AUDIO_ONLY:
+        ffmpeg_args = raw_ffmpeg_args()
+    if "{events_fd}" in ffmpeg_args:
+        events_pipe = os.pipe()
+        ffmpeg_args = ffmpeg_args.replace("{events_fd}", str(events_pipe[1]))
+
+    # The frame grab pipe carries the jpeg thumbnails (see FRAME_GRAB_FROM_ANALYZER)
+    grab_pipe = None
+    if "{grab_fd}" in ffmpeg_args:
+        grab_pipe = os.pipe()
+        ffmpeg_args = ffmpeg_args.replace("{grab_fd}", str(grab_pipe[1]))
+
+    # The raw frames and PCM for the raw detector (see DETECTOR), its events go into the same queue
+    raw_readers = []
+    if DETECTOR == "raw":
+        raw_detector = streammon_raw.RawDetector(
+            lambda event, value, line: put_line(analyzeq, (event, value, line), event in DROPPABLE_EVENTS, queue_stats, readers_stop),
+            BLACKFRAME_THRESHOLD, FREEZE_NOISE_THRESHOLD, FREEZETIME_SECONDS_ALLOWED if not AUDIO_ONLY else "0",
+            SILENCE_THRESHOLD, SILENCE_DURATION)
+        for placeholder, reader in (("{video_fd}", raw_detector.read_video), ("{audio_fd}", raw_detector.read_audio)):
+            if placeholder in ffmpeg_args:
+                pipe = os.pipe()
+                ffmpeg_args = ffmpeg_args.replace(placeholder, str(pipe[1]))
+                raw_readers.append((pipe, reader))
     
     # Structure the FFMPEG command that will be run
     # -report argument generates huge log file, use only for serious debugging
     ffmpeg_command = (
         FFMPEG + 
         # " -report" + 
+        " " + FFMPEG_INPUT_ARGS +
         " -i " + 
         stream + 
         " " + 
-        FFMPEG_ARGS
+        ffmpeg_args
     )
 
     # Remove quotes from ffmpeg command
@@ -757,229 +958,227 @@ def analyze(stream):
     ffmpeg_command = ffmpeg_command.split()
     logging.info("ffmpeg command after split(): " + str(ffmpeg_command))
 
-    analyzeproc = launch_process_to_q(ffmpeg_command, analyzeq)
+    analyzeproc = launch_process_to_q(ffmpeg_command, analyzeq, events_pipe, grab_pipe, raw_readers, readers_stop)
     logging.info("Launched analyze process with pid " + str(analyzeproc.pid))
 
     # Read from the queue until the queue is empty and process has exited
-    start_time=time.time()
+    start_time=time.monotonic()
     last_probe_time = time.time() + RAMPUP_TIME
 
     # This loop continues as long as the ffmpeg process is running as expected
+    last_poll_time = start_time
+    last_queue_stats_time = start_time
+    last_queue_stats = dict(queue_stats)
+    now = start_time
     while (True):
 
-        # Make sure line is empty as a bytes object
+        # Make sure line is empty and there is no event in case the queue is empty
         line = ""
+        event = None
+        value = None
         
-        # Try to get a line from the queue. We don't block but we do wait a second in case it's not right there
+        # Try to get a line from the queue. We don't block but we do wait, up to a second or until the next
+        # detection deadline, in case it's not right there
+        # The reader threads have already worked out what kind of line it is, see enqueue_output()
         try:
-            line = analyzeq.get(timeout=1).decode('UTF-8')
-            # trim trailing newline
-            line = line.rstrip()
+            event, value, line = analyzeq.get(timeout=stream_state.wheel.timeout(now))
+            lines_analyzed += 1
 
         except KeyboardInterrupt:
             # Disable alerts
             logging.info("Alerts disabled for keyboard interrupt")
             alerts_disabled=1
             analyzeproc.kill()
+            readers_stop.set()
             return False
         except Empty:
-            logging.info("Queue empty")
+            logging.info("Queue empty", extra={"rate_key": "queue_empty"})
 
+        # One clock read per line is plenty
+        now = time.monotonic()
         
-        if "https @ " in line:
-            logging.info(line)
-
         # Suppress logging blackframe messages because super noisy                
-        elif (SUPPRESS_BLACKFRAME_LOGGING):
-            if (b'Parsed_blackframe' not in line):                
+        if (SUPPRESS_BLACKFRAME_LOGGING and event != EVENT_PROTOCOL):
+            if (event != EVENT_BLACKFRAME):
                 if (SUPPRESS_FFMPEG_LOGGING == 0):
                     logging.debug(line)        
 
-        '''
-        Possible error responses:
-        Server error: Failed to play stream
-        Input/output error
-        
-        Need a regex to match for video found!
-        Sample: Stream #0:0: Video: h264 (Baseline), yuv420p, 640x360 [SAR 1:1 DAR 16:9], 655 kb/s, 25 tbr, 1k tbn, 50 tbc
-        Should also look for audio
-        '''
-        
-        if ("Stream #0:0: Video" in line):
-            logging.info("Found stream " + stream)
-            logging.info(line)
-            #return True
-        if ("Stream #0:1: Video" in line):
-            logging.info("Found stream " + stream)
-            logging.info(line)
-            #return True
-
         # print (line)  # Uncomment for debugging ffmpeg problems
         
-        # See if it's time to update the frame grab thumbnail
-        if (time.time() - last_framegrab_time) > int(FRAME_GRAB_INTERVAL):
-            logging.info("Updating frame grab")
-            last_framegrab_time = time.time()
-
-            # Call update_frame_grab asynchronously
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(update_frame_grab)
-            
-    
-
-        # If we see an error check to see if it's after the ramp up time, otherwise we ignore it
-        if ( (time.time() - program_start_time) > RAMPUP_TIME ):
-
-            if ("lavfi.freezedetect.freeze_start" in line):                
-                # Suppress this alert if we also have a potential blackframe issue, which takes priority
-                if not blackframe_timer_running or FREEZE_PRIORITY:
-                    logging.info("FREEZEFRAME DURATION EXCEEDED " + FREEZETIME_SECONDS_ALLOWED + "sec")
-                    send_message ("FREEZEFRAME DURATION EXCEEDED" + FREEZETIME_SECONDS_ALLOWED + "sec")
-                    freeze_frame_in_progress = 1
-                else:
-                    logging.info("Suppressing freeze alert due to black screen")                
-        
-        
-            if ("silence_start" in line):
-                logging.info("SILENCE DURATION EXCEEDED")
-                send_message ("SILENCE DURATION EXCEEDED")
-                audio_silent_in_progress = 1
-
-
-            # Extract and analyze quantity of contiguous frames
-            # to determine if the stream is still giving us new data
-            # logging.info("line is " + line)
-            # Requires ffmpeg to log in debug level
-            p = re.compile(r'.*\[debug\] frame:(\d+).*')
-            if (p.match(line)):
-            #     print "Matched\n"
-                for match in p.finditer(line):
-                    frame = int(match.group(1))
-                    logging.info ("Got frame: " + str(frame))                    
-                    if (frame > last_frame):
-                        last_frame=frame
-                        watching_stale_frames = 0
-                        if (stale_frames_in_progress):
-                            logging.info("NO_NEW_FRAMES CONDITION ENDED")
-                            send_message("NO_NEW_FRAMES CONDITION ENDED")
-                            stale_frames_in_progress = 0
-                    else:
-                        if (watching_stale_frames == 0):
-                            stale_frame_start_time = time.time()
-                            watching_stale_frames = 1
-                        logging.info(time.time() - stale_frame_start_time)
-                        if ((time.time() - stale_frame_start_time > STALE_FRAME_TIMEOUT) and stale_frames_in_progress == 0):
-                            logging.info("NO_NEW_FRAMES DURATION EXCEEDED " + STALE_FRAME_TIMEOUT + "sec")
-                            send_message("NO_NEW_FRAMES DURATION EXCEEDED " + STALE_FRAME_TIMEOUT + "sec")
-                            stale_frames_in_progress = 1
-            
-            # The blackframe_timer times how long we have been getting black frames
-            # blackframe_timer 
-            # The blackframe_last_seen contains the time we last saw a blackframe
-            # BLACKFRAME_SECONDS_ALLOWED is the time we allow blackframes to continue before we alert
-
-
-            # If a blackframe is seen:            
-            p = re.compile(r'\[Parsed_blackframe_1.* frame:(\d+).* last_keyframe:(\d+)')
-            if (p.match(line)):
-                logging.info('blackframe seen')
-
-                # Reset the blackframe_last_seen timer                
-                blackframe_last_seen_time = time.time()
-
-                # If the blackframe_timer is (already) running
-                if (blackframe_timer_running):
-                    logging.info('blackframe_timer: ' + str(round(time.time() - blackframe_timer)))
-                    # Send an alert if it's more than n seconds                    
-                    if (time.time() - blackframe_timer) > float(BLACKFRAME_SECONDS_ALLOWED):
-                        # Send an alert if we haven't already
-                        if not blackframe_alerted_latch:
-                            logging.info("BLACKFRAME DURATION EXCEEDED " + BLACKFRAME_SECONDS_ALLOWED + "sec")
-                            send_message("BLACKFRAME DURATION EXCEEDED " + BLACKFRAME_SECONDS_ALLOWED + "sec")
-                            blackframe_alerted_latch = 1                        
-
-                # Else start the blackframe_timer
-                else:
-                    logging.info('Starting blackframe_timer')
-                    blackframe_timer_running = 1
-                    blackframe_timer = time.time()
-
-
-            # If the blackframe_last_seen timer is more than n seconds
-            temp_time = time.time() - blackframe_last_seen_time
-            if (temp_time > BLACKFRAME_RESET_TIME):
-
-                # Stop and reset the blackframe_timer
-                blackframe_timer_running = 0
-                blackframe_timer = time.time()
-                blackframe_alerted_latch = 0 
-
-            # Send a restored alert for black frame
-            if "black_end" in line and blackframe_alerted_latch and SEND_RESTORED_ALERTS:
-                send_message("Blackframe issue ended")
-                blackframe_timer_running=0
-
-            # Send a restored alert for frozen
-            if "freeze_end" in line and freeze_frame_in_progress and SEND_RESTORED_ALERTS:
-                send_message("Freezeframe issue ended")
-                freeze_frame_in_progress=0
-
-            # Send a restored alert for audio
-            if "silence_end" in line and audio_silent_in_progress and SEND_RESTORED_ALERTS:
-                send_message("Audio restored")
-                audio_silent_in_progress = 0
-
-        else:
-            # logging.info("Ignoring condition because RAMPUP_TIME not exceeded")
-            pass
-
-        # See if the analyze process has exited
-        if (analyzeproc.poll() != None):
-            logging.info("Analyze thread died")
-            # Print a dump of ffmpeg processes from ps
-            # print (subprocess.check_output("ps -ef | grep ffmpeg", shell=True))
-
-            return False
-        else:
-            # logging.info("Analyze thread still alive with pid " + str(analyzeproc.pid))
-            pass
+        # Logging and the black/freeze/silence/stale frame conditions, and the frame grab when it's due
+        # (see StreamState)
+        stream_state.handle_event(event, value, line, now)
+
+        # Report on the queue now and then if it has been under pressure
+        if (now - last_queue_stats_time) > QUEUE_STATS_LOG_INTERVAL:
+            last_queue_stats_time = now
+            if queue_stats != last_queue_stats:
+                log_queue_stats(analyzeq)
+                last_queue_stats = dict(queue_stats)
+
+        # See if the analyze process has exited (and let the supervisor know how we are doing).
+        # Polling costs a system call, so only do it when the queue has gone quiet or once a second
+        # while lines are streaming in.
+        if (line == "" or (now - last_poll_time) >= 1):
+            last_poll_time = now
+            # Connected (or not getting anywhere), let the next monitor have the connect slot
+            if connect_slots.held() and (now - start_time) > CONNECT_SLOT_HOLD:
+                connect_slots.release()
+            publish_status(streammon_status.STATE_RUNNING, analyzeq, analyzeproc)
+            if (analyzeproc.poll() != None):
+                logging.info("Analyze thread died")
+                log_queue_stats(analyzeq)
+                # Print a dump of ffmpeg processes from ps
+                # print (subprocess.check_output("ps -ef | grep ffmpeg", shell=True))
+
+                # Nothing takes lines off the queue from here on, don't leave the readers waiting for room
+                readers_stop.set()
+                return False
         
 
             
         
     
+# Tells the supervisor how the stream is doing, along with the monitor's metrics (see streammon_metrics)
+# q is the analyze queue and process the analyzer's ffmpeg while there are any
+def publish_status(state, q=None, process=None):
+    metrics = streammon_metrics.process_stats()
+    running = [process.pid] if process is not None and process.returncode is None else []
+    metrics.update({
+        "ffmpeg_cpu_seconds": streammon_metrics.children_cpu_seconds(running),
+        "lines": lines_analyzed,
+        "lines_per_sec": lines_rate.update(lines_analyzed),
+        "queue_high_water": queue_stats["high_water"],
+        "dropped": queue_stats["dropped"],
+        "blocked": queue_stats["blocked"],
+        "alert_latency": alert_latency.snapshot(),
+        "mongo_write": streammon_db.write_latency.snapshot(),
+    })
+    if q is not None:
+        metrics["queue_depth"] = q.qsize()
+    if raw_detector is not None:
+        metrics.update(raw_detector.stats())
+    status_publisher.publish(stream_desc, state, metrics=metrics, **stream_state.status())
+
+
 # Send given message to Apprise system
+# The alert is queued for the dispatcher thread (see dispatch_alerts()), so this returns right away
 def send_message(msg):
     logging.info ("alerts_disabled: " + str(alerts_disabled) + " alerts_hard_disabled: " + str(alerts_hard_disabled))
     if not alerts_disabled and not alerts_hard_disabled:
         logging.info ("INIT SENDING ALERT: ")
-        subj = stream_desc + ":"
-        logging.info (subj + " " + msg)
+        logging.info (stream_desc + ": " + msg)
+
+        # Hold on to the frame as it was when the problem was detected
+        try:
+            alert_queue.put_nowait((msg, time.time(), latest_frame_grab))
+        except Full:
+            logging.error("Alert queue is full, dropping alert: " + msg)
+
+    else:
+        logging.info("Alerts are hard-disabled, Skipping alert")
+
+
+# Starts the thread that delivers the alerts queued by send_message()
+def start_alert_dispatcher():
+    t = threading.Thread(target=dispatch_alerts, name="alert_dispatcher")
+    t.daemon = True
+    t.start()
+
 
+# Delivers queued alerts one at a time for as long as the monitor runs
+def dispatch_alerts():
+    while True:
+        msg, detected_time, frame = alert_queue.get()
+        try:
+            deliver_alert(msg, detected_time, frame)
+        # get_database() exits when Mongo is down, which would otherwise end this thread for good
+        except (Exception, SystemExit) as e:
+            logging.error("Failed to deliver alert '" + msg + "': " + str(e))
+        alert_queue.task_done()
+
+
+# Returns the recipients' Pushover keys: from the routing table if we have a streamId (and can read the
+# table), otherwise the ones we were started with
+def alert_recipients():
+    if args.stream_id:
+        keys = routing_table.recipients(args.stream_id)
+        if routing_table.error is not None:
+            logging.warning("Could not read the routing table " + routing_table.path + ": " + routing_table.error +
+                (", using the last one read" if keys is not None else ", using the recipients from the command line"))
+        if keys is not None:
+            return keys
+    return args.pushover or []
+
+
+# Returns the Apprise instance for the notifications, None if there are no recipients.  It's made
+# when the first alert goes out, Apprise loads all of its plugins on import, and made again when
+# the recipients change.
+def get_apprise():
+    global apobj
+    global apobj_keys
+    keys = alert_recipients()
+    if not keys:
+        return None
+    if apobj is None or keys != apobj_keys:
+        import apprise
+        apobj = apprise.Apprise()
+        for x in keys:
+            logging.info("Adding pushover info: " + x)
+            apobj.add('pover://' + x)
+        apobj_keys = keys
+    return apobj
+
+
+# Sends one alert through Apprise (with retries) and logs it to the database,
+# along with how long it took from detection to delivery
+def deliver_alert(msg, detected_time, frame):
+    global last_alert_sent_time
+
+    # Rate limit the notifications
+    wait = ALERT_MIN_INTERVAL - (time.time() - last_alert_sent_time)
+    if wait > 0:
+        time.sleep(wait)
+
+    subj = stream_desc + ":"
+    delivered = False
+    apobj = get_apprise()
+    if apobj is None or len(apobj) == 0:
+        logging.info("No notification recipients, not sending " + msg)
+    else:
         logging.info("Sending alert to pushover user ")        
+        for attempt in range(ALERT_RETRY_ATTEMPTS):
+            if apobj.notify(body=msg, title=subj):
+                delivered = True
+                break
+            retry_delay = ALERT_RETRY_DELAY * (2 ** attempt)
+            logging.warning("Notification failed (attempt " + str(attempt + 1) + "), retrying in " + str(retry_delay) + " seconds")
+            time.sleep(retry_delay)
+        if not delivered:
+            logging.error("Giving up on notification: " + msg)
+    last_alert_sent_time = time.time()
 
-        apobj.notify(
-            body=msg,
-            title=subj
-        )
-        
-        time.sleep (1)  # Wait a second here to ensure we don't send too many alerts too quickly
+    latency = last_alert_sent_time - detected_time
+    alert_latency.observe(latency)
+    logging.info(f"Alert '{msg}' handled {latency:.2f} seconds after detection")
 
-        logging.info ("Logging alert to database")
+    logging.info ("Logging alert to database")
 
-        # Insert this alert into the database 
-        dbname = get_database()
-        stream_alerts_collection = dbname[stream_alerts_collection_name]
+    # Insert this alert into the database 
+    dbname = get_database()
+    stream_alerts_collection = dbname[stream_alerts_collection_name]
 
-        dateTimeObj = datetime.now()
-        mytime = dateTimeObj.now().strftime("%Y-%m-%d %H:%M:%S")
+    mytime = datetime.fromtimestamp(detected_time).strftime("%Y-%m-%d %H:%M:%S")
 
-        mydict = {'timestamp': mytime, 'stream': stream_desc, 'alert': msg, 'image': return_frame_grab()}
+    image_data = return_frame_grab(frame)
+    write_start = time.monotonic()
+    image_id = store_alert_image(image_data) if image_data else None
 
-        stream_alerts_collection.insert_one(mydict)
+    mydict = {'timestamp': mytime, 'stream': stream_desc, 'alert': msg, 'image_id': image_id,
+        'delivered': delivered, 'latency': round(latency, 3)}
 
-    else:
-        logging.info("Alerts are hard-disabled, Skipping alert")
+    stream_alerts_collection.insert_one(mydict)
+    streammon_db.write_latency.observe(time.monotonic() - write_start)
 
 
 
@@ -998,23 +1197,60 @@ def convert2unicode(mydict):
 def live_analyze():
     pass
 
-def launch_process_to_q(command, q):
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)    
-    t1 = threading.Thread(target=enqueue_output, args=(process.stdout, q))
-    t2 = threading.Thread(target=enqueue_output, args=(process.stderr, q))
+# Launches the command and starts threads that put its stdout and stderr lines into the queue.
+# If events_pipe (a (read fd, write fd) tuple from os.pipe()) is given, the write end is handed
+# to the child and lines arriving on the read end go into the same queue.
+# If grab_pipe is given, the same goes for the frame grab thumbnails, see read_frame_grabs().
+# readers is a list of (pipe, function) for more pipes, each read by the function in a thread of its own.
+# stop is set once nothing takes lines off the queue any more, see put_line().
+def launch_process_to_q(command, q, events_pipe=None, grab_pipe=None, readers=(), stop=None):
+    pass_fds = ()
+    if events_pipe:
+        pass_fds = pass_fds + (events_pipe[1],)
+    if grab_pipe:
+        pass_fds = pass_fds + (grab_pipe[1],)
+    for pipe, reader in readers:
+        pass_fds = pass_fds + (pipe[1],)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds)    
+    t1 = threading.Thread(target=enqueue_output, args=(process.stdout, q, stop))
+    t2 = threading.Thread(target=enqueue_output, args=(process.stderr, q, stop))
+    t1.daemon = True
+    t2.daemon = True
     t1.start()
     t2.start()
+    if events_pipe:
+        # Only the child writes to the pipe, so we get EOF when ffmpeg exits
+        os.close(events_pipe[1])
+        t3 = threading.Thread(target=enqueue_output, args=(os.fdopen(events_pipe[0], 'rb'), q, stop))
+        t3.daemon = True
+        t3.start()
+    if grab_pipe:
+        os.close(grab_pipe[1])
+        t4 = threading.Thread(target=read_frame_grabs, args=(os.fdopen(grab_pipe[0], 'rb'),))
+        t4.daemon = True
+        t4.start()
+    for pipe, reader in readers:
+        os.close(pipe[1])
+        t = threading.Thread(target=reader, args=(os.fdopen(pipe[0], 'rb'),))
+        t.daemon = True
+        t.start()
     return process
 
-def enqueue_output(output, q):
+# Reads lines from one of the ffmpeg outputs, classifies them and puts (event, value, line) into the queue
+def enqueue_output(output, q, stop=None):
     
     for line in iter(output.readline, b''):
         # logging.info("enqueue_output() got:" + line)
-        q.put(line)
+        line = line.decode('UTF-8', errors='replace').rstrip()
+        queue_line(q, line, queue_stats, SUPPRESS_FFMPEG_LOGGING, stop=stop)
     output.close()
 
-logging.info("(re)starting...")
-
+def log_queue_stats(q):
+    logging.info("Analyze queue depth " + str(q.qsize()) + "/" + str(ANALYZE_QUEUE_SIZE) +
+        ", high water " + str(queue_stats["high_water"]) +
+        ", dropped " + str(queue_stats["dropped"]) +
+        ", blocked " + str(queue_stats["blocked"]))
 
 if __name__ == "__main__":
+    startup()
     main()
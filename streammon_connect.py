@@ -0,0 +1,154 @@
+'''
+streammon_connect.py
+Reconnecting to streams without a thundering herd.  When the network or an origin blips, every
+monitor on the box loses its stream at once, and without this they would all start a full ffmpeg
+decode again on the same schedule.
+
+- backoff_delay(): exponential backoff with jitter between retries, so the retries spread out
+- probe(): a cheap reachability check (TCP connect or HTTP HEAD, with a hard timeout) before an
+  analyzer is started, so an unreachable stream costs a socket rather than an ffmpeg
+- ConnectSlots: a host-wide cap on connection attempts in progress.  The supervisor creates one slot
+  file per attempt allowed in run/connect_slots (create_slots()), a monitor holds a flock on one of
+  them while it connects.  A lock goes away with the process holding it, so a monitor that dies
+  can't leak its slot.
+
+'''
+
+import fcntl
+import os
+import random
+import shutil
+import socket
+import time
+import urllib.parse
+
+import streammon_status
+
+SLOT_DIR = streammon_status.run_dir + "/connect_slots"
+
+# Seconds allowed for the reachability check
+PROBE_TIMEOUT = 5
+
+# Ports for the schemes we can check with a TCP connect when the URI doesn't give one
+DEFAULT_PORTS = {"http": 80, "https": 443, "rtmp": 1935, "rtmps": 443, "rtsp": 554, "rtsps": 322, "tcp": None}
+
+# How often a monitor waiting for a connect slot tries again
+SLOT_POLL_INTERVAL = 0.5
+
+
+# Seconds to wait before retry number attempt (from 0): base doubling each time up to cap, with
+# "equal jitter" (somewhere between half and all of it) so streams that failed together don't come
+# back together
+def backoff_delay(attempt, base, cap):
+    delay = min(cap, base * (2 ** min(attempt, 16)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# Returns (reachable, reason).  HTTP(S) gets a HEAD request, any response other than a server error or
+# "not found" means it's there.  RTMP, RTSP and TCP get a TCP connect.  Anything we can't check cheaply
+# (UDP, SRT, files) counts as reachable and is left to ffmpeg.
+def probe(uri, timeout=PROBE_TIMEOUT):
+    parts = urllib.parse.urlsplit(uri)
+    scheme = parts.scheme.lower()
+
+    if scheme in ("http", "https"):
+        # Slow to import, and most streams never need it
+        import urllib.error
+        import urllib.request
+        request = urllib.request.Request(uri, method="HEAD")
+        try:
+            with urllib.request.urlopen(request, timeout=timeout):
+                return True, "ok"
+        except urllib.error.HTTPError as e:
+            # Some servers don't do HEAD (405) or want credentials, they are still up
+            if e.code == 404 or e.code >= 500:
+                return False, "HTTP " + str(e.code)
+            return True, "HTTP " + str(e.code)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            return False, str(getattr(e, "reason", e))
+
+    if scheme in DEFAULT_PORTS:
+        try:
+            port = parts.port or DEFAULT_PORTS[scheme]
+        except ValueError:
+            port = None
+        if not parts.hostname or not port:
+            return True, "not checked"
+        try:
+            socket.create_connection((parts.hostname, port), timeout=timeout).close()
+            return True, "ok"
+        except OSError as e:
+            return False, str(e)
+
+    return True, "not checked"
+
+
+# Makes sure there are exactly count slot files, readable by owner (the monitors' user).
+# count 0 removes them all, which lifts the cap.
+def create_slots(count, owner=None, directory=SLOT_DIR):
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith("slot-") and not (name[5:].isdigit() and int(name[5:]) < count):
+            os.unlink(os.path.join(directory, name))
+    for number in range(count):
+        path = os.path.join(directory, "slot-" + str(number))
+        if not os.path.exists(path):
+            open(path, "w").close()
+            os.chmod(path, 0o644)
+        if owner:
+            try:
+                shutil.chown(path, user=owner)
+            except (OSError, LookupError) as e:
+                print ("Could not hand " + path + " to " + owner + ": " + str(e))
+
+
+class ConnectSlots:
+    '''
+    One monitor's use of the host-wide connect slots.  acquire() before connecting and release() once
+    connected (or given up).  Without any slot files (no supervisor, or the cap turned off) there is no
+    cap and acquire() returns straight away.
+    '''
+
+    def __init__(self, directory=SLOT_DIR):
+        self.directory = directory
+        self.fd = None
+
+    def held(self):
+        return self.fd is not None
+
+    # Waits up to wait seconds for a free slot.  Returns False if there was none, the caller goes
+    # ahead anyway rather than never connecting.
+    def acquire(self, wait):
+        if self.fd is not None:
+            return True
+        try:
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.startswith("slot-")]
+        except OSError:
+            return True
+        if not paths:
+            return True
+
+        deadline = time.monotonic() + wait
+        while True:
+            # Start somewhere different each time so the monitors don't all fight over slot-0
+            random.shuffle(paths)
+            for path in paths:
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    continue
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.fd = fd
+                    return True
+                except OSError:
+                    os.close(fd)
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(SLOT_POLL_INTERVAL * random.uniform(0.5, 1.5))
+
+    def release(self):
+        if self.fd is not None:
+            # Closing the file drops the lock
+            os.close(self.fd)
+            self.fd = None
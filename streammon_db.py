@@ -0,0 +1,120 @@
+'''
+streammon_db.py
+Database helpers shared by the supervisor and the monitors.
+Each process gets a single MongoClient (created on first use and reused by every caller), and writes
+that don't need to happen right away (thumbnails, reports) can be handed to a write-behind batcher.
+
+Note: a MongoClient must not be carried across a fork(), so don't call get_client() in a process
+that is going to fork monitors.
+
+'''
+
+import atexit
+import logging
+import threading
+import time
+
+import streammon_metrics
+from config import MONGO_CONNECTION_STRING, MONGO_DATABASE_NAME
+
+database_name = str(MONGO_DATABASE_NAME)
+# Remove quotes
+database_name = database_name.replace('"', '')
+
+# Seconds between write-behind flushes
+WRITE_BEHIND_INTERVAL = 5
+
+_client = None
+_client_lock = threading.Lock()
+
+# How long database writes take, reported in the status records (see streammon_metrics)
+write_latency = streammon_metrics.Histogram(streammon_metrics.MONGO_WRITE_BUCKETS)
+
+
+# Returns the process-wide MongoClient, creating it on first use.
+# If ping is set, a new client is checked with a ping first, and pymongo.errors.ConnectionFailure
+# is raised (and nothing is cached) if the server isn't available.
+def get_client(ping=True):
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from pymongo import MongoClient
+
+                client = MongoClient(str(MONGO_CONNECTION_STRING))
+                if ping:
+                    # The ping command is cheap and does not require auth.
+                    client.admin.command('ping')
+                _client = client
+    return _client
+
+
+# Returns the handle to the streammon database on the process-wide client
+def get_database(ping=True):
+    return get_client(ping)[database_name]
+
+
+class WriteBehind:
+    '''
+    Collects upserts that don't need to reach the database right away and writes them
+    with one unordered bulk_write per collection every interval seconds.
+    Writes with the same collection and filter replace each other until they are flushed,
+    so only the latest version of e.g. a thumbnail is ever written.
+    '''
+
+    def __init__(self, interval=WRITE_BEHIND_INTERVAL):
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # Queues an update_one(filter, update, upsert=True) on the named collection
+    def update_one(self, collection_name, filter, update):
+        key = (collection_name, tuple(sorted(filter.items())))
+        with self.lock:
+            self.pending[key] = (collection_name, filter, update)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="write_behind")
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.flush)
+
+    # Writes out everything that is pending, returns the number of writes
+    def flush(self):
+        from pymongo import UpdateOne
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+
+        by_collection = {}
+        for collection_name, filter, update in pending.values():
+            by_collection.setdefault(collection_name, []).append(UpdateOne(filter, update, upsert=True))
+
+        try:
+            dbname = get_database()
+            for collection_name, ops in by_collection.items():
+                write_start = time.monotonic()
+                dbname[collection_name].bulk_write(ops, ordered=False)
+                write_latency.observe(time.monotonic() - write_start)
+        except Exception:
+            # Put the writes back for the next flush, unless something newer came in meanwhile
+            with self.lock:
+                for key, value in pending.items():
+                    self.pending.setdefault(key, value)
+            raise
+        return len(pending)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error("Write-behind flush failed: " + str(e))
+
+
+# The write-behind batcher for this process
+write_behind = WriteBehind()
@@ -0,0 +1,637 @@
+'''
+streammon_detect.py
+Stream analysis shared by the monitor agent (sjmstreammonitor-withprobe.py) and the multi-stream
+engine (streammon_engine.py): building the ffmpeg analyze command, classifying the lines ffmpeg
+writes and queueing them for the analyzer, and the per-stream detection state that turns those
+lines into alerts.
+
+Nothing in here does any I/O of its own (other than resolve_stream_uri()), alerts go out through
+the send_message function each StreamState is given.
+
+'''
+
+import logging
+import re
+import threading
+import time
+from queue import Full
+
+import streammon_timers
+
+
+#################################################
+# ffmpeg output line classifier
+#################################################
+
+# Event types produced by classify_line()
+EVENT_FRAME = "frame"                   # Frame counter, value is the frame number
+EVENT_BLACKFRAME = "blackframe"         # A single black frame was seen
+EVENT_BLACK_END = "black_end"           # blackdetect reported the end of a black period
+EVENT_FREEZE_START = "freeze_start"
+EVENT_FREEZE_END = "freeze_end"
+EVENT_SILENCE_START = "silence_start"
+EVENT_SILENCE_END = "silence_end"
+EVENT_STREAM_INFO = "stream_info"       # Input stream description (e.g. "Stream #0:0: Video: h264 ...")
+EVENT_PROTOCOL = "protocol"             # Protocol chatter we like to see in the log (e.g. https)
+EVENT_ERROR = "error"                   # ffmpeg error/fatal level message
+EVENT_SPEED = "speed"                   # Processing speed relative to real time, value is a float (1.0 = real time)
+
+# Regexes used to pull a value out of a line once we already know what kind of line it is
+DEBUG_FRAME_RE = re.compile(r'\[debug\] frame:(\d+)')
+PROGRESS_FRAME_RE = re.compile(r'^frame=(\d+)')
+PROGRESS_SPEED_RE = re.compile(r'^speed=\s*([\d.]+)x')
+
+# Tokens are checked in order and the first hit wins, so the most frequent lines come first.
+# A plain substring check is several times cheaper than a regex search, so regexes are only
+# used for the value.  Each entry is (token, event, value regex, value type).
+# The progress ("frame=", "speed=") and metadata ("lavfi.") lines come from the events pipe,
+# the rest are what ffmpeg prints on stderr.
+LINE_TOKENS = (
+    ("frame=", EVENT_FRAME, PROGRESS_FRAME_RE, int),
+    ("speed=", EVENT_SPEED, PROGRESS_SPEED_RE, float),
+    ("lavfi.blackframe.pblack=", EVENT_BLACKFRAME, None, None),
+    ("[debug] frame:", EVENT_FRAME, DEBUG_FRAME_RE, int),
+    ("[Parsed_blackframe_1 ", EVENT_BLACKFRAME, None, None),
+    ("black_end", EVENT_BLACK_END, None, None),
+    ("freezedetect.freeze_start", EVENT_FREEZE_START, None, None),
+    ("freeze_end", EVENT_FREEZE_END, None, None),
+    ("silence_start", EVENT_SILENCE_START, None, None),
+    ("silence_end", EVENT_SILENCE_END, None, None),
+    ("Stream #0:0: Video", EVENT_STREAM_INFO, None, None),
+    ("Stream #0:1: Video", EVENT_STREAM_INFO, None, None),
+    ("https @ ", EVENT_PROTOCOL, None, None),
+    ("[error]", EVENT_ERROR, None, None),
+    ("[fatal]", EVENT_ERROR, None, None),
+)
+
+# Events that can be thrown away when the analyzer falls behind, because the next one makes them redundant.
+# Anything else is a condition change (or something we want in the log) and always gets through.
+DROPPABLE_EVENTS = (EVENT_FRAME, EVENT_SPEED, EVENT_BLACKFRAME, EVENT_PROTOCOL, None)
+
+
+# Returns a tuple of (event, value) for a line of ffmpeg output, or (None, None) if the line is
+# of no interest to the analyzer.  value is only set for EVENT_FRAME (the frame number) and
+# EVENT_SPEED (the speed as a float).
+def classify_line(line):
+    for token, event, value_re, value_type in LINE_TOKENS:
+        if token in line:
+            if value_re is None:
+                return event, None
+            match = value_re.search(line)
+            # e.g. "speed=N/A" or a stats line, keep looking
+            if match is not None:
+                return event, value_type(match.group(1))
+    return None, None
+
+
+#################################################
+# The analyze queue
+#################################################
+
+# Counters for a bounded analyze queue (see put_line()): the deepest it got, droppable lines dropped,
+# and lines that had to wait for room
+def new_queue_stats():
+    return {"high_water": 0, "dropped": 0, "blocked": 0}
+
+queue_stats_lock = threading.Lock()
+
+
+# Seconds between checks of the stop event while waiting for room in the analyze queue
+PUT_RETRY_INTERVAL = 0.5
+
+
+# Classifies a line of ffmpeg output and puts (event, value, line) into the analyze queue, followed by
+# extra if given.  Lines nothing would happen with (other than logging them) are left out if
+# skip_unclassified.  See put_line() for stop.
+def queue_line(q, line, stats, skip_unclassified=True, extra=(), stop=None):
+    event, value = classify_line(line)
+    if event is None and skip_unclassified:
+        return
+    put_line(q, (event, value, line) + extra, event in DROPPABLE_EVENTS, stats, stop)
+
+
+# Puts an item into the bounded analyze queue.  If the queue is full, droppable items are
+# discarded and everything else waits for room (which in turn makes ffmpeg wait on its pipe).
+# Once stop (a threading.Event) is set nobody is taking items off the queue any more, so the
+# item is given up on rather than waiting for ever.
+def put_line(q, item, droppable, stats, stop=None):
+    try:
+        q.put_nowait(item)
+    except Full:
+        if droppable:
+            with queue_stats_lock:
+                stats["dropped"] += 1
+            return
+        with queue_stats_lock:
+            stats["blocked"] += 1
+        if stop is None:
+            q.put(item)
+            return
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=PUT_RETRY_INTERVAL)
+                break
+            except Full:
+                pass
+        else:
+            return
+
+    depth = q.qsize()
+    if depth > stats["high_water"]:
+        with queue_stats_lock:
+            stats["high_water"] = max(depth, stats["high_water"])
+
+
+#################################################
+# Analysis profiles
+#################################################
+
+class AnalysisProfile:
+    '''
+    How much of the video the analyzer decodes and looks at.  The black and freeze filters don't
+    need full resolution or every frame, and running them on less is most of the CPU saved.
+    Thresholds that depend on the frame rate or resolution are adjusted to match.
+    '''
+
+    __slots__ = ("name", "input_args", "prefilter", "freeze_noise_offset", "min_stale_frame_timeout",
+        "min_blackframe_reset_time")
+
+    def __init__(self, name, input_args="", prefilter="", freeze_noise_offset=0, min_stale_frame_timeout=0,
+            min_blackframe_reset_time=0):
+        self.name = name
+        # Decoder options that go before -i (video only)
+        self.input_args = input_args
+        # Filters that go in front of the detection filters
+        self.prefilter = prefilter
+        # Added to the freeze noise threshold (dB).  Downscaling averages out the pixel noise that
+        # tells two frames of a static scene apart, so the threshold has to come down to match.
+        self.freeze_noise_offset = freeze_noise_offset
+        # With fewer frames, the gaps between frame counter updates and between black frames get longer
+        self.min_stale_frame_timeout = min_stale_frame_timeout
+        self.min_blackframe_reset_time = min_blackframe_reset_time
+
+
+PROFILE_FULL = "full"
+PROFILE_REDUCED = "reduced"
+PROFILE_KEYFRAME = "keyframe"
+
+# Width the reduced and keyframe profiles scale down to (smaller streams are left as they are)
+ANALYSIS_WIDTH = 480
+# Frame rate the reduced profile analyzes at
+ANALYSIS_FPS = 5
+
+ANALYSIS_SCALE = "scale=w=min(iw\\," + str(ANALYSIS_WIDTH) + "):h=-2:flags=fast_bilinear"
+
+# Audio only streams are downmixed to mono and resampled to this rate before silence detection,
+# which only looks at the level.  One conversion does both (and the null output's encode gets cheaper too).
+AUDIO_ANALYSIS_RATE = 8000
+AUDIO_ANALYSIS_FORMAT = "aformat=sample_fmts=s16:sample_rates=" + str(AUDIO_ANALYSIS_RATE) + ":channel_layouts=mono"
+
+ANALYSIS_PROFILES = {
+    # Every frame at full resolution
+    PROFILE_FULL: AnalysisProfile(PROFILE_FULL),
+    # Decimated to ANALYSIS_FPS before anything else, then scaled down.  Still decodes every frame.
+    PROFILE_REDUCED: AnalysisProfile(PROFILE_REDUCED, prefilter="fps=" + str(ANALYSIS_FPS) + "," + ANALYSIS_SCALE,
+        freeze_noise_offset=-5),
+    # Only the keyframes are decoded (typically one every 1-10 seconds), then scaled down.
+    # The cheapest by far, but conditions are noticed a keyframe interval later.
+    PROFILE_KEYFRAME: AnalysisProfile(PROFILE_KEYFRAME, input_args="-skip_frame:v nokey", prefilter=ANALYSIS_SCALE,
+        freeze_noise_offset=-5, min_stale_frame_timeout=30, min_blackframe_reset_time=15),
+}
+
+
+# Returns the AnalysisProfile for a profile name from stream_configs, the full profile if it's empty or unknown
+def get_profile(name, log=logging):
+    if not name:
+        return ANALYSIS_PROFILES[PROFILE_FULL]
+    profile = ANALYSIS_PROFILES.get(name)
+    if profile is None:
+        log.warning("Unknown analysis profile '" + str(name) + "', using " + PROFILE_FULL)
+        return ANALYSIS_PROFILES[PROFILE_FULL]
+    return profile
+
+
+#################################################
+# Detection settings
+#################################################
+
+# What every stream is monitored with.  The supervisor gives these to the monitor agents on their
+# command lines (see settings_args()) and the engine uses them as they are, so both see the same.
+BLACK_THRESHOLD = "32"
+BLACK_DURATION = "60"
+FREEZE_THRESHOLD = "-50"
+FREEZE_DURATION = "600"
+SILENCE_THRESHOLD = "-45"
+SILENCE_DURATION = "60"
+
+# ffmpeg thread budget for each stream: decoder threads (-threads) for video and audio only streams,
+# and filter graph threads (-filter_threads).  0 leaves it to ffmpeg, which starts threads for every
+# core in every ffmpeg, so a box full of streams ends up with far more threads than cores.
+FFMPEG_THREADS = 2
+FFMPEG_AUDIO_THREADS = 1
+FFMPEG_FILTER_THREADS = 1
+
+
+# Returns the number of decoder threads for a stream
+def ffmpeg_threads(audio_only):
+    return FFMPEG_AUDIO_THREADS if audio_only else FFMPEG_THREADS
+
+
+# Returns the monitor agent arguments for the settings above.  Audio only monitors only get the
+# silence settings, the black and freeze ones don't apply to them.
+def settings_args(audio_only):
+    args = []
+    if not audio_only:
+        args = ["--black_threshold", BLACK_THRESHOLD, "--black_duration", BLACK_DURATION,
+            "--freeze_threshold", FREEZE_THRESHOLD, "--freeze_duration", FREEZE_DURATION]
+    args = args + ["--silence_threshold", SILENCE_THRESHOLD, "--silence_duration", SILENCE_DURATION]
+    if ffmpeg_threads(audio_only):
+        args = args + ["--threads", str(ffmpeg_threads(audio_only))]
+    if FFMPEG_FILTER_THREADS:
+        args = args + ["--filter_threads", str(FFMPEG_FILTER_THREADS)]
+    return args
+
+
+#################################################
+# ffmpeg command
+#################################################
+
+# Returns the arguments that go before "-i <stream>": the profile's decoder options (see AnalysisProfile)
+# and the thread budget.  threads is the number of decoder threads and filter_threads the number of
+# threads for the filter graphs, 0 leaves either up to ffmpeg (which uses every core).
+def build_input_args(audio_only, profile=PROFILE_FULL, threads=0, filter_threads=0):
+    input_args = ""
+    if filter_threads:
+        input_args = input_args + " -filter_threads " + str(filter_threads)
+    if threads:
+        input_args = input_args + " -threads " + str(threads)
+    if audio_only:
+        # Leave the video (and subtitle and data) streams alone in the demuxer, so they are never decoded
+        input_args = input_args + " -vn -sn -dn"
+    else:
+        input_args = input_args + " " + get_profile(profile).input_args
+    return input_args.strip()
+
+
+# Returns the options that send ffmpeg's progress reports to the events pipe ({events_fd}) every
+# progress_period seconds, and keep everything else but warnings and errors off stderr
+def progress_args(progress_period=1):
+    return " -loglevel level+warning -nostats -stats_period " + str(progress_period) + " -progress pipe:{events_fd}"
+
+
+# Returns an output with a couple of scaled jpeg thumbnails per frame grab interval on the frame grab pipe ({grab_fd})
+def frame_grab_output(frame_grab_interval, frame_grab_width=640):
+    return (" -map 0:v:0 -vf fps=2/" + str(frame_grab_interval) + ",scale=" + str(frame_grab_width) + ":-2" +
+        " -c:v mjpeg -q:v 5 -f image2pipe pipe:{grab_fd}")
+
+
+# Builds the arguments that go after "ffmpeg -i <stream>" to support the requested monitoring features.
+# profile is the name of one of the ANALYSIS_PROFILES.
+# The returned string has {events_fd} and {grab_fd} placeholders for the pipes, which are filled in
+# once the pipes have been created (events pipe only with use_progress_channel, grab pipe only
+# for video streams with frame_grab_from_analyzer).
+def build_ffmpeg_args(audio_only, black_threshold, freeze_threshold, freeze_duration, silence_threshold,
+        silence_duration, frame_grab_interval, use_progress_channel=1, progress_period=1,
+        frame_grab_from_analyzer=1, frame_grab_width=640, profile=PROFILE_FULL, log=logging):
+
+    profile = get_profile(profile, log)
+    ffmpeg_args = ""
+
+    if use_progress_channel:
+        # Frame counters, speed and filter events come in on the events pipe, so stderr
+        # only needs to carry real problems.
+        ffmpeg_args = progress_args(progress_period)
+        metadata_print = "metadata=mode=print:direct=1:file=/dev/fd/{events_fd}"
+        ametadata_print = "ametadata=mode=print:direct=1:file=/dev/fd/{events_fd}"
+
+    if not audio_only:
+        # This section deals with adding Freezeframe and blackframe detection for video (aka non-audio_only)
+        if not use_progress_channel:
+            # Without the progress channel we depend on the "[debug] frame:N" lines for stale frame detection,
+            # which makes the logs (and the queue) much more noisy.
+            ffmpeg_args = " -loglevel repeat+level+debug"
+
+        # Add video filter argument
+        ffmpeg_args = ffmpeg_args + " -vf "
+
+        # Decimate and/or scale down before the detection filters (see ANALYSIS_PROFILES)
+        if profile.prefilter:
+            ffmpeg_args = ffmpeg_args + profile.prefilter + ","
+
+        # Add blackdetect video filter
+        ffmpeg_args = ffmpeg_args + "blackdetect=d=0:pix_th=0.10,blackframe=amount=98:threshold=" + str(black_threshold)
+
+        # Add freezedetect video filter
+        if int(freeze_duration) > 0:
+            log.info("Freezeframe alerting enabled")
+            freeze_noise = float(freeze_threshold) + profile.freeze_noise_offset
+            ffmpeg_args = ffmpeg_args + ",freezedetect=noise=" + format(freeze_noise, "g") + "dB:duration=" + str(freeze_duration)
+        else:
+            log.info("Freezeframe alerting disabled (duration was 0)")
+
+        # Print the metadata the filters above attach to frames onto the events pipe
+        if use_progress_channel:
+            ffmpeg_args = ffmpeg_args + "," + metadata_print
+
+    # Add audio silence monitoring (for both video and audio)
+    # Audio only streams output just the first audio stream, at low rate mono (see AUDIO_ANALYSIS_FORMAT)
+    if audio_only:
+        ffmpeg_args = ffmpeg_args + " -map 0:a:0 -vn -sn -dn -af " + AUDIO_ANALYSIS_FORMAT + ",silencedetect=noise="
+    else:
+        ffmpeg_args = ffmpeg_args + " -af silencedetect=noise="
+    ffmpeg_args = ffmpeg_args + str(silence_threshold) + "dB:d=" + str(silence_duration)
+    if use_progress_channel:
+        ffmpeg_args = ffmpeg_args + "," + ametadata_print
+
+    # Add max muxing queue size, output receive to null, and output messages to stdout
+    ffmpeg_args = ffmpeg_args + "  -max_muxing_queue_size 9999 -f null -"
+
+    # Add a second output with a couple of scaled jpeg thumbnails per frame grab interval on the frame grab pipe.
+    if not audio_only and frame_grab_from_analyzer:
+        ffmpeg_args = ffmpeg_args + frame_grab_output(frame_grab_interval, frame_grab_width)
+
+    return ffmpeg_args
+
+
+def resolve_stream_uri(uri, log=logging):
+    """
+    If the URI points to a .m3u playlist, fetch it and return the first
+    real stream URL found inside it.  Returns the original URI on any
+    failure or if the URI is not a .m3u file.
+    """
+    if not uri.lower().endswith('.m3u'):
+        return uri
+    log.info("URI ends with .m3u - fetching playlist to resolve real stream URL")
+    # Only needed here, and slow to import (http.client, email, ssl)
+    import urllib.request
+    try:
+        req = urllib.request.Request(uri, headers={'User-Agent': 'StreamMonitor/1.0'})
+        with urllib.request.urlopen(req, timeout=10) as response:
+            content = response.read().decode('utf-8', errors='ignore')
+        for line in content.splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                log.info(f"Resolved .m3u URI '{uri}' -> '{line}'")
+                return line
+        log.warning("No usable stream URL found in .m3u playlist; using original URI")
+    except Exception as e:
+        log.warning(f"Failed to fetch/parse .m3u playlist ({uri}): {e}; using original URI")
+    return uri
+
+
+# Looks for complete jpegs in data read from the frame grab pipe.
+# Returns (the last complete jpeg or None, the data left over for the next read).
+# Each mjpeg frame is a complete jpeg that ends with the EOI marker (ff d9), which can't occur
+# anywhere else in the encoded data.
+def split_jpeg_frames(buffer):
+    end = buffer.rfind(b'\xff\xd9')
+    if end == -1:
+        return None, buffer
+    # Only the last complete frame in the buffer is interesting
+    start = buffer.rfind(b'\xff\xd8', 0, end)
+    frame = None
+    if start != -1:
+        frame = buffer[start:end + 2]
+    return frame, buffer[end + 2:]
+
+
+#################################################
+# Per-stream detection state
+#################################################
+
+# Messages logged for (nearly) every frame are rate limited when the log goes through streammon_log
+RATE_LIMITED_FRAME = {"rate_key": "frame"}
+RATE_LIMITED_STALE = {"rate_key": "stale_frames"}
+RATE_LIMITED_BLACKFRAME = {"rate_key": "blackframe"}
+RATE_LIMITED_BLACKFRAME_TIMER = {"rate_key": "blackframe_timer"}
+
+# When the black frame deadline comes up, black frames less than this many seconds ago count as still
+# coming (the blackframe filter reports every frame, the raw detector once a second)
+BLACKFRAME_GAP = 1.5
+
+
+class StreamState:
+    '''
+    The detection state of one stream.  handle_event() is fed the classified ffmpeg output
+    and calls send_message() when a condition starts or ends.
+    The black frame and stale frame deadlines are timers in a TimerWheel (see streammon_timers) on the
+    monotonic clock, so they go off when due rather than when the next line happens to arrive.  Call
+    handle_event() with event None by wheel.timeout(now) at the latest when there is no output.
+    '''
+
+    __slots__ = ("stream", "send_message", "log", "audio_only", "blackframe_seconds_allowed",
+        "freeze_seconds_allowed", "stale_frame_timeout", "rampup_time", "blackframe_reset_time",
+        "freeze_priority", "send_restored_alerts", "slow_speed_threshold", "start_time", "active_time", "wheel",
+        "blackframe_timer_running", "blackframe_last_seen_time", "blackframe_timer", "blackframe_alerted_latch",
+        "blackframe_alert_timer", "blackframe_reset_timer", "freeze_frame_in_progress", "audio_silent_in_progress",
+        "last_frame", "stale_frame_start_time", "stale_frame_timer", "stale_frames_in_progress", "ffmpeg_speed",
+        "last_event", "last_event_time")
+
+    def __init__(self, stream, send_message, start_time, log=logging, audio_only=0, blackframe_seconds_allowed=5,
+            freeze_seconds_allowed="5", stale_frame_timeout=10, rampup_time=10, blackframe_reset_time=5,
+            freeze_priority=0, send_restored_alerts=1, slow_speed_threshold=0.9):
+        self.stream = stream
+        self.send_message = send_message
+        self.log = log
+        self.audio_only = audio_only
+        self.blackframe_seconds_allowed = float(blackframe_seconds_allowed)
+        self.freeze_seconds_allowed = str(freeze_seconds_allowed)
+        self.stale_frame_timeout = stale_frame_timeout
+        self.rampup_time = rampup_time
+        self.blackframe_reset_time = blackframe_reset_time
+        self.freeze_priority = freeze_priority
+        self.send_restored_alerts = send_restored_alerts
+        self.slow_speed_threshold = slow_speed_threshold
+        # Conditions are ignored until rampup_time after this (time.monotonic())
+        self.start_time = start_time
+        self.active_time = start_time + rampup_time
+
+        # The deadlines, along with any the caller adds (e.g. the frame grab)
+        self.wheel = streammon_timers.TimerWheel()
+        self.blackframe_alert_timer = streammon_timers.Timer(self.blackframe_duration_exceeded)
+        self.blackframe_reset_timer = streammon_timers.Timer(self.blackframe_reset)
+        self.stale_frame_timer = streammon_timers.Timer(self.stale_frame_timeout_exceeded)
+
+        self.blackframe_timer_running = 0
+        self.blackframe_last_seen_time = 0
+        self.blackframe_timer = float(0)
+        self.blackframe_alerted_latch = 0
+        self.freeze_frame_in_progress = 0
+        self.audio_silent_in_progress = 0
+        self.last_frame = 0
+        self.stale_frame_start_time = 0
+        self.stale_frames_in_progress = 0
+        self.ffmpeg_speed = 1.0
+        self.last_event = None
+        self.last_event_time = None
+
+    # Call when a new analyzer ffmpeg is started for the stream
+    def new_analyzer(self):
+        self.blackframe_alerted_latch = 0
+        self.blackframe_timer_running = 0
+        self.wheel.cancel(self.blackframe_alert_timer)
+        self.wheel.cancel(self.blackframe_reset_timer)
+        # The new ffmpeg gets stale_frame_timeout from its first frame report
+        self.wheel.cancel(self.stale_frame_timer)
+
+    # Returns the conditions currently in progress
+    def conditions(self):
+        conditions = []
+        if self.blackframe_alerted_latch:
+            conditions.append("black")
+        if self.freeze_frame_in_progress:
+            conditions.append("freeze")
+        if self.audio_silent_in_progress:
+            conditions.append("silence")
+        if self.stale_frames_in_progress:
+            conditions.append("no_new_frames")
+        return conditions
+
+    # Returns the fields for a status record (see streammon_status)
+    def status(self):
+        return {"frame": self.last_frame, "speed": self.ffmpeg_speed, "conditions": self.conditions(),
+            "last_event": self.last_event, "last_event_time": self.last_event_time}
+
+    def alert(self, msg):
+        self.last_event = msg
+        # Status records carry wall clock times
+        self.last_event_time = time.time()
+        self.send_message(msg)
+
+    def handle_event(self, event, value, line, now):
+        # Anything due goes off before the line is looked at, as it would have if the line had come later
+        if now >= self.wheel.next_due:
+            self.wheel.advance(now)
+
+        if event is None:
+            return
+
+        log = self.log
+
+        if event == EVENT_PROTOCOL:
+            log.info(line)
+
+        elif event == EVENT_STREAM_INFO:
+            log.info("Found stream " + self.stream)
+            log.info(line)
+
+        elif event == EVENT_ERROR:
+            log.info(line)
+
+        # Keep an eye on whether ffmpeg is keeping up with the stream
+        elif event == EVENT_SPEED:
+            if value < self.slow_speed_threshold and self.ffmpeg_speed >= self.slow_speed_threshold:
+                log.warning("ffmpeg is falling behind the stream, speed " + str(value) + "x")
+            elif value >= self.slow_speed_threshold and self.ffmpeg_speed < self.slow_speed_threshold:
+                log.info("ffmpeg caught up with the stream, speed " + str(value) + "x")
+            self.ffmpeg_speed = value
+
+        # If we see an error check to see if it's after the ramp up time, otherwise we ignore it
+        if now <= self.active_time:
+            return
+
+        if event == EVENT_FREEZE_START:
+            # Suppress this alert if we also have a potential blackframe issue, which takes priority
+            if not self.blackframe_timer_running or self.freeze_priority:
+                log.info("FREEZEFRAME DURATION EXCEEDED " + self.freeze_seconds_allowed + "sec")
+                self.alert("FREEZEFRAME DURATION EXCEEDED" + self.freeze_seconds_allowed + "sec")
+                self.freeze_frame_in_progress = 1
+            else:
+                log.info("Suppressing freeze alert due to black screen")
+
+        elif event == EVENT_SILENCE_START:
+            log.info("SILENCE DURATION EXCEEDED")
+            self.alert("SILENCE DURATION EXCEEDED")
+            self.audio_silent_in_progress = 1
+
+        # Extract and analyze quantity of contiguous frames
+        # to determine if the stream is still giving us new data
+        # Comes from the progress reports (or debug level stderr without the progress channel).
+        # Audio only streams have no video frames to count.
+        # Each new frame pushes the stale frame deadline back, which the wheel does lazily.
+        elif event == EVENT_FRAME and not self.audio_only:
+            frame = value
+            log.info("Got frame: %d", frame, extra=RATE_LIMITED_FRAME)
+            if (frame > self.last_frame):
+                self.last_frame = frame
+                self.stale_frame_start_time = now
+                self.wheel.schedule(self.stale_frame_timer, now + self.stale_frame_timeout)
+                if (self.stale_frames_in_progress):
+                    log.info("NO_NEW_FRAMES CONDITION ENDED")
+                    self.alert("NO_NEW_FRAMES CONDITION ENDED")
+                    self.stale_frames_in_progress = 0
+            else:
+                if not self.stale_frame_timer.pending() and not self.stale_frames_in_progress:
+                    self.stale_frame_start_time = now
+                    self.wheel.schedule(self.stale_frame_timer, now + self.stale_frame_timeout)
+                log.info("No new frames for %.1fs", now - self.stale_frame_start_time, extra=RATE_LIMITED_STALE)
+
+        # The blackframe_timer is when we started getting black frames
+        # The blackframe_last_seen contains the time we last saw a blackframe
+        # blackframe_seconds_allowed is the time we allow blackframes to continue before we alert,
+        # blackframe_reset_time the gap in them that ends the black period
+
+        # If a blackframe is seen:
+        elif event == EVENT_BLACKFRAME:
+            log.info('blackframe seen', extra=RATE_LIMITED_BLACKFRAME)
+
+            # Reset the blackframe_last_seen timer
+            self.blackframe_last_seen_time = now
+            self.wheel.schedule(self.blackframe_reset_timer, now + self.blackframe_reset_time)
+
+            # If the blackframe_timer is (already) running
+            if (self.blackframe_timer_running):
+                log.info('blackframe_timer: %d', round(now - self.blackframe_timer), extra=RATE_LIMITED_BLACKFRAME_TIMER)
+                # Black again after a pause that was still too short to reset the timer
+                if (now - self.blackframe_timer) > self.blackframe_seconds_allowed:
+                    self.blackframe_duration_exceeded(now)
+
+            # Else start the blackframe_timer
+            else:
+                log.info('Starting blackframe_timer')
+                self.blackframe_timer_running = 1
+                self.blackframe_timer = now
+                self.wheel.schedule(self.blackframe_alert_timer, now + self.blackframe_seconds_allowed)
+
+        # Send a restored alert for black frame
+        elif event == EVENT_BLACK_END and self.blackframe_alerted_latch and self.send_restored_alerts:
+            self.alert("Blackframe issue ended")
+            self.blackframe_timer_running = 0
+            self.wheel.cancel(self.blackframe_alert_timer)
+
+        # Send a restored alert for frozen
+        elif event == EVENT_FREEZE_END and self.freeze_frame_in_progress and self.send_restored_alerts:
+            self.alert("Freezeframe issue ended")
+            self.freeze_frame_in_progress = 0
+
+        # Send a restored alert for audio
+        elif event == EVENT_SILENCE_END and self.audio_silent_in_progress and self.send_restored_alerts:
+            self.alert("Audio restored")
+            self.audio_silent_in_progress = 0
+
+    # Black frames have kept coming (with no gap of blackframe_reset_time) for blackframe_seconds_allowed
+    def blackframe_duration_exceeded(self, now):
+        # Paused for now, the next black frame sends the alert if it comes before the reset
+        if now - self.blackframe_last_seen_time > BLACKFRAME_GAP:
+            return
+        # Send an alert if we haven't already
+        if not self.blackframe_alerted_latch:
+            self.log.info(f"BLACKFRAME DURATION EXCEEDED {self.blackframe_seconds_allowed:g}sec")
+            self.alert(f"BLACKFRAME DURATION EXCEEDED {self.blackframe_seconds_allowed:g}sec")
+            self.blackframe_alerted_latch = 1
+
+    # No black frame for blackframe_reset_time
+    def blackframe_reset(self, now):
+        # Stop and reset the blackframe_timer
+        self.blackframe_timer_running = 0
+        self.blackframe_timer = now
+        self.blackframe_alerted_latch = 0
+        self.wheel.cancel(self.blackframe_alert_timer)
+
+    # No new frame for stale_frame_timeout
+    def stale_frame_timeout_exceeded(self, now):
+        if now <= self.active_time or self.stale_frames_in_progress:
+            return
+        self.log.info("NO_NEW_FRAMES DURATION EXCEEDED " + str(self.stale_frame_timeout) + "sec")
+        self.alert("NO_NEW_FRAMES DURATION EXCEEDED " + str(self.stale_frame_timeout) + "sec")
+        self.stale_frames_in_progress = 1
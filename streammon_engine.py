@@ -0,0 +1,562 @@
+#!/usr/bin/python3
+'''
+streammon_engine.py
+Monitors every enabled stream from a single process.  This is the alternative to the supervisor
+starting one sjmstreammonitor-withprobe.py agent per stream (see ENGINE_MODE in streammon_supervisor.py).
+
+Each stream still has its own ffmpeg, but the output of all of them is read on one asyncio event loop
+and fed to a StreamState per stream (see streammon_detect), so Python, pymongo and Apprise are loaded
+once for the whole host instead of once per stream, and there are two threads in total (the alert
+dispatcher and the write-behind batcher) instead of several per stream.
+Each stream logs to its own log file like the agents do, so the stream reports keep working.
+
+The engine doesn't read stream_configs or users itself: it works from the copies the supervisor keeps
+in run/ (see streammon_status.STREAMS_FILE and streammon_routing), and only goes to the database
+to write thumbnails and alerts.
+
+'''
+
+import asyncio
+import hashlib
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueListener
+from queue import Queue, Full, SimpleQueue
+
+import streammon_db
+import streammon_status
+import streammon_log
+import streammon_metrics
+import streammon_timers
+import streammon_connect
+import streammon_routing
+from streammon_detect import StreamState, classify_line, build_ffmpeg_args, build_input_args, get_profile, resolve_stream_uri, split_jpeg_frames
+from streammon_detect import BLACK_THRESHOLD, BLACK_DURATION, FREEZE_THRESHOLD, FREEZE_DURATION, SILENCE_THRESHOLD, SILENCE_DURATION, FFMPEG_FILTER_THREADS, ffmpeg_threads
+from config import OPERATING_DIRECTORY, ALERTS_DISABLED, STREAMDOWN_ALERTS_DISABLED, STREAM_FAILURE_GRACE_PERIOD, STREAM_FAILURE_RETRY_INTERVAL, ENABLE_GRACEFUL_STREAM_FAILURE
+
+# Get the base directory from the config file
+base_dir = str(OPERATING_DIRECTORY)
+#remove quotes
+base_dir = base_dir.replace('"', '')
+
+stream_alerts_collection_name = "stream_alerts"
+stream_images_collection_name = "stream_images"
+alert_images_collection_name = "stream_alert_images"
+log_dir = base_dir + "/public_html/logs"
+
+FFMPEG = "/usr/bin/ffmpeg"
+
+# Seconds between looks at the supervisor's stream configs for streams to start or stop.  Unless
+# they have changed that's a stat of the file, and of the routing table.
+CONFIG_REFRESH_INTERVAL = 1
+
+# Seconds between thumbnail updates, audio streams only ever have the audio icon
+FRAME_GRAB_INTERVAL = 60
+AUDIO_FRAME_GRAB_INTERVAL = 3600
+# Width of the thumbnails ffmpeg produces (height follows the aspect ratio)
+FRAME_GRAB_WIDTH = 640
+
+# Ignore conditions for this long after a stream is started
+RAMPUP_TIME = 10
+# Send an alert if we don't get a new frame in this amount of time
+STALE_FRAME_TIMEOUT = 10
+# Amount of time to wait before we think blackframes are over
+BLACKFRAME_RESET_TIME = 5
+# Time to wait before trying a stream again after its grace period ran out
+CHECK_UPNESS_TIME = 3600
+# Retries within the grace period back off from STREAM_FAILURE_RETRY_INTERVAL up to this (see streammon_connect)
+RETRY_BACKOFF_MAX = 120
+
+# Alerts for all streams go through one dispatcher thread, see dispatch_alerts()
+ALERT_QUEUE_SIZE = 500
+ALERT_RETRY_ATTEMPTS = 3
+ALERT_RETRY_DELAY = 5
+ALERT_MIN_INTERVAL = 1
+
+# Alerts waiting for the dispatcher, as (StreamMonitor, message, time detected, frame grab) tuples
+alert_queue = Queue(maxsize=ALERT_QUEUE_SIZE)
+last_alert_sent_time = 0
+audio_icon_data = None
+# Log records from all the streams, written to their files by one QueueListener (see streammon_log)
+log_queue = SimpleQueue()
+log_router = streammon_log.LogRouter()
+# Status records for the supervisor, for all the streams (see streammon_status)
+status_publisher = streammon_status.StatusPublisher()
+# The supervisor's copies of stream_configs and of who gets the alerts for each stream
+stream_configs_file = streammon_status.JsonFile(streammon_status.STREAMS_FILE)
+routing_file = streammon_status.JsonFile(streammon_routing.ROUTING_FILE)
+# Why the stream configs or routing table couldn't be read, so it's only logged when it changes
+read_error = None
+
+
+class StreamMonitor:
+    '''
+    One monitored stream: its settings, notification recipients, detection state,
+    the running ffmpeg and the latest thumbnail.
+    '''
+
+    __slots__ = ("title", "uri", "audio_only", "profile", "stream_id", "pushover_keys", "apobj", "apobj_keys", "log", "log_handler",
+        "input_args", "ffmpeg_args", "state", "task", "latest_frame_grab", "last_frame_grab_hash", "frame_grab_timer",
+        "lines", "lines_rate", "alert_latency")
+
+    def __init__(self, config, pushover_keys):
+        self.title = config["title"]
+        self.uri = config["uri"]
+        self.audio_only = config["audio"] == "1"
+        # Analysis profile name from stream_configs, see streammon_detect.ANALYSIS_PROFILES
+        self.profile = config.get("profile") or ""
+        self.stream_id = config.get("streamId")
+        self.log, self.log_handler = open_stream_log(self.title)
+        self.pushover_keys = None
+        self.set_recipients(pushover_keys)
+        # Made by the dispatcher when the first alert goes out, see get_apprise()
+        self.apobj = None
+        self.apobj_keys = None
+
+        profile = get_profile(self.profile, self.log)
+        self.log.info("Using analysis profile " + profile.name)
+        self.input_args = build_input_args(int(self.audio_only), self.profile, ffmpeg_threads(self.audio_only),
+            FFMPEG_FILTER_THREADS)
+        self.ffmpeg_args = build_ffmpeg_args(int(self.audio_only), BLACK_THRESHOLD, FREEZE_THRESHOLD,
+            FREEZE_DURATION if not self.audio_only else "0", SILENCE_THRESHOLD, SILENCE_DURATION,
+            FRAME_GRAB_INTERVAL, frame_grab_width=FRAME_GRAB_WIDTH, profile=self.profile, log=self.log)
+        self.state = StreamState(self.uri, self.send_message, time.monotonic(), log=self.log,
+            audio_only=int(self.audio_only), blackframe_seconds_allowed=BLACK_DURATION,
+            freeze_seconds_allowed=FREEZE_DURATION,
+            stale_frame_timeout=max(STALE_FRAME_TIMEOUT, profile.min_stale_frame_timeout),
+            rampup_time=RAMPUP_TIME,
+            blackframe_reset_time=max(BLACKFRAME_RESET_TIME, profile.min_blackframe_reset_time))
+
+        self.task = None
+        self.latest_frame_grab = None
+        self.last_frame_grab_hash = None
+        # Updates the thumbnail, first thing once there is one (see tick())
+        self.frame_grab_timer = streammon_timers.Timer(self.frame_grab_due)
+        self.state.wheel.schedule(self.frame_grab_timer, time.monotonic())
+        # ffmpeg lines handled, and how long alerts took from detection to delivery (see streammon_metrics)
+        self.lines = 0
+        self.lines_rate = streammon_metrics.RateMeter()
+        self.alert_latency = streammon_metrics.Histogram(streammon_metrics.ALERT_LATENCY_BUCKETS)
+
+    # Replaces the notification recipients if they have changed.  The dispatcher picks them up with
+    # the next alert (see get_apprise()).
+    def set_recipients(self, pushover_keys):
+        if pushover_keys == self.pushover_keys:
+            return
+        if not pushover_keys:
+            self.log.info("WARNING: No Pushover key, will run without delivering alerts")
+        self.pushover_keys = pushover_keys
+
+    # Returns the Apprise instance for the current recipients, None if there aren't any.  Only called
+    # from the dispatcher thread.  Apprise is only imported once the first alert needs it, like the
+    # monitor agent does, and a new instance is made when the recipients change.
+    def get_apprise(self):
+        keys = self.pushover_keys
+        if not keys:
+            return None
+        if self.apobj is None or keys is not self.apobj_keys:
+            import apprise
+            apobj = apprise.Apprise()
+            for key in keys:
+                self.log.info("Adding pushover info: " + key)
+                apobj.add('pover://' + key)
+            self.apobj = apobj
+            self.apobj_keys = keys
+        return self.apobj
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        self.task.add_done_callback(self.task_done)
+
+    # run() only ends when it is cancelled, anything else is a bug that reconcile() cleans up after
+    def task_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Monitor for " + self.title + " stopped", exc_info=task.exception())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    # Queues an alert for the dispatcher thread, returns right away
+    def send_message(self, msg):
+        if ALERTS_DISABLED == 1:
+            self.log.info("Alerts are hard-disabled, Skipping alert")
+            return
+        self.log.info("INIT SENDING ALERT: ")
+        self.log.info(self.title + ": " + msg)
+        try:
+            alert_queue.put_nowait((self, msg, time.time(), self.latest_frame_grab))
+        except Full:
+            self.log.error("Alert queue is full, dropping alert: " + msg)
+
+    # Keeps the stream analyzed, with the same grace period handling as the monitor agent
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        grace_period = int(STREAM_FAILURE_GRACE_PERIOD) if ENABLE_GRACEFUL_STREAM_FAILURE else 0
+        retry_interval = int(STREAM_FAILURE_RETRY_INTERVAL)
+        grace_period_start = None
+        retry_count = 0
+
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    # Fetching a playlist blocks, keep it off the event loop
+                    uri = await loop.run_in_executor(None, resolve_stream_uri, self.uri, self.log)
+
+                    self.publish_status(streammon_status.STATE_STARTING)
+                    # An unreachable stream fails without starting ffmpeg (see streammon_connect)
+                    reachable, reason = await loop.run_in_executor(None, streammon_connect.probe, uri)
+                    if reachable:
+                        await self.analyze(uri)
+                    else:
+                        self.log.info("Stream not reachable, not starting the analyzer: " + reason)
+                except Exception:
+                    # Handled like the analyzer dying, so the stream is tried again rather than left unmonitored
+                    self.log.exception("Stream analyzer failed for " + self.uri)
+                self.log.info("Stream analyzer could not launch or died for " + self.uri)
+
+                # A stream that ran for a while and then died starts a new grace period
+                if time.monotonic() - started > RAMPUP_TIME:
+                    grace_period_start = None
+                    retry_count = 0
+                if grace_period_start is None:
+                    grace_period_start = time.monotonic()
+
+                elapsed = time.monotonic() - grace_period_start
+                if elapsed < grace_period:
+                    # Back off, with jitter, so streams that went down together don't all come back at once
+                    sleep_time = min(streammon_connect.backoff_delay(retry_count, retry_interval, RETRY_BACKOFF_MAX),
+                        grace_period - elapsed)
+                    retry_count += 1
+                    self.log.info(f"Grace period: {grace_period - elapsed:.1f} seconds remaining, retrying in {sleep_time:.1f} seconds")
+                    self.publish_status(streammon_status.STATE_RETRYING)
+                    await asyncio.sleep(sleep_time)
+                    continue
+
+                if STREAMDOWN_ALERTS_DISABLED:
+                    self.log.info("Skipping alert, stream down alerts are hard-disabled by configuration.")
+                elif retry_count:
+                    self.send_message(f"Stream failure for: {self.uri} (after {retry_count} retry attempts)")
+                else:
+                    self.send_message(f"Stream failure for: {self.uri}")
+
+                self.log.info("Stream death. Retry connect in " + str(CHECK_UPNESS_TIME) + " seconds")
+                self.publish_status(streammon_status.STATE_DOWN)
+                await asyncio.sleep(CHECK_UPNESS_TIME)
+                grace_period_start = None
+                retry_count = 0
+        finally:
+            log_router.remove(self.log.name, self.log_handler)
+
+    # Runs one ffmpeg on the stream and handles its output until it exits
+    async def analyze(self, uri):
+        self.state.new_analyzer()
+        self.log.info("Analyzing " + uri)
+
+        events_pipe = os.pipe()
+        ffmpeg_args = self.ffmpeg_args.replace("{events_fd}", str(events_pipe[1]))
+        grab_pipe = None
+        if "{grab_fd}" in ffmpeg_args:
+            grab_pipe = os.pipe()
+            ffmpeg_args = ffmpeg_args.replace("{grab_fd}", str(grab_pipe[1]))
+        pipes = [events_pipe] + ([grab_pipe] if grab_pipe else [])
+
+        command = (FFMPEG + " " + self.input_args + " -i " + uri + " " + ffmpeg_args).split()
+        self.log.info("Running ffmpeg command: " + str(command))
+
+        try:
+            process = await asyncio.create_subprocess_exec(*command, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, pass_fds=[pipe[1] for pipe in pipes])
+        except OSError as e:
+            self.log.error("Could not start ffmpeg: " + str(e))
+            for pipe in pipes:
+                os.close(pipe[0])
+                os.close(pipe[1])
+            return
+        # Only the child writes to the pipes, so we get EOF when ffmpeg exits
+        for pipe in pipes:
+            os.close(pipe[1])
+        self.log.info("Launched analyze process with pid " + str(process.pid))
+
+        readers = [self.read_lines(process.stderr), self.read_lines(await open_pipe_reader(events_pipe[0]))]
+        if grab_pipe:
+            readers.append(self.read_frame_grabs(await open_pipe_reader(grab_pipe[0])))
+        reading = asyncio.gather(*readers)
+        ticker = asyncio.ensure_future(self.tick())
+        try:
+            # tick() only finishes if it fails, which ends this analyzer too
+            done, _ = await asyncio.wait([reading, ticker], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+            await process.wait()
+        finally:
+            reading.cancel()
+            ticker.cancel()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        self.log.info("Analyze thread died")
+
+    # Classifies the lines from one of ffmpeg's outputs and feeds them to the detection state
+    async def read_lines(self, reader):
+        async for line in reader:
+            line = line.decode('UTF-8', errors='replace').rstrip()
+            event, value = classify_line(line)
+            self.lines += 1
+            if event is not None:
+                self.state.handle_event(event, value, line, time.monotonic())
+
+    # Keeps the most recent jpeg from ffmpeg's frame grab output
+    async def read_frame_grabs(self, reader):
+        buffer = b""
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            frame, buffer = split_jpeg_frames(buffer + data)
+            if frame is not None:
+                self.latest_frame_grab = frame
+
+    # Fires the detection deadlines and the frame grab when they are due, even while ffmpeg is quiet,
+    # and once a second tells the supervisor how the stream is doing
+    async def tick(self):
+        last_publish_time = 0
+        while True:
+            await asyncio.sleep(self.state.wheel.timeout(time.monotonic()))
+            now = time.monotonic()
+            self.state.handle_event(None, None, "", now)
+            if now - last_publish_time >= 1:
+                last_publish_time = now
+                self.publish_status(streammon_status.STATE_RUNNING)
+
+    # Frame grab timer, updates the thumbnail and sets itself for the next one
+    def frame_grab_due(self, now):
+        if not self.audio_only and self.latest_frame_grab is None:
+            # Try again in a second
+            self.state.wheel.schedule(self.frame_grab_timer, now + 1)
+            return
+        interval = AUDIO_FRAME_GRAB_INTERVAL if self.audio_only else FRAME_GRAB_INTERVAL
+        self.state.wheel.schedule(self.frame_grab_timer, now + interval)
+        self.update_frame_grab()
+
+    # Tells the supervisor how the stream is doing.  CPU, memory and database writes are the engine's
+    # as a whole, the same for every stream.
+    def publish_status(self, state):
+        metrics = streammon_metrics.process_stats()
+        metrics.update({
+            "lines": self.lines,
+            "lines_per_sec": self.lines_rate.update(self.lines),
+            "alert_latency": self.alert_latency.snapshot(),
+            "mongo_write": streammon_db.write_latency.snapshot(),
+        })
+        status_publisher.publish(self.title, state, metrics=metrics, **self.state.status())
+
+    # Queues the thumbnail for the stream_images collection (for the preview) if it has changed
+    def update_frame_grab(self):
+        image_data = self.alert_image(None)
+        image_hash = hashlib.sha1(image_data).hexdigest()
+        if image_hash == self.last_frame_grab_hash:
+            self.log.info("Frame grab unchanged, not updating database")
+            return
+        self.last_frame_grab_hash = image_hash
+
+        self.log.info("Updating frame grab in database")
+        mytime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        mydict = {'timestamp': mytime, 'stream': self.title, 'data': image_data, 'hash': image_hash}
+        streammon_db.write_behind.update_one(stream_images_collection_name, {'stream': self.title}, {'$set': mydict})
+
+    # Returns the jpeg to go with an alert (or thumbnail update), None if there isn't one yet
+    def alert_image(self, frame):
+        if self.audio_only:
+            return read_audio_icon()
+        if frame is not None:
+            return frame
+        return self.latest_frame_grab
+
+
+# Opens (and empties) the stream's log file, returns the stream's logger and its file handler
+def open_stream_log(title):
+    log = logging.getLogger("stream." + title)
+    log.setLevel(logging.DEBUG)
+    # The root logger goes to the console, this only goes to the stream's file
+    log.propagate = False
+    if not log.handlers:
+        log.addHandler(streammon_log.queue_handler(log_queue))
+    handler = streammon_log.file_handler(log_dir + "/" + title + ".log")
+    log_router.add(log.name, handler)
+    return log, handler
+
+
+def read_audio_icon():
+    global audio_icon_data
+
+    if audio_icon_data is None:
+        with open(base_dir + "/audio_icon.jpg", 'rb') as f:
+            audio_icon_data = f.read()
+    return audio_icon_data
+
+
+# Wraps the read end of a pipe in a StreamReader on the running event loop
+async def open_pipe_reader(fd):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+    return reader
+
+
+# Starts monitors for newly enabled streams, stops the ones for disabled or removed streams,
+# and restarts the ones whose uri or type has changed.  Works from the supervisor's copy of the stream
+# configs, until there is one nothing is started.
+def reconcile(monitors):
+    global read_error
+
+    configs = stream_configs_file.read()
+    routing = routing_file.read()
+    error = stream_configs_file.error or routing_file.error
+    if error != read_error:
+        read_error = error
+        if error:
+            logging.warning("Could not read the supervisor's stream configs or routing table: " + error)
+    if configs is None:
+        return
+
+    wanted = {}
+    for config in configs:
+        # Only docs with NECESSARY & VALID INFO (i.e. a stream uri, a title, etc.)
+        if len(config["title"]) >= 1 and len(config["uri"]) >= 4 and config["enabled"] == "1":
+            wanted[config["title"]] = config
+
+    for title, monitor in list(monitors.items()):
+        config = wanted.get(title)
+        if (config is None or config["uri"] != monitor.uri or (config["audio"] == "1") != monitor.audio_only
+                or (config.get("profile") or "") != monitor.profile):
+            logging.info("Stopping " + title)
+            monitor.stop()
+            del monitors[title]
+
+    for title, config in wanted.items():
+        if title in monitors and monitors[title].task.done():
+            # Stopped by an error (see StreamMonitor.task_done), start it again
+            logging.warning("Restarting " + title)
+            del monitors[title]
+        # No routing table yet means no recipients yet, they are set once it turns up
+        keys = streammon_routing.lookup(routing, config.get("streamId")) if routing else []
+        if title in monitors:
+            monitors[title].set_recipients(keys)
+        else:
+            logging.info("Starting " + title)
+            monitors[title] = StreamMonitor(config, keys)
+            monitors[title].start()
+
+
+# Delivers queued alerts one at a time for as long as the engine runs
+def dispatch_alerts():
+    while True:
+        monitor, msg, detected_time, frame = alert_queue.get()
+        try:
+            deliver_alert(monitor, msg, detected_time, frame)
+        except Exception as e:
+            monitor.log.error("Failed to deliver alert '" + msg + "': " + str(e))
+        alert_queue.task_done()
+
+
+# Sends one alert through Apprise (with retries) and logs it to the database,
+# along with how long it took from detection to delivery
+def deliver_alert(monitor, msg, detected_time, frame):
+    global last_alert_sent_time
+
+    # Rate limit the notifications
+    wait = ALERT_MIN_INTERVAL - (time.time() - last_alert_sent_time)
+    if wait > 0:
+        time.sleep(wait)
+
+    apobj = monitor.get_apprise()
+    delivered = False
+    if apobj is None or len(apobj) == 0:
+        monitor.log.info("No notification recipients, not sending " + msg)
+    else:
+        monitor.log.info("Sending alert to pushover user ")
+        for attempt in range(ALERT_RETRY_ATTEMPTS):
+            if apobj.notify(body=msg, title=monitor.title + ":"):
+                delivered = True
+                break
+            retry_delay = ALERT_RETRY_DELAY * (2 ** attempt)
+            monitor.log.warning("Notification failed (attempt " + str(attempt + 1) + "), retrying in " + str(retry_delay) + " seconds")
+            time.sleep(retry_delay)
+        if not delivered:
+            monitor.log.error("Giving up on notification: " + msg)
+    last_alert_sent_time = time.time()
+
+    latency = last_alert_sent_time - detected_time
+    monitor.alert_latency.observe(latency)
+    monitor.log.info(f"Alert '{msg}' handled {latency:.2f} seconds after detection")
+
+    dbname = streammon_db.get_database()
+
+    # Alert images are stored by content hash, see store_alert_image() in the monitor agent
+    image_data = monitor.alert_image(frame)
+    write_start = time.monotonic()
+    image_id = None
+    if image_data:
+        image_id = hashlib.sha1(image_data).hexdigest()
+        dbname[alert_images_collection_name].update_one(
+            {'_id': image_id},
+            {'$setOnInsert': {'data': image_data, 'stream': monitor.title}},
+            upsert=True
+        )
+
+    mytime = datetime.fromtimestamp(detected_time).strftime("%Y-%m-%d %H:%M:%S")
+    mydict = {'timestamp': mytime, 'stream': monitor.title, 'alert': msg, 'image_id': image_id,
+        'delivered': delivered, 'latency': round(latency, 3)}
+    dbname[stream_alerts_collection_name].insert_one(mydict)
+    streammon_db.write_latency.observe(time.monotonic() - write_start)
+
+
+async def run_engine():
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    monitors = {}
+    while not stopping.is_set():
+        try:
+            reconcile(monitors)
+        except Exception as e:
+            logging.error("Could not check stream configs: " + str(e))
+        try:
+            await asyncio.wait_for(stopping.wait(), CONFIG_REFRESH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    logging.info("Shutdown signal received, stopping " + str(len(monitors)) + " streams")
+    for monitor in monitors.values():
+        monitor.stop()
+    await asyncio.gather(*(monitor.task for monitor in monitors.values()), return_exceptions=True)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+    if ALERTS_DISABLED == 1:
+        logging.info("Alerts are hard-disabled by configuration.")
+
+    t = threading.Thread(target=dispatch_alerts, name="alert_dispatcher")
+    t.daemon = True
+    t.start()
+
+    listener = QueueListener(log_queue, log_router)
+    listener.start()
+    try:
+        asyncio.run(run_engine())
+    finally:
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+'''
+streammon_log.py
+Logging for the monitors and the engine.  Records are put on a queue by the thread that logs them,
+and a QueueListener thread does the formatting and the file writes, so detection never waits on
+the disk.  The per-stream log files are rotated when they get big, and high-frequency messages
+(frame counters, black frames, ...) can be rate limited per message key.
+
+To rate limit a message, log it with extra={"rate_key": <key>}.  At most one message per key gets
+through every RATE_LIMIT_INTERVAL seconds, and it says how many were left out since the last one.
+
+'''
+
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Size a stream log can reach before it is rotated, and how many old ones are kept
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 2
+
+# Seconds between messages with the same rate_key
+RATE_LIMIT_INTERVAL = 10
+
+LOG_FORMAT = '%(asctime)s %(message)s'
+LOG_DATE_FORMAT = '%H:%M:%S'
+
+
+class RateLimitFilter(logging.Filter):
+    '''Lets through at most one record per rate_key every interval seconds, records without one all pass.'''
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        # rate_key: (time of the last record let through, records dropped since)
+        self.last = {}
+
+    def filter(self, record):
+        key = getattr(record, "rate_key", None)
+        if key is None:
+            return True
+        last_time, suppressed = self.last.get(key, (0, 0))
+        if record.created - last_time < self.interval:
+            self.last[key] = (last_time, suppressed + 1)
+            return False
+        self.last[key] = (record.created, 0)
+        if suppressed:
+            record.msg = str(record.msg) + " (" + str(suppressed) + " similar messages suppressed)"
+        return True
+
+
+class LogRouter(logging.Handler):
+    '''
+    Hands each record to the handler added for its logger's name, so one QueueListener can write
+    the logs of many streams (see streammon_engine).
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+
+    # Routes the named logger to handler, closing whatever it was routed to before
+    def add(self, name, handler):
+        old = self.routes.get(name)
+        self.routes[name] = handler
+        if old is not None:
+            old.close()
+
+    # Stops routing the named logger, if it is still routed to handler
+    def remove(self, name, handler):
+        if self.routes.get(name) is handler:
+            del self.routes[name]
+            handler.close()
+
+    def emit(self, record):
+        handler = self.routes.get(record.name)
+        if handler is not None:
+            handler.handle(record)
+
+
+# Returns a rotating handler for a stream's log file, which is emptied first
+def file_handler(filename):
+    with open(filename, 'w'):
+        pass
+    handler = RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    return handler
+
+
+# Returns a handler that puts records (that get past the rate limit) on log_queue
+def queue_handler(log_queue):
+    handler = QueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter())
+    return handler
+
+
+# Sends everything logged in this process to filename (and the console), through a queue.
+# Returns the QueueListener, which is stopped (flushing what is left) at exit.
+def start_logging(filename, console=True, level=logging.DEBUG):
+    handlers = [file_handler(filename)]
+    if console:
+        console_handler = logging.StreamHandler()
+        # set a format which is simple for console use
+        console_handler.setFormatter(logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s'))
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger('')
+    root.setLevel(level)
+    root.addHandler(queue_handler(log_queue))
+
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
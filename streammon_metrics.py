@@ -0,0 +1,258 @@
+'''
+streammon_metrics.py
+Performance telemetry for the monitors and the supervisor.
+
+The monitors (and the engine) keep their counters and histograms in memory and send them to the
+supervisor in their status records (see streammon_status), so nothing extra is listening in each
+monitor.  The supervisor serves everything from all the monitors, plus its own numbers, on a local
+HTTP endpoint: /metrics in the Prometheus text format and /status as JSON.
+
+'''
+
+import json
+import os
+import resource
+import threading
+import time
+from bisect import bisect_left
+
+# Bucket upper bounds in seconds
+ALERT_LATENCY_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120)
+MONGO_WRITE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+LOOP_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# A monitor is considered up while its last status record is younger than this
+STATUS_MAX_AGE = 10
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+class Histogram:
+    '''Counts observations into buckets by upper bound, like a Prometheus histogram.'''
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # One count per bucket plus one for everything above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Returns the histogram as a dict that can go in a status record
+    def snapshot(self):
+        return {"le": list(self.buckets), "counts": list(self.counts), "sum": round(self.sum, 6), "count": self.count}
+
+
+class RateMeter:
+    '''Turns a running count into a per-second rate, measured over at least interval seconds.'''
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.last_count = 0
+        self.last_time = time.monotonic()
+        self.rate = 0.0
+
+    # Returns the rate, updated if interval seconds have passed since the last update
+    def update(self, count):
+        now = time.monotonic()
+        elapsed = now - self.last_time
+        if elapsed >= self.interval:
+            self.rate = (count - self.last_count) / elapsed
+            self.last_count = count
+            self.last_time = now
+        return round(self.rate, 1)
+
+
+# Returns the CPU seconds used so far and the resident memory of this process
+def process_stats():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = {"cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3)}
+    try:
+        with open("/proc/self/statm") as f:
+            stats["rss_bytes"] = int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # No /proc, ru_maxrss (peak, in kB on Linux) is the next best thing
+        stats["rss_bytes"] = usage.ru_maxrss * 1024
+    return stats
+
+
+# Returns the CPU seconds used so far by a running process, None if it has gone
+def proc_cpu_seconds(pid):
+    try:
+        with open("/proc/" + str(pid) + "/stat") as f:
+            # The command (field 2) is in brackets and may have spaces in it, utime and stime are fields 14 and 15
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# Returns the CPU seconds used so far by this process's children: the ones that have exited and been
+# waited for, plus the running ones in pids (e.g. the analyzer's ffmpeg, which does nearly all the work)
+def children_cpu_seconds(pids=()):
+    # Read before the running ones, so one that exits in between is counted once at most
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    total = usage.ru_utime + usage.ru_stime
+    for pid in pids:
+        total += proc_cpu_seconds(pid) or 0
+    return round(total, 3)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# Adds the lines for one histogram snapshot to lines (cumulative buckets, as Prometheus wants them)
+def format_histogram(lines, name, labels, snapshot):
+    cumulative = 0
+    for bound, count in zip(snapshot["le"], snapshot["counts"]):
+        cumulative += count
+        lines.append(name + '_bucket{' + labels + ',le="' + format(bound, "g") + '"} ' + str(cumulative))
+    lines.append(name + '_bucket{' + labels + ',le="+Inf"} ' + str(snapshot["count"]))
+    lines.append(name + '_sum{' + labels + '} ' + str(snapshot["sum"]))
+    lines.append(name + '_count{' + labels + '} ' + str(snapshot["count"]))
+
+
+# The metrics in a monitor's status record, as (metric name, help, type, key in the record's metrics)
+MONITOR_METRICS = (
+    ("streammon_lines_total", "ffmpeg lines analyzed", "counter", "lines"),
+    ("streammon_lines_per_second", "ffmpeg lines analyzed per second, over the last few seconds", "gauge", "lines_per_sec"),
+    ("streammon_lines_dropped_total", "Droppable lines dropped because the analyze queue was full", "counter", "dropped"),
+    ("streammon_queue_blocked_total", "Lines that had to wait for room in the analyze queue", "counter", "blocked"),
+    ("streammon_queue_depth", "Lines waiting in the analyze queue", "gauge", "queue_depth"),
+    ("streammon_queue_high_water", "Deepest the analyze queue has been", "gauge", "queue_high_water"),
+    ("streammon_luma_mean", "Mean brightness of the latest frame, 0-255 (raw detector only)", "gauge", "luma"),
+    ("streammon_motion_db", "Difference between the latest two frames in dB (raw detector only)", "gauge", "motion_db"),
+    ("streammon_audio_level_db", "RMS audio level of the latest 0.1s in dB (raw detector only)", "gauge", "audio_db"),
+    ("streammon_process_cpu_seconds_total", "CPU time used by the monitor process", "counter", "cpu_seconds"),
+    ("streammon_ffmpeg_cpu_seconds_total", "CPU time used by the monitor's ffmpeg processes", "counter", "ffmpeg_cpu_seconds"),
+    ("streammon_process_resident_memory_bytes", "Resident memory of the monitor process", "gauge", "rss_bytes"),
+)
+
+MONITOR_HISTOGRAMS = (
+    ("streammon_alert_latency_seconds", "Time from detecting a condition to the alert being delivered", "alert_latency"),
+    ("streammon_mongo_write_seconds", "Time taken by database writes", "mongo_write"),
+)
+
+
+# Returns the Prometheus text format for the latest status record of each stream and the supervisor's own stats
+def format_metrics(records, supervisor):
+    now = time.time()
+    lines = []
+
+    def header(name, help_text, metric_type):
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " " + metric_type)
+
+    streams = sorted(records.items())
+
+    header("streammon_monitor_up", "1 if the monitor has sent its status recently", "gauge")
+    for stream, record in streams:
+        lines.append('streammon_monitor_up{stream="' + escape_label(stream) + '"} ' + str(int(now - record["time"] < STATUS_MAX_AGE)))
+
+    header("streammon_status_age_seconds", "Seconds since the monitor's last status", "gauge")
+    for stream, record in streams:
+        lines.append('streammon_status_age_seconds{stream="' + escape_label(stream) + '"} ' + format(now - record["time"], ".3f"))
+
+    header("streammon_monitor_state", "The monitor's state (starting, running, retrying or down)", "gauge")
+    for stream, record in streams:
+        lines.append('streammon_monitor_state{stream="' + escape_label(stream) + '",state="' + escape_label(record["state"]) + '"} 1')
+
+    header("streammon_condition", "Conditions in progress (black, freeze, silence, no_new_frames)", "gauge")
+    for stream, record in streams:
+        for condition in record.get("conditions", []):
+            lines.append('streammon_condition{stream="' + escape_label(stream) + '",condition="' + escape_label(condition) + '"} 1')
+
+    header("streammon_ffmpeg_speed", "ffmpeg processing speed relative to real time", "gauge")
+    for stream, record in streams:
+        if record.get("speed") is not None:
+            lines.append('streammon_ffmpeg_speed{stream="' + escape_label(stream) + '"} ' + str(record["speed"]))
+
+    for name, help_text, metric_type, key in MONITOR_METRICS:
+        header(name, help_text, metric_type)
+        for stream, record in streams:
+            value = record.get("metrics", {}).get(key)
+            if value is not None:
+                lines.append(name + '{stream="' + escape_label(stream) + '"} ' + str(value))
+
+    for name, help_text, key in MONITOR_HISTOGRAMS:
+        header(name, help_text, "histogram")
+        for stream, record in streams:
+            snapshot = record.get("metrics", {}).get(key)
+            if snapshot:
+                format_histogram(lines, name, 'stream="' + escape_label(stream) + '"', snapshot)
+
+    header("streammon_supervisor_monitors", "Monitors the supervisor is keeping track of", "gauge")
+    lines.append("streammon_supervisor_monitors " + str(supervisor["monitors"]))
+    header("streammon_supervisor_cpu_seconds_total", "CPU time used by the supervisor", "counter")
+    lines.append("streammon_supervisor_cpu_seconds_total " + str(supervisor["cpu_seconds"]))
+    header("streammon_supervisor_resident_memory_bytes", "Resident memory of the supervisor", "gauge")
+    lines.append("streammon_supervisor_resident_memory_bytes " + str(supervisor["rss_bytes"]))
+    header("streammon_supervisor_core_monitors", "Monitors assigned to each core (see CPU_AFFINITY in the supervisor)", "gauge")
+    for cpu, load in sorted(supervisor.get("core_monitors", {}).items(), key=lambda item: int(item[0])):
+        lines.append('streammon_supervisor_core_monitors{cpu="' + cpu + '"} ' + str(load))
+    launch = supervisor.get("launch", {})
+    header("streammon_supervisor_monitors_starting", "Monitors started and not running yet (see LAUNCH_CONCURRENCY)", "gauge")
+    lines.append("streammon_supervisor_monitors_starting " + str(launch.get("starting", 0)))
+    header("streammon_supervisor_monitors_waiting", "Monitors waiting for the launch budget", "gauge")
+    lines.append("streammon_supervisor_monitors_waiting " + str(launch.get("waiting", 0)))
+    if launch.get("last_wave_seconds") is not None:
+        header("streammon_supervisor_launch_wave_seconds", "Time from the first start to all monitors started in the last wave (e.g. a restart) running, only if they all were", "gauge")
+        lines.append("streammon_supervisor_launch_wave_seconds " + str(launch["last_wave_seconds"]))
+    if launch.get("last_wave_size"):
+        header("streammon_supervisor_launch_wave_monitors", "Monitors started in the last wave, how many of them were running, and how many timed out without a status", "gauge")
+        lines.append('streammon_supervisor_launch_wave_monitors{result="started"} ' + str(launch["last_wave_size"]))
+        lines.append('streammon_supervisor_launch_wave_monitors{result="running"} ' + str(launch["last_wave_running"]))
+        lines.append('streammon_supervisor_launch_wave_monitors{result="timed_out"} ' + str(launch.get("last_wave_timed_out", 0)))
+    header("streammon_supervisor_loop_seconds", "Time taken by each pass of the supervisor loop", "histogram")
+    format_histogram(lines, "streammon_supervisor_loop_seconds", 'process="supervisor"', supervisor["loop"])
+    header("streammon_supervisor_mongo_write_seconds", "Time taken by the supervisor's stream report writes", "histogram")
+    format_histogram(lines, "streammon_supervisor_mongo_write_seconds", 'process="supervisor"', supervisor["mongo_write"])
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    '''
+    Serves /metrics (Prometheus) and /status (JSON) from a background thread.
+    get_records and get_supervisor are called for every request and return the latest status records
+    by stream and the supervisor's stats.
+    '''
+
+    def __init__(self, port, get_records, get_supervisor, address="127.0.0.1"):
+        # Only the supervisor serves metrics, the monitors don't need to load http.server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                records = dict(get_records())
+                supervisor = get_supervisor()
+                if self.path == "/metrics":
+                    body = format_metrics(records, supervisor).encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/status":
+                    body = json.dumps({"streams": records, "supervisor": supervisor}).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes every few seconds would fill the supervisor's output
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((address, port), Handler)
+        self.httpd.daemon_threads = True
+        t = threading.Thread(target=self.httpd.serve_forever, name="metrics_server")
+        t.daemon = True
+        t.start()
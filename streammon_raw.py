@@ -0,0 +1,204 @@
+'''
+streammon_raw.py
+The raw detector, an alternative to ffmpeg's blackframe, blackdetect, freezedetect and silencedetect
+filters for the monitor agent.  ffmpeg pipes small grayscale frames and low rate mono PCM to the
+monitor, and the black, freeze and silence checks are done here with NumPy, about a second at a time.
+
+Conditions come out as the same events classify_line() makes of the filters' output (see
+streammon_detect), so StreamState handles them exactly the same way.  The frame counter and speed
+still come from ffmpeg's progress reports.
+
+NumPy is optional.  Without it available() returns False and the monitor sticks with the filters.
+
+'''
+
+import math
+import subprocess
+
+# Imported by available(), so monitors using the filters don't load it
+numpy = None
+
+from streammon_detect import (EVENT_BLACKFRAME, EVENT_BLACK_END, EVENT_FREEZE_START, EVENT_FREEZE_END,
+    EVENT_SILENCE_START, EVENT_SILENCE_END, AUDIO_ANALYSIS_FORMAT, AUDIO_ANALYSIS_RATE, progress_args,
+    frame_grab_output)
+
+# Size and rate of the frames ffmpeg sends, black and freeze detection don't need any more than this
+FRAME_WIDTH = 160
+FRAME_HEIGHT = 90
+FRAME_RATE = 5
+FRAME_SIZE = FRAME_WIDTH * FRAME_HEIGHT
+
+# Frames and audio are analyzed this many seconds at a time
+BATCH_SECONDS = 1
+# The audio level is measured over windows this long
+AUDIO_WINDOW_SECONDS = 0.1
+AUDIO_WINDOW = int(AUDIO_ANALYSIS_RATE * AUDIO_WINDOW_SECONDS)
+
+# A frame is black when at least this share of its pixels are darker than the black threshold,
+# the same as blackframe=amount=98
+BLACK_AMOUNT = 0.98
+# Frames this small have much less pixel noise than the stream itself, so the freeze noise threshold
+# comes down, as it does for the scaled analysis profiles
+FREEZE_NOISE_OFFSET = -5
+# Floor for the levels reported in dB, so a perfectly still picture or digital silence doesn't give -inf
+MIN_LEVEL = 1e-6
+# Seconds allowed for ffprobe to find out whether a video stream has sound
+PROBE_TIMEOUT = 15
+
+
+def available():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
+
+
+# Returns whether the stream has an audio stream, None if ffprobe couldn't tell (e.g. the stream is down)
+def has_audio(ffprobe, uri, timeout=PROBE_TIMEOUT):
+    try:
+        result = subprocess.run([ffprobe, "-v", "error", "-select_streams", "a", "-show_entries", "stream=index",
+            "-of", "csv=p=0", uri], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return len(result.stdout.strip()) > 0
+
+
+# Builds the arguments that go after "ffmpeg -i <stream>" for the raw detector.  Like build_ffmpeg_args(),
+# the string has placeholders for the pipes: {events_fd} for the progress reports, {video_fd} for the
+# raw frames (not for audio only streams), {audio_fd} for the PCM (only if the stream has sound) and
+# {grab_fd} for the thumbnails.
+def build_raw_ffmpeg_args(audio_only, frame_grab_interval, progress_period=1, frame_grab_from_analyzer=1,
+        frame_grab_width=640, audio=True):
+    ffmpeg_args = progress_args(progress_period)
+
+    if not audio_only:
+        ffmpeg_args = ffmpeg_args + " -map 0:v:0 -vf fps=" + str(FRAME_RATE) + ",scale=" + str(FRAME_WIDTH) + ":" + \
+            str(FRAME_HEIGHT) + ":flags=area,format=gray -max_muxing_queue_size 9999 -f rawvideo pipe:{video_fd}"
+
+    # An output with nothing mapped to it stops ffmpeg ("Output file does not contain any stream"),
+    # so a video stream without sound mustn't get one (see has_audio())
+    if audio_only or audio:
+        ffmpeg_args = ffmpeg_args + " -map 0:a:0 -af " + AUDIO_ANALYSIS_FORMAT + \
+            " -max_muxing_queue_size 9999 -f s16le pipe:{audio_fd}"
+
+    if not audio_only and frame_grab_from_analyzer:
+        ffmpeg_args = ffmpeg_args + frame_grab_output(frame_grab_interval, frame_grab_width)
+
+    return ffmpeg_args
+
+
+class RawDetector:
+    '''
+    Black, freeze and silence detection on the raw frames and PCM from one ffmpeg.
+    read_video() and read_audio() each run in a thread of their own and pass each event to
+    emit(event, value, line).  Use a new RawDetector for each ffmpeg.
+    '''
+
+    def __init__(self, emit, black_threshold, freeze_threshold, freeze_duration, silence_threshold, silence_duration):
+        self.emit = emit
+        self.black_threshold = int(black_threshold)
+        # Like freezedetect: frames are the same when the mean absolute difference between them,
+        # as a fraction of full scale, is below the noise level
+        self.freeze_noise = 10 ** ((float(freeze_threshold) + FREEZE_NOISE_OFFSET) / 20)
+        # 0 turns freeze detection off, as it does for the filter
+        self.freeze_frames = float(freeze_duration) * FRAME_RATE
+        # Silence is an RMS level below the threshold (dB below full scale) for the duration
+        self.silence_threshold = float(silence_threshold)
+        self.silence_windows = float(silence_duration) / AUDIO_WINDOW_SECONDS
+
+        self.black = False
+        self.previous_frame = None
+        self.still_frames = 0
+        self.frozen = False
+        self.quiet_windows = 0
+        self.silent = False
+
+        # The latest measurements, for the status records
+        self.luma = None
+        self.motion = None
+        self.audio_level = None
+
+    # Returns the latest measurements for the monitor's metrics (see streammon_metrics)
+    def stats(self):
+        return {"luma": self.luma, "motion_db": self.motion, "audio_db": self.audio_level}
+
+    def read_video(self, output):
+        self.read_batches(output, FRAME_SIZE * FRAME_RATE * BATCH_SECONDS, FRAME_SIZE, self.analyze_frames)
+
+    def read_audio(self, output):
+        self.read_batches(output, AUDIO_ANALYSIS_RATE * 2 * BATCH_SECONDS, AUDIO_WINDOW * 2, self.analyze_audio)
+
+    # Reads batch_size bytes at a time and hands them to analyze, in whole units, until ffmpeg exits
+    def read_batches(self, output, batch_size, unit, analyze):
+        while True:
+            data = output.read(batch_size)
+            usable = len(data) - len(data) % unit
+            if usable:
+                analyze(data[:usable])
+            if len(data) < batch_size:
+                break
+        output.close()
+
+    def analyze_frames(self, data):
+        frames = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, FRAME_SIZE)
+        self.luma = round(float(frames[-1].mean()), 1)
+
+        # Black frames, and whether a black period ended (a black frame followed by one that isn't)
+        black = (frames < self.black_threshold).mean(axis=1) >= BLACK_AMOUNT
+        was_black = numpy.concatenate(([self.black], black[:-1]))
+        ended = bool((was_black & ~black).any())
+        if ended and black[-1]:
+            # Ended and then started again within the batch
+            self.emit(EVENT_BLACK_END, None, "raw: black ended")
+        if black.any():
+            self.emit(EVENT_BLACKFRAME, None, "raw: " + str(int(black.sum())) + "/" + str(len(black)) + " black frames")
+        if ended and not black[-1]:
+            self.emit(EVENT_BLACK_END, None, "raw: black ended")
+        self.black = bool(black[-1])
+
+        # Difference between each frame and the one before it
+        if self.previous_frame is not None:
+            frames = numpy.concatenate((self.previous_frame, frames))
+        self.previous_frame = frames[-1:]
+        if len(frames) < 2:
+            return
+        differences = numpy.abs(numpy.diff(frames.astype(numpy.int16), axis=0)).mean(axis=1) / 255
+        self.motion = round(20 * math.log10(max(float(differences[-1]), MIN_LEVEL)), 1)
+        if not self.freeze_frames:
+            return
+
+        for still in differences < self.freeze_noise:
+            if still:
+                self.still_frames += 1
+                if not self.frozen and self.still_frames >= self.freeze_frames:
+                    self.frozen = True
+                    self.emit(EVENT_FREEZE_START, None, "raw: freeze_start, still for " + str(self.still_frames) + " frames")
+            else:
+                if self.frozen:
+                    self.frozen = False
+                    self.emit(EVENT_FREEZE_END, None, "raw: freeze_end")
+                self.still_frames = 0
+
+    def analyze_audio(self, data):
+        samples = numpy.frombuffer(data, dtype="<i2").astype(numpy.float32) / 32768
+        # RMS level of each window in dB below full scale
+        power = numpy.square(samples.reshape(-1, AUDIO_WINDOW)).mean(axis=1)
+        levels = 10 * numpy.log10(numpy.maximum(power, MIN_LEVEL * MIN_LEVEL))
+        self.audio_level = round(float(levels[-1]), 1)
+
+        for quiet in levels < self.silence_threshold:
+            if quiet:
+                self.quiet_windows += 1
+                if not self.silent and self.quiet_windows >= self.silence_windows:
+                    self.silent = True
+                    self.emit(EVENT_SILENCE_START, None, "raw: silence_start")
+            else:
+                if self.silent:
+                    self.silent = False
+                    self.emit(EVENT_SILENCE_END, None, "raw: silence_end")
+                self.quiet_windows = 0
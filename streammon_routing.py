@@ -0,0 +1,82 @@
+'''
+streammon_routing.py
+Who gets the alerts for each stream.  The supervisor keeps the users collection in memory and, whenever
+it changes, writes the routing table to run/routing.json: the Pushover keys for each streamId.  Monitors
+started with --stream_id look their recipients up in it when an alert goes out, so subscription changes
+take effect without restarting them, and starting a monitor doesn't need a users query.
+
+The supervisor also gives each monitor the recipients at the time it starts, with --pushover, which the
+monitor falls back on if it can't read the table.  Monitors started by hand (or by an older supervisor)
+only have those.
+
+'''
+
+import time
+
+import streammon_status
+
+ROUTING_FILE = streammon_status.run_dir + "/routing.json"
+
+
+# Returns the Pushover keys ("user" or "user@token") of the enabled users that get alerts for the
+# stream.  Users with a non-empty subscribed_streams list only get alerts for those streams.
+def recipients_for(users, stream_id):
+    keys = []
+    for i in users:
+        if len(str(i["pushover_id"])) > 0 and i["enabled"] == "1":
+            subscribed = i.get("subscribed_streams", [])
+            if stream_id and len(subscribed) > 0 and stream_id not in subscribed:
+                continue
+            if len(str(i["pushover_token"])) > 0:
+                keys.append(i["pushover_id"] + "@" + i["pushover_token"])
+            else:
+                keys.append(i["pushover_id"])
+    return keys
+
+
+# Builds the routing table from the users documents: the keys of the users that get alerts for
+# streams nobody has subscribed to, and the keys for each streamId somebody has.  Looking a stream
+# up is then a dict lookup, however many users there are.
+def build_table(users):
+    stream_ids = set()
+    for i in users:
+        stream_ids.update(i.get("subscribed_streams", []))
+    streams = dict((stream_id, recipients_for(users, stream_id)) for stream_id in stream_ids)
+    unsubscribed = [i for i in users if len(i.get("subscribed_streams", [])) == 0]
+    return {"everyone": recipients_for(users, None), "unsubscribed": recipients_for(unsubscribed, None),
+        "streams": streams, "updated": time.time()}
+
+
+# Returns the keys for a stream from a routing table, the same as recipients_for() on the users it
+# was built from
+def lookup(table, stream_id):
+    if not stream_id:
+        return table["everyone"]
+    return table["streams"].get(stream_id, table["unsubscribed"])
+
+
+# Replaces the routing file in one go, so a monitor never reads half of it.  The monitors' user needs
+# to read it, nobody else should (it has the Pushover keys in it).
+def write_table(table, owner=None, path=ROUTING_FILE):
+    streammon_status.write_json(path, table, owner)
+
+
+class RoutingTable:
+    '''
+    A monitor's view of the routing file.  recipients() checks whether the file has been replaced
+    (one stat) and reads it again if it has.  error says why the last read failed, None if it didn't.
+    '''
+
+    def __init__(self, path=ROUTING_FILE):
+        self.path = path
+        self.file = streammon_status.JsonFile(path)
+        self.error = None
+
+    # Returns the keys for the stream, None if there is no routing table to go by.  If the file can't
+    # be read, the last table read from it (if any) is used.
+    def recipients(self, stream_id):
+        table = self.file.read()
+        self.error = self.file.error
+        if table is None:
+            return None
+        return lookup(table, stream_id)
@@ -0,0 +1,140 @@
+'''
+streammon_status.py
+Status records from the monitors (and the engine) to the supervisor over a Unix datagram socket.
+Each record is a small JSON object describing one stream: its state, last frame, active conditions
+and last alert.  The supervisor keeps the latest record per stream, so reading a stream's status
+costs a dict lookup instead of reading its log file.
+
+Sending never blocks.  If the supervisor isn't listening (or is behind) the record is dropped,
+and the next one follows a second later.
+
+Going the other way, the supervisor leaves what the monitors need from the database in JSON files in
+run/ (see write_json() and JsonFile): the routing table (see streammon_routing) and, in engine mode,
+the stream configs, so the engine doesn't have to read them from the database itself.
+
+'''
+
+import json
+import os
+import shutil
+import socket
+import time
+
+from config import OPERATING_DIRECTORY
+
+# Get the base directory from the config file
+base_dir = str(OPERATING_DIRECTORY)
+#remove quotes
+base_dir = base_dir.replace('"', '')
+
+run_dir = base_dir + "/run"
+STATUS_SOCKET = run_dir + "/status.sock"
+# The supervisor's copy of stream_configs, for the engine
+STREAMS_FILE = run_dir + "/streams.json"
+
+# Largest record the supervisor will read, anything longer is cut off (and then ignored)
+MAX_RECORD_SIZE = 8192
+
+# Stream states
+STATE_STARTING = "starting"
+STATE_RUNNING = "running"
+STATE_RETRYING = "retrying"     # Within the stream failure grace period
+STATE_DOWN = "down"             # Grace period over, waiting to try again
+
+
+class StatusPublisher:
+    '''Sends status records to the supervisor.'''
+
+    def __init__(self, path=STATUS_SOCKET):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    # Sends the status of a stream, fields are added to the record as they are
+    def publish(self, stream, state, **fields):
+        record = {"stream": stream, "state": state, "pid": os.getpid(), "time": time.time()}
+        record.update(fields)
+        try:
+            self.sock.sendto(json.dumps(record, separators=(",", ":")).encode(), self.path)
+        except OSError:
+            # No supervisor (ENOENT, ECONNREFUSED) or its socket buffer is full (EAGAIN)
+            pass
+
+
+class StatusReceiver:
+    '''
+    Binds the status socket and keeps the latest record for each stream.
+    If owner is given the socket is handed to that user, so monitors started under it can send to it.
+    '''
+
+    def __init__(self, path=STATUS_SOCKET, owner=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Left behind by an earlier supervisor
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.sock.setblocking(False)
+        if owner:
+            try:
+                shutil.chown(path, user=owner)
+            except (OSError, LookupError) as e:
+                print ("Could not hand the status socket to " + owner + ": " + str(e))
+        self.records = {}
+
+    # Reads whatever has arrived since the last call, returns the latest record for each stream by name
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_RECORD_SIZE)
+            except BlockingIOError:
+                break
+            try:
+                record = json.loads(data)
+                self.records[record["stream"]] = record
+            except (ValueError, TypeError, KeyError):
+                continue
+        return self.records
+
+
+# Replaces a file in run/ with data as JSON in one go, so a reader never sees half of it.  Only owner
+# (the user the monitors run as) gets to read it, some of these files have Pushover keys in them.
+# Values JSON doesn't have (the documents' ObjectIds) are written as strings.
+def write_json(path, data, owner=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, default=str)
+    os.chmod(temp_path, 0o600)
+    if owner:
+        try:
+            shutil.chown(temp_path, user=owner)
+        except (OSError, LookupError) as e:
+            print ("Could not hand " + os.path.basename(path) + " to " + owner + ": " + str(e))
+    os.replace(temp_path, path)
+
+
+class JsonFile:
+    '''
+    A reader's view of a file written with write_json().  read() checks whether the file has been
+    replaced (one stat) and loads it again if it has.  error says why the last read failed, None if it didn't.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.mtime = None
+        self.error = None
+
+    # Returns what is in the file, what was in it last time if it can't be read now, None if it never could
+    def read(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.mtime:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+                self.mtime = mtime
+            self.error = None
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+        return self.data
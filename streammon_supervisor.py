@@ -11,10 +11,21 @@ Author:  Scott McGrath (scott@smcgrath.com)
 
 import psutil
 import os,signal
+import select
+import threading
 import time
 import subprocess
 from subprocess import PIPE, Popen
-from config import MONGO_CONNECTION_STRING, OPERATING_DIRECTORY, MONGO_DATABASE_NAME, USER
+from pymongo.errors import OperationFailure, PyMongoError
+import streammon_db
+import streammon_status
+import streammon_metrics
+import streammon_connect
+import streammon_zygote
+import streammon_routing
+import streammon_detect
+from datetime import datetime
+from config import OPERATING_DIRECTORY, MONGO_DATABASE_NAME, USER
 
 database_name = str(MONGO_DATABASE_NAME)
 # Remove quotes
@@ -36,6 +47,396 @@ users_collection_name = "users"
 base_dir = str(OPERATING_DIRECTORY)
 log_dir = base_dir + "/public_html/logs"
 
+# Set this to 1 to monitor all the streams from a single streammon_engine.py process instead of
+# starting one sjmstreammonitor-withprobe.py per stream.  The engine starts and stops the streams
+# itself, the supervisor just keeps the engine running and updates the stream reports.
+ENGINE_MODE = 0
+
+# Registry key for the engine process
+ENGINE_KEY = "__engine__"
+
+# Seconds to wait before reopening a change stream that failed
+CHANGE_STREAM_RETRY_INTERVAL = 5
+
+# Without change streams or the top command, seconds between reading the config collections again
+CONFIG_POLL_INTERVAL = 10
+
+# The top command's per-collection counters that go up when the collection is written to
+TOP_WRITE_COUNTERS = ("insert", "update", "remove", "commands")
+
+# Stream reports are only written when they change, all of them in one bulk_write at most
+# every REPORT_FLUSH_INTERVAL seconds.  Changes to just the frame counter and time (see
+# REPORT_VOLATILE_FIELDS) are written at most every REPORT_REFRESH_INTERVAL seconds.
+REPORT_FLUSH_INTERVAL = 5
+REPORT_REFRESH_INTERVAL = 60
+REPORT_VOLATILE_FIELDS = ('last_frame', 'updated')
+
+# Set to 1 to pin each monitor (and its ffmpegs) to as many cores as it has decoder threads, spread
+# so that every core has about the same number of monitors on it (see CoreAllocator)
+CPU_AFFINITY = 1
+
+# Local port for the metrics of all the monitors and the supervisor: /metrics in the Prometheus
+# text format, /status as JSON (see streammon_metrics).  Set to 0 to turn it off.
+METRICS_PORT = 9731
+
+# Connection attempts the monitors may have in progress at once across the box, so a network blip
+# that takes every stream down doesn't bring them all back with a burst of ffmpegs (see
+# streammon_connect).  Set to 0 for no cap.
+CONNECT_SLOTS = 4
+
+# Monitors are started a few at a time rather than all at once after a restart (see LaunchScheduler):
+# at most LAUNCH_CONCURRENCY still starting up at once, and starts at LAUNCH_RATE a second with bursts
+# of up to LAUNCH_BURST.  A monitor counts as started once its status record says it is running (or
+# retrying, or down), or after LAUNCH_SETTLE_TIMEOUT seconds.  Streams with a higher "priority" in
+# stream_configs go first.
+LAUNCH_CONCURRENCY = 4
+LAUNCH_RATE = 2
+LAUNCH_BURST = 4
+LAUNCH_SETTLE_TIMEOUT = 60
+
+# Set to 1 to start the monitors by forking a process that has already loaded everything they need,
+# instead of sudo and a new Python each time (see streammon_zygote).  Needs the supervisor to run as
+# root or as USER.
+ZYGOTE = 1
+
+
+# An in-memory copy of a config collection.  Where the server supports change streams (replica sets)
+# a thread follows the collection's change stream.  Otherwise poll() checks the server's write
+# counters for the collection (the top command, which only reads counters the server keeps in
+# memory) and only re-reads the collection when they have gone up.
+# changed (a threading.Event) is set whenever the copy changes, and version goes up.
+class ConfigCache:
+    def __init__(self, collection, changed):
+        self.collection = collection
+        self.changed = changed
+        self.docs = {}
+        self.lock = threading.Lock()
+        self.watching = False
+        self.use_top = True
+        self.last_counters = None
+        self.last_read = 0
+        self.version = 0
+
+    def start(self):
+        try:
+            # Opened before the first read, so nothing that changes in between is missed
+            stream = self.collection.watch(full_document='updateLookup')
+        except OperationFailure as e:
+            print ("No change streams for " + self.collection.name + " (" + str(e) + "), polling for changes\r\n")
+            self.poll()
+            return
+        self.reload()
+        self.watching = True
+        t = threading.Thread(target=self.follow, args=(stream,), name="watch_" + self.collection.name)
+        t.daemon = True
+        t.start()
+
+    # Returns the documents as a list
+    def snapshot(self):
+        with self.lock:
+            return list(self.docs.values())
+
+    def reload(self):
+        docs = {}
+        for doc in self.collection.find():
+            docs[doc["_id"]] = doc
+        with self.lock:
+            self.docs = docs
+            self.version += 1
+        self.last_read = time.monotonic()
+        self.changed.set()
+
+    # Re-reads the collection if it has been written to since the last look.  Where we aren't allowed
+    # to run top (e.g. mongos, or a user without the privilege) it is re-read every CONFIG_POLL_INTERVAL
+    # seconds, changes take that long to show up.
+    def poll(self):
+        if self.use_top:
+            try:
+                result = self.collection.database.client.admin.command("top")
+            except OperationFailure as e:
+                print ("top not available (" + str(e) + "), reading " + self.collection.name + " every " + str(CONFIG_POLL_INTERVAL) + " seconds\r\n")
+                self.use_top = False
+            else:
+                usage = result["totals"].get(self.collection.full_name, {})
+                counters = tuple(usage.get(name, {}).get("count") for name in TOP_WRITE_COUNTERS)
+                if counters == self.last_counters:
+                    return
+                # Taken before the read, so a write that lands in between is picked up next time
+                self.last_counters = counters
+                self.reload()
+                return
+        if time.monotonic() - self.last_read >= CONFIG_POLL_INTERVAL:
+            self.reload()
+
+    # Applies the changes from the change stream for as long as the supervisor runs
+    def follow(self, stream):
+        while True:
+            try:
+                if stream is None:
+                    stream = self.collection.watch(full_document='updateLookup')
+                    self.reload()
+                for change in stream:
+                    self.apply(change)
+                # The stream was invalidated (e.g. the collection was dropped or renamed)
+            except PyMongoError as e:
+                print ("Change stream for " + self.collection.name + " failed: " + str(e) + "\r\n")
+                time.sleep(CHANGE_STREAM_RETRY_INTERVAL)
+            if stream is not None:
+                stream.close()
+            stream = None
+
+    def apply(self, change):
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            doc = change.get("fullDocument")
+            with self.lock:
+                if doc is None:
+                    # Deleted again before the lookup
+                    self.docs.pop(change["documentKey"]["_id"], None)
+                else:
+                    self.docs[doc["_id"]] = doc
+        elif operation == "delete":
+            with self.lock:
+                self.docs.pop(change["documentKey"]["_id"], None)
+        else:
+            self.reload()
+            return
+        with self.lock:
+            self.version += 1
+        self.changed.set()
+
+
+# A monitor (or the engine) process the supervisor is keeping track of
+class MonitorProcess:
+    def __init__(self, pid, uri=None, audio_only=False, process=None, profile="", session=False):
+        self.pid = pid
+        self.uri = uri
+        self.audio_only = audio_only
+        # Analysis profile name from stream_configs ("" for the default)
+        self.profile = profile
+        # The Popen if we started it, None if it was already running when we started up or came from the zygote
+        self.process = process
+        # Whether it leads a session of its own (everything we start does, see kill())
+        self.session = session or process is not None
+        # A pidfd becomes readable when the process exits, see reap_monitors()
+        self.pidfd = open_pidfd(pid)
+
+    # Only for processes without a pidfd
+    def has_exited(self):
+        if self.process is not None:
+            return self.process.poll() is not None
+        return not psutil.pid_exists(self.pid)
+
+    def kill(self):
+        try:
+            if self.session:
+                # Monitors we started have a session of their own, so this gets sudo, the monitor and its ffmpegs
+                os.killpg(self.pid, signal.SIGKILL)
+            else:
+                # Found running when we started up (see rebuild_registry()), its ffmpegs have to go too
+                kill_process_tree(self.pid)
+        except ProcessLookupError:
+            pass
+
+
+# Kills a process and everything it started.  A monitor started with start_new_session leads a process
+# group (or its sudo does) with its ffmpegs in it, which goes as a whole.  Otherwise (e.g. started from
+# a shell along with other monitors) its children are looked up and killed one by one.
+def kill_process_tree(pid):
+    try:
+        process = psutil.Process(pid)
+        pgid = os.getpgid(pid)
+        if pgid in (pid, process.ppid()) and pgid != os.getpgid(0):
+            os.killpg(pgid, signal.SIGKILL)
+            return
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    for process in processes:
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+# Spreads the monitors over the cores the supervisor is allowed to use.  Each monitor gets the given
+# number of cores, the ones with the fewest monitors on them at the time.
+class CoreAllocator:
+    def __init__(self, cpus=None):
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0))
+        # Monitors on each core, and the cores each monitor has by registry key
+        self.load = dict((cpu, 0) for cpu in cpus)
+        self.assigned = {}
+
+    # Returns the cores for a new monitor
+    def assign(self, key, count):
+        self.release(key)
+        count = max(1, min(count, len(self.load)))
+        cpus = sorted(sorted(self.load, key=lambda cpu: (self.load[cpu], cpu))[:count])
+        self.claim(key, cpus)
+        return cpus
+
+    # Records the cores a monitor is using, e.g. one that was already running when we started up
+    def claim(self, key, cpus):
+        self.release(key)
+        cpus = [cpu for cpu in cpus if cpu in self.load]
+        for cpu in cpus:
+            self.load[cpu] += 1
+        self.assigned[key] = cpus
+
+    def release(self, key):
+        for cpu in self.assigned.pop(key, []):
+            self.load[cpu] -= 1
+
+    # Difference in monitors between the busiest and the least busy core
+    def spread(self):
+        return max(self.load.values()) - min(self.load.values())
+
+    # e.g. "4 monitors on 4 cores: cpu0=2 cpu1=2 cpu2=2 cpu3=2, spread 0"
+    def report(self):
+        return (str(len(self.assigned)) + " monitors on " + str(len(self.load)) + " cores: " +
+            " ".join("cpu" + str(cpu) + "=" + str(load) for cpu, load in sorted(self.load.items())) +
+            ", spread " + str(self.spread()))
+
+
+# Starts the monitors that should be running, the most important first, without starting them all at
+# once: there is a cap on monitors still starting up and a token bucket for the start rate.
+# Each pass of the main loop request()s the monitors it wants started and calls run().  A request
+# that has to wait is made again on the next pass, if the stream still wants a monitor by then.
+# A wave begins with the first start after the launcher was idle (e.g. after a restart) and ends
+# once every monitor started in it has got going.  How long that took is only reported if they
+# are all running by then, monitors that timed out are counted separately.
+class LaunchScheduler:
+    def __init__(self, concurrency, rate, burst, settle_timeout):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.settle_timeout = settle_timeout
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        # This pass's requests by registry key, as (priority, title, arguments for restart_monitor())
+        self.requests = {}
+        # Requests that had to wait on the last pass
+        self.deferred = 0
+        # Monitors started and not settled yet, as (title, time started) by registry key
+        self.starting = {}
+        # The current wave: when it began, how many monitors were started, how many are running and
+        # how many timed out
+        self.wave_start = None
+        self.wave_size = 0
+        self.wave_running = 0
+        self.wave_timed_out = 0
+        # Seconds the last wave took (None unless all its monitors were running), and its monitors
+        # started, running and timed out
+        self.last_wave_seconds = None
+        self.last_wave_size = 0
+        self.last_wave_running = 0
+        self.last_wave_timed_out = 0
+
+    def request(self, key, title, priority, args):
+        self.requests[key] = (priority, title, args)
+
+    # Starts what the budget allows, highest priority first, with launch(key, args).
+    # statuses are the latest status records by title, and monitors the registry of running monitors.
+    def run(self, statuses, launch, monitors):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.check_started(statuses, now, monitors)
+
+        requests = sorted(self.requests.items(), key=lambda item: (-item[1][0], item[1][1]))
+        self.requests = {}
+        self.deferred = 0
+        for count, (key, (priority, title, args)) in enumerate(requests):
+            if len(self.starting) >= self.concurrency or self.tokens < 1:
+                self.deferred = len(requests) - count
+                print ("Launch budget used up, " + str(self.deferred) + " monitors waiting, " +
+                    str(len(self.starting)) + " starting\r\n")
+                break
+            self.tokens -= 1
+            if self.wave_start is None:
+                self.wave_start = now
+                self.wave_size = 0
+                self.wave_running = 0
+                self.wave_timed_out = 0
+            self.wave_size += 1
+            self.starting[key] = (title, now)
+            launch(key, args)
+
+    # Frees the launch slots of the monitors that have got going, and reports the end of a wave.
+    # A monitor has got going once it sends a status other than starting (running, or retrying or
+    # down if the stream is), exits, or has had settle_timeout seconds.  monitors is the registry,
+    # a monitor that isn't in it any more has exited.
+    def check_started(self, statuses, now, monitors):
+        for key, (title, started) in list(self.starting.items()):
+            record = statuses.get(title)
+            # Records from before the monitor was started don't count
+            if record is not None and record["time"] >= time.time() - (now - started) and \
+                    record["state"] != streammon_status.STATE_STARTING:
+                if record["state"] == streammon_status.STATE_RUNNING:
+                    self.wave_running += 1
+            elif key in monitors:
+                if now - started <= self.settle_timeout:
+                    continue
+                print ("Monitor " + title + " not running after " + str(self.settle_timeout) + " seconds, freeing its launch slot\r\n")
+                self.wave_timed_out += 1
+            del self.starting[key]
+
+        if self.wave_start is not None and not self.starting and not self.deferred:
+            self.last_wave_size = self.wave_size
+            self.last_wave_running = self.wave_running
+            self.last_wave_timed_out = self.wave_timed_out
+            seconds = round(now - self.wave_start, 1)
+            if self.wave_running == self.wave_size:
+                self.last_wave_seconds = seconds
+                print ("Started " + str(self.wave_size) + " monitors, all running " + str(seconds) +
+                    " seconds after the first was started\r\n")
+            else:
+                # Not a launch time, some of them never got going
+                self.last_wave_seconds = None
+                print ("Started " + str(self.wave_size) + " monitors, after " + str(seconds) + " seconds " +
+                    str(self.wave_running) + " running, " + str(self.wave_timed_out) + " timed out, " +
+                    str(self.wave_size - self.wave_running - self.wave_timed_out) + " down or exited\r\n")
+            self.wave_start = None
+
+    # Numbers for the metrics endpoint
+    def stats(self):
+        return {"starting": len(self.starting), "waiting": self.deferred, "last_wave_seconds": self.last_wave_seconds,
+            "last_wave_size": self.last_wave_size, "last_wave_running": self.last_wave_running,
+            "last_wave_timed_out": self.last_wave_timed_out}
+
+
+# Writes the stream reports (see update_report())
+report_writer = streammon_db.WriteBehind(interval=REPORT_FLUSH_INTERVAL)
+# The last report queued for each stream, as (report, time queued), by title
+written_reports = {}
+
+# The monitors this supervisor knows about, by stream key (see stream_key()), plus the engine under ENGINE_KEY
+monitors = {}
+# Polls all the pidfds in one system call, and which registry key each pidfd belongs to
+pidfd_poller = select.poll()
+pidfd_keys = {}
+
+# Forks the monitors (see ZYGOTE)
+zygote = streammon_zygote.Zygote(base_dir + "/sjmstreammonitor-withprobe.py", username)
+
+# Which cores each monitor runs on (see CPU_AFFINITY)
+core_allocator = CoreAllocator()
+
+# Starts the monitors a few at a time
+launcher = LaunchScheduler(LAUNCH_CONCURRENCY, LAUNCH_RATE, LAUNCH_BURST, LAUNCH_SETTLE_TIMEOUT)
+
+# Who gets the alerts for each stream (see streammon_routing), and the version of the users cache
+# it was built from
+routing = None
+routing_version = None
+# The version of the stream configs cache the engine's copy was written from (see update_streams())
+streams_version = None
+
+# How long each pass of the main loop takes
+loop_latency = streammon_metrics.Histogram(streammon_metrics.LOOP_BUCKETS)
+
 
 # Install a signal handler for shutting down gracefully
 class GracefulKiller:
@@ -49,6 +450,10 @@ class GracefulKiller:
 
 def main():
 
+    # The zygote has to be forked while this is the only thread, and before the database connection
+    if ZYGOTE and not ENGINE_MODE:
+        zygote.start()
+
     # Install a signal handler for shutting down gracefully
     killer = GracefulKiller()
 
@@ -59,17 +464,59 @@ def main():
 
     stream_configs_collection = dbname[stream_configs_collection_name]
     global_configs_collection = dbname[global_configs_collection_name]
-    stream_reports_collection = dbname[stream_reports_collection_name]
-    # users_collection = dbname[users_collection_name]
+    users_collection = dbname[users_collection_name]
+
+    # The monitors report their status over a socket (see streammon_status)
+    status_receiver = streammon_status.StatusReceiver(owner=username)
+
+    # The monitors take turns connecting to their streams
+    try:
+        streammon_connect.create_slots(CONNECT_SLOTS, owner=username)
+    except OSError as e:
+        print ("Could not create the connect slots, connections are not capped: " + str(e) + "\r\n")
+
+    if METRICS_PORT:
+        try:
+            # The main loop keeps the records up to date, the server just reads them
+            streammon_metrics.MetricsServer(METRICS_PORT, lambda: status_receiver.records, supervisor_stats)
+            print ("Serving metrics on http://127.0.0.1:" + str(METRICS_PORT) + "/metrics\r\n")
+        except OSError as e:
+            print ("Could not serve metrics on port " + str(METRICS_PORT) + ": " + str(e) + "\r\n")
+
+    # Keep copies of the configs, so we don't have to read them every time around the loop
+    config_changed = threading.Event()
+    global_configs = ConfigCache(global_configs_collection, config_changed)
+    stream_configs = ConfigCache(stream_configs_collection, config_changed)
+    global_configs.start()
+    stream_configs.start()
+    # and of the users, for the routing table (see update_routing())
+    users = ConfigCache(users_collection, config_changed)
+    users.start()
+
+    # Pick up the monitors that are already running (e.g. if the supervisor was restarted)
+    rebuild_registry(stream_configs.snapshot())
 
     while (1):
+        loop_start = time.monotonic()
+
+        # Forget about any monitors that have exited, so they get started again below
+        reap_monitors()
+
+        # Without change streams, see if anything changed since last time
+        config_changed.clear()
+        for cache in (global_configs, stream_configs, users):
+            if not cache.watching:
+                try:
+                    cache.poll()
+                except PyMongoError as e:
+                    print ("Could not check " + cache.collection.name + ": " + str(e) + "\r\n")
 
         print ("Checking global config...\r\n")
         # Review the global config and see if anything needs attention
-        result=global_configs_collection.find()
+        result=global_configs.snapshot()
 
         # If the collection is empty, insert a default doc
-        if (result.count() == 0):
+        if (len(result) == 0):
             print ("No global config found, creating...\r\n")
             global_configs_collection.insert_one({"global_configs": "1", "restart_due": "0"})
 
@@ -80,15 +527,31 @@ def main():
                 kill_all_monitors()
                 # Reset the restart request
                 global_configs_collection.update_one({"global_configs": "1"}, {"$set": {"restart_due": "0"}})
+                # Our copy may not have caught up yet, don't restart again next time around
+                i["restart_due"] = "0"
+
+
 
+        # Tell the monitors about any change in who gets their alerts
+        if users.version != routing_version:
+            update_routing(users)
 
+        if ENGINE_MODE:
+            # The engine works from our copy of the stream configs, so it's written before it starts
+            if stream_configs.version != streams_version:
+                update_streams(stream_configs)
+            if ENGINE_KEY not in monitors:
+                start_engine()
+
+        # Pick up the latest status of each stream
+        statuses = status_receiver.receive()
 
         print ("Checking streams...\r\n")
         # Make sure there is a monitor running for each ENABLED stream in the config
-        result=stream_configs_collection.find()
+        result=stream_configs.snapshot()
 
         # If the collection is missing, print an error and exit
-        if (result.count() == 0):
+        if (len(result) == 0):
             print ("No stream configs found, please configure a stream to watch or load some initial data...\r\n")            
         else:
             for i in result:    
@@ -97,37 +560,101 @@ def main():
                 # If this doc has NECESSARY & VALID INFO (i.e. a stream uri, a title, etc.), do stuff, otherwise, skip.
                 if len(i["title"]) >= 1 and len(i["uri"]) >= 4:
 
+                    if ENGINE_MODE:
+                        print ("Engine mode, action: none\r\n")
+                        if i["enabled"] == "1":
+                            update_report(i["title"], statuses.get(i["title"]))
+                        continue
+
                     # See if the process is running
-                    pid=check_monitor(i["uri"])
-                    if (pid):
+                    key = stream_key(i.get("streamId"), i["title"])
+                    monitor = monitors.get(key)
+                    if monitor and (monitor.uri != i["uri"] or monitor.audio_only != (i["audio"] == "1")
+                            or monitor.profile != (i.get("profile") or "")):
+                        print ("Config changed, action: kill, ",end="")
+                        kill_monitor(key)
+                        monitor = None
+                    if (monitor):
                         print ("Running = 1, ",end="")
                         # See if it should be
                         if i["enabled"] == "1":            
                             print ("Enabled = 1, action: none\r\n")
                             # Take this opportunity to update the stream report in the database
-                            stream_reports_collection.update_one({'title': i["title"]},{'$set': {'status': tailshell(i["title"])}},True) #upsert
+                            update_report(i["title"], statuses.get(i["title"]))
 
                         else:
                             print ("Enabled = 0, action: kill\r\n")    
                             #restart_monitor(i["uri"],i["stream_title"])
-                            kill_monitor(pid)
+                            kill_monitor(key)
                     else:
                         print ("Running = 0, ")
                         # See if it should be
                         if i["enabled"] == "1":            
                             print ("Enabled = 1, action: start\r\n")
-                            restart_monitor(i["uri"],i["title"],i["audio"] == "1", i.get("streamId"))
+                            launcher.request(key, i["title"], stream_priority(i),
+                                (i["uri"], i["title"], i["audio"] == "1", i.get("streamId"), i.get("profile") or ""))
                         else:
                             print ("Enabled = 0, action: none\r\n")
                 else:
                     print ("Ignoring partially/not populated db entry\r\n")
 
+        # Start the monitors that are missing, as many as the launch budget allows
+        launcher.run(statuses, lambda key, args: restart_monitor(*args), monitors)
+
+        loop_latency.observe(time.monotonic() - loop_start)
         if killer.kill_now:
             shutdown()
-        time.sleep(1)                  
+        # Go around again after a second, or as soon as a config change comes in
+        config_changed.wait(1)
                 
 
 
+# Rebuilds the routing table from the users cache and hands it to the monitors.  Monitors started
+# with --stream_id read it when they send an alert, so they don't need restarting.  If they can't,
+# they fall back on the recipients they were started with.
+def update_routing(users):
+    global routing
+    global routing_version
+    version = users.version
+    table = streammon_routing.build_table(users.snapshot())
+    # The monitors we start get their recipients from this one as well
+    routing = table
+    try:
+        streammon_routing.write_table(table, owner=username)
+    except OSError as e:
+        # Try again next time around
+        print ("Could not write the routing table: " + str(e) + "\r\n")
+        return
+    routing_version = version
+    print ("Routing table updated: " + str(len(table["everyone"])) + " recipients, " + str(len(table["streams"])) + " streams with subscribers\r\n")
+
+
+# Hands the stream configs to the engine (see ENGINE_MODE), which picks up the new file within a second
+def update_streams(stream_configs):
+    global streams_version
+    version = stream_configs.version
+    try:
+        streammon_status.write_json(streammon_status.STREAMS_FILE, stream_configs.snapshot(), owner=username)
+    except OSError as e:
+        # Try again next time around
+        print ("Could not write the stream configs for the engine: " + str(e) + "\r\n")
+        return
+    streams_version = version
+
+
+# The supervisor's own numbers for the metrics endpoint
+def supervisor_stats():
+    stats = streammon_metrics.process_stats()
+    stats["monitors"] = len(monitors)
+    stats["loop"] = loop_latency.snapshot()
+    stats["mongo_write"] = streammon_db.write_latency.snapshot()
+    # Called from the metrics server's threads while the main loop changes these, so copy them first
+    stats["core_monitors"] = dict((str(cpu), load) for cpu, load in list(core_allocator.load.items()))
+    stats["core_assignment"] = dict((str(key), cpus) for key, cpus in list(core_allocator.assigned.items()))
+    stats["launch"] = launcher.stats()
+    return stats
+
+
 # If a shutdown signal is received, run kill all monitors
 def shutdown():
     print ("Shutdown signal received")
@@ -135,27 +662,69 @@ def shutdown():
     time.sleep(5)
     exit(0)
 
-def tailshell(title):
-    # Returns the last line in the monitor's log file
-    try:
-        with open(log_dir+'/'+title+'.log', 'rb') as f:
-            try:  
-                f.seek(-2, os.SEEK_END)
-                while f.read(1) != b'\n':
-                    f.seek(-2, os.SEEK_CUR)
-            except OSError:
-                f.seek(0)
-            last_line = f.readline().decode()
-            return last_line
-    except FileNotFoundError:
-        return "No log file found"
-
-
-def kill_monitor(pid):
-    print ("Killing PID " + str(pid) +"\r\n")
-    os.kill(pid, signal.SIGKILL)
+# Updates the stream report in the database from the monitor's latest status record, if it has changed.
+# The write is batched with the other reports, see report_writer.
+def update_report(title, record):
+    if record is None:
+        report = {'status': "No status from monitor yet"}
+    else:
+        report = {
+            'status': status_text(record),
+            'state': record["state"],
+            'conditions': record.get("conditions", []),
+            'last_frame': record.get("frame"),
+            'last_event': record.get("last_event"),
+            'last_event_time': format_time(record.get("last_event_time")),
+            'updated': format_time(record["time"]),
+        }
+
+    now = time.time()
+    previous = written_reports.get(title)
+    if previous is not None:
+        previous_report, queued_time = previous
+        if report == previous_report:
+            return
+        if now - queued_time < REPORT_REFRESH_INTERVAL and report_changes(previous_report, report) <= set(REPORT_VOLATILE_FIELDS):
+            return
+
+    written_reports[title] = (report, now)
+    report_writer.update_one(stream_reports_collection_name, {'title': title}, {'$set': report})
+
+
+# Returns the set of fields that differ between two reports
+def report_changes(old, new):
+    return set(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+# A one line summary of a status record, e.g. "running, conditions: silence, last alert: SILENCE DURATION EXCEEDED"
+# Leaves out the frame counter and time, so it only changes when something happens
+def status_text(record):
+    text = record["state"]
+    if record.get("conditions"):
+        text = text + ", conditions: " + ", ".join(record["conditions"])
+    if record.get("last_event"):
+        text = text + ", last alert: " + record["last_event"]
+    return text
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def kill_monitor(key):
+    print ("Killing PID " + str(monitors[key].pid) +"\r\n")
+    monitors[key].kill()
+    remove_monitor(key)
 
 def kill_all_monitors():
+    # kill the engine (see ENGINE_MODE)
+    for line in os.popen("ps ax | grep streammon_engine | grep -v grep"):
+        pid = line.split()[0]
+        os.kill(int(pid), signal.SIGKILL)
+        print(pid + " Stream engine Process Successfully terminated")
+
     # kill the monitor probes by iterating through the process stack
     for line in os.popen("ps ax | grep sjmstreammonitor | grep -v grep"):
         fields = line.split()
@@ -169,6 +738,14 @@ def kill_all_monitors():
         os.kill(int(pid), signal.SIGKILL)
         print(pid + "Stream probe Process Successfully terminated")
 
+    # and the ones forked by the zygote, which don't have the monitor's name on their command line
+    for pid, cmdline in streammon_zygote.forked_monitors(process_started_before):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+            print(str(pid) + " Stream probe Process Successfully terminated")
+        except ProcessLookupError:
+            pass
+
     # Kill ffmpeg processes
     # iterating through each instance of the process
     for line in os.popen("ps ax | grep ffmpeg | grep -v grep"):
@@ -181,15 +758,21 @@ def kill_all_monitors():
         os.kill(int(pid), signal.SIGKILL)
         print(pid + "ffmpeg Process Successfully terminated")
 
+    for key in list(monitors):
+        remove_monitor(key)
 
-# starting a missing monitor
-def restart_monitor(stream_uri, stream_desc, audio_only=0, stream_id=None):
-    # Connect to the necessary database collections
-    dbname = get_database()
-    stream_configs_collection = dbname[stream_configs_collection_name]
-    users_collection = dbname[users_collection_name]
 
-    pushover_list=[]
+# Launch priority from stream_configs, higher goes first, 0 if not set
+def stream_priority(config):
+    try:
+        return int(config.get("priority") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+# starting a missing monitor
+# profile is the analysis profile from stream_configs (see streammon_detect.ANALYSIS_PROFILES), "" for the default
+def restart_monitor(stream_uri, stream_desc, audio_only=0, stream_id=None, profile=""):
 
     print ("Starting monitor " + stream_desc +"\r\n")
     # Clear the log file
@@ -199,99 +782,183 @@ def restart_monitor(stream_uri, stream_desc, audio_only=0, stream_id=None):
     # if (pid):
     #     kill_monitor(pid)
 
-    # Get the notification info for delivery to the new monitor via arguments
-    
-    pushover_list.clear()
-    result=users_collection.find()    
-    for i in result:
-        # If there is an actual pushover key, and notification is enabled...
-        if len(str(i["pushover_id"])) > 0 and i["enabled"] == "1":         
-            # Check per-stream subscription: if the user has a non-empty subscribed_streams
-            # list, only include them if this stream's streamId is in that list.
-            subscribed = i.get("subscribed_streams", [])
-            if stream_id and len(subscribed) > 0 and stream_id not in subscribed:
-                print ("Skipping " + str(i["pushover_id"]) + " - not subscribed to stream " + str(stream_id))
-                continue
-            pushover_list.append(" --pushover ")
-            # If the pushover_token is not empty, append it to the pushover_id
-            if len(str(i["pushover_token"])) > 0:
-                pushover_list.append(i["pushover_id"]+"@"+i["pushover_token"])
-            else:
-                pushover_list.append(i["pushover_id"])
-                
-        else: 
-            print ("Skipping " + i["pushover_id"] + " with length: ")
-            print (len(str(i["pushover_id"])))
-            print ("enabled = " + str(i["enabled"]))
-    pushover_string =  "".join(pushover_list)
-    
+    # Streams with a streamId look up their recipients in the routing table when they send an alert,
+    # so a change of subscriptions reaches them without a restart.  They get the current recipients on
+    # the command line too, for when they can't read the table.  The others only get those.
+    pushover_list = []
+    if stream_id:
+        pushover_list = ["--stream_id", stream_id]
+    if routing:
+        for key in streammon_routing.lookup(routing, stream_id):
+            pushover_list = pushover_list + ["--pushover", key]
+
+    # Started without a shell and in a session of its own, so the pid we get is the one to watch
+    # and kill_monitor() can take the whole process group down
+    # The monitor's arguments, for the zygote or the command line
+    moncmd = pushover_list
     if (audio_only):
-        moncmd = "sudo -u " + username + " /usr/bin/python " + base_dir + "/sjmstreammonitor-withprobe.py "+ pushover_string + " --audio_only --silence_duration 60 --stream_uri \"" + stream_uri + "\" --stream_desc \"" +stream_desc +"\" > /dev/null"
-    else:
-        moncmd = "sudo -u " + username + " /usr/bin/python " + base_dir + "/sjmstreammonitor-withprobe.py "+ pushover_string + " --freeze_duration 600 --black_duration 60 --silence_duration 60 --stream_uri \"" + stream_uri + "\" --stream_desc \"" +stream_desc +"\" > /dev/null"
-    print (moncmd)
+        moncmd = moncmd + ["--audio_only"]
+    # Audio only monitors ignore it, but it's on the command line so rebuild_registry() can find it
+    if profile:
+        moncmd = moncmd + ["--profile", profile]
+
+    # The detection settings and thread budget the engine uses too, and the cores to run on
+    key = stream_key(stream_id, stream_desc)
+    moncmd = moncmd + streammon_detect.settings_args(audio_only)
+    threads = streammon_detect.ffmpeg_threads(audio_only)
+    if CPU_AFFINITY:
+        cpus = core_allocator.assign(key, threads or 1)
+        moncmd = moncmd + ["--cpus", ",".join(str(cpu) for cpu in cpus)]
+        print ("CPU assignment: " + core_allocator.report() + "\r\n")
+    moncmd = moncmd + ["--stream_uri", stream_uri, "--stream_desc", stream_desc]
+
+    if zygote.running():
+        try:
+            start = time.monotonic()
+            pid = zygote.spawn(moncmd)
+            print ("Forked monitor PID " + str(pid) + " in " + format((time.monotonic() - start) * 1000, ".1f") + " ms: " + " ".join(moncmd))
+            add_monitor(key, MonitorProcess(pid, stream_uri, bool(audio_only), profile=profile, session=True))
+            return
+        except OSError as e:
+            print ("Could not fork the monitor: " + str(e) + "\r\n")
 
-    Popen (moncmd,shell=True)
+    moncmd = ["sudo", "-u", username, "/usr/bin/python", base_dir + "/sjmstreammonitor-withprobe.py"] + moncmd
+    print (" ".join(moncmd))
 
+    process = Popen (moncmd, stdout=subprocess.DEVNULL, start_new_session=True)
+    add_monitor(key, MonitorProcess(process.pid, stream_uri, bool(audio_only), process, profile))
 
-# This function checks to see if a monitor is running by looking for the stream_uri in the command line of all running processes
-    # If it is, it returns the PID
-    # If it isn't, it returns false
-def check_monitor (stream_uri):
-    
-    listOfProcessNames = list()
-    # Iterate over all running processes
-    for proc in psutil.process_iter(): 
-        
-        # Get process detail as dictionary
-        pInfoDict = proc.as_dict(attrs=['pid', 'name', 'cmdline'])
-        # Append dict of process detail in list
-        listOfProcessNames.append(pInfoDict)
-        
-        #print ("\n");
+
+# starting the engine that monitors all the streams (see ENGINE_MODE)
+def start_engine():
+    print ("Starting stream engine\r\n")
+    process = Popen (["sudo", "-u", username, "/usr/bin/python3", base_dir + "/streammon_engine.py"], stdout=subprocess.DEVNULL, start_new_session=True)
+    add_monitor(ENGINE_KEY, MonitorProcess(process.pid, process=process))
+
+
+# Streams are tracked by their streamId, or by title for streams that don't have one
+def stream_key(stream_id, title):
+    return stream_id or title
+
+
+# Returns a pidfd for the process, None if pidfds aren't supported (Linux 5.3+) or the process is already gone
+def open_pidfd(pid):
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def add_monitor(key, monitor):
+    monitors[key] = monitor
+    if monitor.pidfd is not None:
+        pidfd_poller.register(monitor.pidfd, select.POLLIN)
+        pidfd_keys[monitor.pidfd] = key
+
+
+def remove_monitor(key):
+    monitor = monitors.pop(key)
+    core_allocator.release(key)
+    if monitor.pidfd is not None:
+        pidfd_poller.unregister(monitor.pidfd)
+        del pidfd_keys[monitor.pidfd]
+        os.close(monitor.pidfd)
+    # Collect the exit status of our own children so they don't stay around as zombies
+    if monitor.process is not None:
         try:
-            for line in proc.cmdline():        
-                # print (stream_uri);
-                # print (line)
-                if stream_uri in line:
-                    # print ("KILLING")
-                    # Found it
-
-                    # Return this pid 
-                    return proc.pid
-        except psutil.NoSuchProcess:
-            continue
-        except psutil.ZombieProcess:
+            monitor.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            print ("PID " + str(monitor.pid) + " did not exit\r\n")
+
+
+# Removes the monitors that have exited from the registry.  All the pidfds are checked with a single
+# poll(), so this costs next to nothing however many streams there are.
+def reap_monitors():
+    for fd, event in pidfd_poller.poll(0):
+        key = pidfd_keys[fd]
+        print ("Monitor " + str(key) + " (PID " + str(monitors[key].pid) + ") exited\r\n")
+        remove_monitor(key)
+
+    # Without pidfd support, fall back to checking each one
+    for key, monitor in list(monitors.items()):
+        if monitor.pidfd is None and monitor.has_exited():
+            print ("Monitor " + str(key) + " (PID " + str(monitor.pid) + ") exited\r\n")
+            remove_monitor(key)
+
+
+# Returns the value following option in a command line, None if it isn't there
+def cmdline_option(cmdline, option):
+    if option in cmdline[:-1]:
+        return cmdline[cmdline.index(option) + 1]
+    return None
+
+
+# Adds a monitor that was already running to the registry, given its command line
+def register_running_monitor(pid, cmdline, configs_by_uri, session=False):
+    uri = cmdline_option(cmdline, "--stream_uri")
+    config = configs_by_uri.get(uri)
+    if config is None:
+        print ("Found monitor for unknown stream " + str(uri) + ", PID " + str(pid) + "\r\n")
+        return
+    key = stream_key(config.get("streamId"), config["title"])
+    if key in monitors:
+        print ("Found a second monitor for " + config["title"] + ", PID " + str(pid) + "\r\n")
+        return
+    print ("Found running monitor " + config["title"] + ", PID " + str(pid) + "\r\n")
+    add_monitor(key, MonitorProcess(pid, uri, "--audio_only" in cmdline, profile=cmdline_option(cmdline, "--profile") or "",
+        session=session))
+    cpus = cmdline_option(cmdline, "--cpus")
+    if cpus:
+        core_allocator.claim(key, [int(cpu) for cpu in cpus.split(",")])
+
+
+# True if pid is running and was started no later than the given time, i.e. is the process that
+# recorded itself then rather than a later one that got the same pid
+def process_started_before(pid, started):
+    try:
+        return psutil.Process(pid).create_time() <= started + 1
+    except psutil.Error:
+        return False
+
+
+# Fills the registry with the monitors (and engine) that are already running, by looking at the
+# command lines of all the processes once.  Monitors for streams that aren't in stream_configs
+# any more are left alone, a restart (kill_all_monitors()) takes care of them.
+def rebuild_registry(stream_configs):
+    configs_by_uri = {}
+    for i in stream_configs:
+        configs_by_uri[i["uri"]] = i
+
+    for proc in psutil.process_iter(['pid', 'cmdline']):
+        cmdline = proc.info['cmdline']
+        # Only the python process itself, not the sudo (or shell) that started it
+        if not cmdline or not os.path.basename(cmdline[0]).startswith("python"):
             continue
-    # Default action returns false (didn't find it)
+        if any("streammon_engine.py" in arg for arg in cmdline):
+            print ("Found running engine, PID " + str(proc.pid) + "\r\n")
+            add_monitor(ENGINE_KEY, MonitorProcess(proc.pid))
+        elif any("sjmstreammonitor-withprobe.py" in arg for arg in cmdline):
+            register_running_monitor(proc.pid, cmdline, configs_by_uri)
+
+    # Monitors from a zygote look like the supervisor in ps, they leave their command lines in run/monitors
+    for pid, cmdline in streammon_zygote.forked_monitors(process_started_before):
+        register_running_monitor(pid, cmdline, configs_by_uri, session=True)
+
+    if core_allocator.assigned:
+        print ("CPU assignment: " + core_allocator.report() + "\r\n")
 
 
 # This function deals with connecting to the database
+# The connection is made once and shared by everything in this process (see streammon_db)
 def get_database():
-    from pymongo import MongoClient
-    import pymongo
-
-    print ("get_database()\r\n")
-    
-    # Create a connection using MongoClient. You can import MongoClient or use pymongo.MongoClient
-    from pymongo import MongoClient
     from pymongo.errors import ConnectionFailure
 
-    client = MongoClient(str(MONGO_CONNECTION_STRING))
     try:
-        # The ping command is cheap and does not require auth.
-        client.admin.command('ping')
+        return streammon_db.get_database()
     except ConnectionFailure:
         print("Server not available")
-
-    print ("Server available\r\n")
-
-    # Print all the databases found    
-    # for db in client.list_databases():
-    #     print(db)
-
-    # Return the database handle
-    return client[database_name]
+        # Carry on with a client that will connect once the server is back
+        return streammon_db.get_database(ping=False)
     
 
 
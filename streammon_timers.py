@@ -0,0 +1,127 @@
+'''
+streammon_timers.py
+A timer wheel for the detection deadlines (see StreamState in streammon_detect): black frame alert and
+reset, stale frame timeout, frame grab interval.
+
+Deadlines are on the monotonic clock and are filed in slots of RESOLUTION seconds, so setting or firing
+a timer costs the same however many there are.  Timers are rescheduled lazily: moving a deadline later,
+which happens for nearly every line (each new frame pushes back the stale frame timeout), only changes
+the timer's deadline.  The timer is filed again when its old slot comes up.
+
+advance(now) fires the timers that are due and costs a single comparison while nothing is.
+
+'''
+
+import math
+
+# Seconds per slot, and slots in the wheel (deadlines further out than a turn wait for the next one)
+RESOLUTION = 0.05
+SLOTS = 256
+
+
+class Timer:
+    '''A deadline and the function to call, with the current time, when it is reached.'''
+
+    __slots__ = ("callback", "deadline", "tick", "generation")
+
+    def __init__(self, callback):
+        self.callback = callback
+        # None while the timer isn't set
+        self.deadline = None
+        # The tick the timer is filed under, None if it isn't in the wheel
+        self.tick = None
+        # Entries in the wheel from before the timer was last filed don't count
+        self.generation = 0
+
+    def pending(self):
+        return self.deadline is not None
+
+
+class TimerWheel:
+    def __init__(self, resolution=RESOLUTION, slots=SLOTS):
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        # Ticks before this one have been dealt with
+        self.tick = None
+        # Nothing is due before this time
+        self.next_due = math.inf
+
+    # Sets the timer to go off at deadline (monotonic seconds)
+    def schedule(self, timer, deadline):
+        timer.deadline = deadline
+        # Already filed at or before the new deadline, it gets refiled when that slot comes up.  It may
+        # have been left out of next_due while it was cancelled, so that still needs to know.
+        if timer.tick is not None and timer.tick <= int(deadline // self.resolution):
+            self.next_due = min(self.next_due, deadline)
+            return
+        self.file(timer)
+
+    def cancel(self, timer):
+        timer.deadline = None
+
+    def file(self, timer):
+        tick = int(timer.deadline // self.resolution)
+        # A deadline before the ticks advance() has dealt with moves them back, or its slot wouldn't
+        # come up again until the wheel had gone all the way round
+        self.tick = tick if self.tick is None else min(self.tick, tick)
+        timer.tick = tick
+        timer.generation += 1
+        self.slots[tick % len(self.slots)].append((tick, timer.generation, timer))
+        if timer.deadline < self.next_due:
+            self.next_due = timer.deadline
+
+    # Seconds from now until the next timer is due, at most limit
+    def timeout(self, now, limit=1):
+        return max(0, min(limit, self.next_due - now))
+
+    # Fires the timers that are due, in order of their deadlines
+    def advance(self, now):
+        if now < self.next_due:
+            return
+
+        target = int(now // self.resolution)
+        slot_count = len(self.slots)
+        due = []
+        refile = []
+        # Each slot only needs looking at once, however far behind we are
+        for tick in range(self.tick, min(target, self.tick + slot_count - 1) + 1):
+            slot = self.slots[tick % slot_count]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                entry_tick, generation, timer = entry
+                if generation != timer.generation:
+                    continue
+                if timer.deadline is None:
+                    timer.tick = None
+                elif entry_tick > target:
+                    # Next time around the wheel
+                    keep.append(entry)
+                elif timer.deadline > now:
+                    # Moved later since it was filed, or due later in this tick
+                    refile.append(timer)
+                else:
+                    timer.tick = None
+                    due.append((timer.deadline, generation, timer))
+            self.slots[tick % slot_count] = keep
+        self.tick = target
+
+        for timer in refile:
+            self.file(timer)
+
+        # Work out when the next timer is due
+        self.next_due = math.inf
+        for slot in self.slots:
+            for entry_tick, generation, timer in slot:
+                if generation == timer.generation and timer.deadline is not None and timer.deadline < self.next_due:
+                    self.next_due = timer.deadline
+
+        due.sort(key=lambda item: item[0])
+        for deadline, generation, timer in due:
+            # Cancelled or set again by the callback of a timer that went off before it
+            if timer.generation != generation or timer.deadline is None:
+                continue
+            # The callback may set the timer again
+            timer.deadline = None
+            timer.callback(now)
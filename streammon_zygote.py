@@ -0,0 +1,228 @@
+'''
+streammon_zygote.py
+Starts monitors by forking a warm process instead of running sudo and a cold Python for each one.
+
+The supervisor forks the zygote first thing, before it connects to Mongo or starts any threads.  The
+zygote switches to the monitors' user, imports everything the monitor needs (pymongo, Apprise and its
+plugins, NumPy and our own modules) and waits for requests on a socket.  For each one it forks a
+child, which runs sjmstreammonitor-withprobe.py with the given arguments as if it had been started as
+a script.  Starting a monitor takes a fork rather than seconds of imports, and the children share the
+imported modules' memory with the zygote until they write to it.
+
+The children are the zygote's, not the supervisor's, so the supervisor keeps track of them with pidfds
+(see MonitorProcess).  They run in sessions of their own like monitors started with sudo, and each one
+writes its command line to run/monitors/<pid> so the supervisor can find it again after a restart
+(their own command line in ps is the supervisor's).
+
+'''
+
+import atexit
+import gc
+import importlib
+import json
+import os
+import pwd
+import runpy
+import signal
+import socket
+import sys
+import time
+
+import streammon_status
+
+MONITOR_DIR = streammon_status.run_dir + "/monitors"
+
+# Imported once in the zygote, the monitor's own imports then find them already loaded
+PRELOAD_MODULES = ("pymongo", "apprise", "numpy", "streammon_db", "streammon_status",
+    "streammon_log", "streammon_metrics", "streammon_detect", "streammon_raw", "streammon_timers",
+    "streammon_connect")
+
+# Largest request or reply
+MAX_MESSAGE_SIZE = 65536
+
+
+class Zygote:
+    '''
+    The supervisor's end of the zygote.  start() forks it, spawn() starts a monitor and returns its pid.
+    If the zygote can't be started, or dies, spawn() raises OSError and the caller starts the monitor
+    the old way.
+    '''
+
+    def __init__(self, script, username):
+        self.script = script
+        self.username = username
+        self.sock = None
+        self.pid = None
+
+    # Call before connecting to the database or starting any threads, a fork only copies the thread
+    # that makes it
+    def start(self):
+        try:
+            user = pwd.getpwnam(self.username)
+        except KeyError:
+            print ("No user " + self.username + ", not starting the monitor zygote")
+            return False
+        if os.getuid() not in (0, user.pw_uid):
+            print ("Not running as root or " + self.username + ", not starting the monitor zygote")
+            return False
+
+        # Where the monitors record their command lines
+        os.makedirs(MONITOR_DIR, exist_ok=True)
+        if os.getuid() == 0:
+            os.chown(MONITOR_DIR, user.pw_uid, user.pw_gid)
+
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            code = 1
+            try:
+                serve(child_sock, self.script, user)
+                code = 0
+            finally:
+                os._exit(code)
+
+        child_sock.close()
+        self.sock = parent_sock
+        self.pid = pid
+        print ("Started monitor zygote, PID " + str(pid))
+        return True
+
+    def running(self):
+        return self.sock is not None
+
+    # Starts the monitor with the given arguments, returns its pid
+    def spawn(self, argv):
+        if self.sock is None:
+            raise OSError("monitor zygote not running")
+        try:
+            self.sock.send(json.dumps({"argv": argv}).encode())
+            reply = self.sock.recv(MAX_MESSAGE_SIZE)
+        except OSError:
+            self.stopped()
+            raise
+        if not reply:
+            self.stopped()
+            raise OSError("monitor zygote exited")
+        reply = json.loads(reply)
+        if "error" in reply:
+            raise OSError(reply["error"])
+        return reply["pid"]
+
+    def stopped(self):
+        print ("Monitor zygote is gone, starting monitors with sudo from now on")
+        self.sock.close()
+        self.sock = None
+        try:
+            os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            pass
+
+
+# The zygote: switch users, load everything, then fork a monitor for each request until the
+# supervisor goes away
+def serve(sock, script, user):
+    # Nothing of the supervisor's should run in here or in the monitors
+    atexit._clear()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    # The monitors are reaped by the kernel, the supervisor watches them with pidfds
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    if os.getuid() != user.pw_uid:
+        os.initgroups(user.pw_name, user.pw_gid)
+        os.setgid(user.pw_gid)
+        os.setuid(user.pw_uid)
+    os.environ.update({"HOME": user.pw_dir, "USER": user.pw_name, "LOGNAME": user.pw_name})
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    # Keep the garbage collector from touching (and so copying) everything loaded so far in each child
+    gc.freeze()
+
+    while True:
+        try:
+            message = sock.recv(MAX_MESSAGE_SIZE)
+        except InterruptedError:
+            continue
+        if not message:
+            # The supervisor has exited
+            return
+        argv = json.loads(message)["argv"]
+        try:
+            pid = os.fork()
+        except OSError as e:
+            sock.send(json.dumps({"error": str(e)}).encode())
+            continue
+        if pid == 0:
+            sock.close()
+            run_monitor(script, argv)
+        sock.send(json.dumps({"pid": pid}).encode())
+
+
+# In the forked child: becomes a monitor started with the given arguments, never returns
+def run_monitor(script, argv):
+    code = 0
+    try:
+        os.setsid()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # Like stdout=subprocess.DEVNULL
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+
+        write_cmdline(os.getpid(), ["python3", script] + argv)
+        sys.argv = [script] + argv
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            atexit._run_exitfuncs()
+            os.unlink(os.path.join(MONITOR_DIR, str(os.getpid())))
+        except BaseException:
+            pass
+        os._exit(code)
+
+
+# Records a monitor's command line, with its start time so a later process with the same pid isn't
+# mistaken for it
+def write_cmdline(pid, cmdline):
+    os.makedirs(MONITOR_DIR, exist_ok=True)
+    with open(os.path.join(MONITOR_DIR, str(pid)), "w") as f:
+        json.dump({"cmdline": cmdline, "started": time.time()}, f)
+
+
+# Returns (pid, command line) for each monitor forked by a zygote that is still running.  is_running(pid,
+# started) says whether the process is still the one that wrote the file.
+def forked_monitors(is_running):
+    monitors = []
+    try:
+        names = os.listdir(MONITOR_DIR)
+    except OSError:
+        return monitors
+    for name in names:
+        path = os.path.join(MONITOR_DIR, name)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+            pid = int(name)
+        except (OSError, ValueError):
+            continue
+        if is_running(pid, record["started"]):
+            monitors.append((pid, record["cmdline"]))
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return monitors
@@ -0,0 +1,23 @@
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+IMPORTTIME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench", "importtime.py")
+
+# Loading the monitor needs config.py, like the monitor itself
+pytestmark = pytest.mark.skipif(importlib.util.find_spec("config") is None, reason="needs config.py")
+
+
+def test_monitor_import_within_budget():
+    # In a fresh interpreter, so nothing this process has imported counts or is left out
+    result = subprocess.run([sys.executable, IMPORTTIME, "--repeat", "3"], capture_output=True, text=True)
+    output = result.stdout + result.stderr
+    match = re.search(r"Import time ([\d.]+) ms, budget ([\d.]+) ms", result.stdout)
+    assert match, output
+    assert float(match.group(1)) <= float(match.group(2)), output
+    # Nor any lazy dependency loaded, or logging set up, at import
+    assert result.returncode == 0, output
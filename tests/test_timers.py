@@ -0,0 +1,78 @@
+import streammon_timers
+
+
+def make_timer(fired, name):
+    return streammon_timers.Timer(lambda now: fired.append((name, now)))
+
+
+def test_fires_in_deadline_order():
+    wheel = streammon_timers.TimerWheel()
+    fired = []
+    a = make_timer(fired, "a")
+    b = make_timer(fired, "b")
+    wheel.schedule(a, 100)
+    wheel.schedule(b, 91)
+    assert wheel.next_due == 91
+
+    wheel.advance(95)
+    assert fired == [("b", 95)]
+    assert wheel.next_due == 100
+
+    wheel.advance(100)
+    assert fired == [("b", 95), ("a", 100)]
+    assert wheel.next_due == float("inf")
+
+
+def test_deadline_before_current_tick():
+    wheel = streammon_timers.TimerWheel()
+    fired = []
+    a = make_timer(fired, "a")
+    b = make_timer(fired, "b")
+    wheel.schedule(a, 100)
+    wheel.advance(50)
+    # Filed for a tick advance() has already passed
+    wheel.schedule(b, 40)
+    assert wheel.timeout(50) == 0
+    wheel.advance(50)
+    assert fired == [("b", 50)]
+    assert wheel.timeout(50) == 1
+
+
+def test_rescheduled_later_fires_once():
+    wheel = streammon_timers.TimerWheel()
+    fired = []
+    a = make_timer(fired, "a")
+    wheel.schedule(a, 10)
+    wheel.schedule(a, 20)
+    wheel.advance(15)
+    assert fired == []
+    wheel.advance(20)
+    assert fired == [("a", 20)]
+
+
+def test_cancel():
+    wheel = streammon_timers.TimerWheel()
+    fired = []
+    a = make_timer(fired, "a")
+    wheel.schedule(a, 10)
+    wheel.cancel(a)
+    wheel.advance(20)
+    assert fired == []
+    assert not a.pending()
+
+
+def test_reschedule_after_cancel():
+    wheel = streammon_timers.TimerWheel()
+    fired = []
+    a = make_timer(fired, "a")
+    b = make_timer(fired, "b")
+    wheel.schedule(a, 100)
+    wheel.schedule(b, 10)
+    wheel.cancel(a)
+    # a is still filed, but doesn't count towards next_due any more
+    wheel.advance(10)
+    assert wheel.next_due == float("inf")
+    wheel.schedule(a, 200)
+    assert wheel.next_due == 200
+    wheel.advance(300)
+    assert fired == [("b", 10), ("a", 300)]